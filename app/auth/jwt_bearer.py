@@ -2,10 +2,78 @@
 # Code to check if the request is authorized or not - based on this it is given access to
 # the endpoint/route
 
+import hashlib
+import threading
+from collections import OrderedDict
 from typing import Optional
+from decouple import config
 from fastapi import Request, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from .jwt_handler import decodeJWT
+from .jwt_handler import decodeJWTPayload, utcTimestamp
+from app.profiling.profiling import activate_request_profile
+from app.metrics.metrics import STAGE_SECONDS
+
+# number of verified tokens remembered, and seconds a verified token is trusted
+# before its signature is checked again
+TOKEN_CACHE_SIZE = config('TOKEN_CACHE_SIZE', default=1024, cast=int)
+TOKEN_CACHE_TTL = config('TOKEN_CACHE_TTL', default=300, cast=int)
+
+
+class TokenCache:
+    """Bounded LRU cache of already verified tokens, keyed by the SHA-256 digest of the token.
+    An entry expires after ttl seconds and never later than the token's own "expires"
+    """
+    def __init__(self, max_size : int = TOKEN_CACHE_SIZE, ttl : int = TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # digest -> time until which the token is trusted
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, jwtoken : str) -> str:
+        return hashlib.sha256(jwtoken.encode()).hexdigest()
+
+    def is_verified(self, jwtoken : str) -> bool:
+        key = self._digest(jwtoken)
+        now = utcTimestamp()
+        with self._lock:
+            valid_until = self._entries.get(key)
+            if valid_until is not None and valid_until >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            if valid_until is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False
+
+    def add(self, jwtoken : str, expires : float) -> None:
+        if self.max_size <= 0:
+            return
+        key = self._digest(jwtoken)
+        valid_until = min(expires, utcTimestamp() + self.ttl)
+        with self._lock:
+            self._entries[key] = valid_until
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size" : len(self._entries),
+                "max_size" : self.max_size,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "hit_rate" : self.hits / lookups if lookups else 0.0,
+            }
+
+
+# verified tokens shared by the jwtBearer of every route
+token_cache = TokenCache()
 
 
 class jwtBearer(HTTPBearer):
@@ -28,8 +96,12 @@ class jwtBearer(HTTPBearer):
                 # then we would raise an exception
                 raise HTTPException(status_code= 403, detail="Invalid token or expired token")
             # verifying validity of the token by checking its expiry time
-            if not self.verify_jwt(credentials.credentials):
+            with STAGE_SECONDS.time("jwt"):
+                verified = self.verify_jwt(credentials.credentials)
+            if not verified:
                 raise HTTPException(status_code=403, detail="Invalid token or expired token.")
+            # a request sent with the X-Profile header is profiled from here on
+            activate_request_profile()
 
             return credentials.credentials
         else:
@@ -37,22 +109,11 @@ class jwtBearer(HTTPBearer):
 
 
     def verify_jwt(self, jwtoken : str):   
-        # to check if a jwt token is valid or not
-        isTokenValid : bool = False        
-        try:
-            payload = decodeJWT(jwtoken) # decode the token - returns True or False
-        except:
-            payload = None
-        
-        if payload:
-                isTokenValid = True
-            
-        return isTokenValid
-        
-
-    
-
-
-
-
- 
+        # to check if a jwt token is valid or not, recently verified tokens skip decoding
+        if token_cache.is_verified(jwtoken):
+            return True
+        payload = decodeJWTPayload(jwtoken) # decode the token - returns the payload or None
+        if payload is None:
+            return False
+        token_cache.add(jwtoken, payload['expires'])
+        return True
@@ -31,18 +31,28 @@ def signJWT(userID : str): # userID is username/email of the user
     return token_respose(token=token)
 
 
-def decodeJWT(token : str):
-    """Takes a token and decodes it using jwt package, and if expiration date is valid,
-    return the token 
+def utcTimestamp() -> float:
+    """Current time as the timestamp format used for "expires"
+    """
+    return (datetime.datetime.utcnow()).timestamp()
+
+
+def decodeJWTPayload(token : str):
+    """Takes a token and decodes it using jwt package, returns the payload if the signature
+    and expiration date are valid, otherwise None
     """
     try:
         decoded_token = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        print("**** Decoded token : \n",decoded_token)
-        if decoded_token['expires'] >= (datetime.datetime.utcnow()).timestamp():
-            print(decoded_token['expires'])
-            print((datetime.datetime.utcnow()).timestamp())
-            return True 
+        if decoded_token['expires'] >= utcTimestamp():
+            return decoded_token
         else:
-            return False 
+            return None
     except:
-        return False
\ No newline at end of file
+        return None
+
+
+def decodeJWT(token : str):
+    """Takes a token and decodes it using jwt package, and if expiration date is valid,
+    return the token 
+    """
+    return decodeJWTPayload(token) is not None
@@ -0,0 +1,48 @@
+# responsible for salting, hashing and verifying user passwords
+import hashlib
+import hmac
+import secrets
+from decouple import config
+
+# PBKDF2-SHA256 work factor - raise it as hardware gets faster, existing hashes keep
+# the iteration count they were created with
+PASSWORD_HASH_ITERATIONS = config('PASSWORD_HASH_ITERATIONS', default=260000, cast=int)
+PASSWORD_HASH_ALGORITHM = "pbkdf2_sha256"
+
+
+def hash_password(password : str, iterations : int = PASSWORD_HASH_ITERATIONS) -> str:
+    """
+    Returns a salted hash of the password as: algorithm$iterations$salt$hash
+    """
+    salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations)
+    return f"{PASSWORD_HASH_ALGORITHM}${iterations}${salt}${digest.hex()}"
+
+
+def is_password_hashed(stored : str) -> bool:
+    """
+    Checks if a stored password is a hash, users signed up before hashing have plaintext passwords
+    """
+    return bool(stored) and stored.startswith(PASSWORD_HASH_ALGORITHM + "$")
+
+
+def verify_password(password : str, stored : str) -> bool:
+    """
+    Checks the password against the stored hash (or legacy plaintext password) in constant time
+    """
+    if not stored or password is None:
+        return False
+    if not is_password_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, iterations, salt, expected = stored.split("$")
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def needs_rehash(stored : str, iterations : int = PASSWORD_HASH_ITERATIONS) -> bool:
+    """
+    Checks if a stored password is plaintext or was hashed with fewer iterations than configured
+    """
+    if not is_password_hashed(stored):
+        return True
+    return int(stored.split("$")[1]) < iterations
@@ -0,0 +1,149 @@
+# Bulk export of the Record warehouse as Parquet, Arrow IPC stream or XLSX. The rows are read in
+# chunks of the selected columns from a server-side cursor (app.database.records.iter_row_chunks)
+# and every chunk is encoded and handed to the response before the next one is read, so an
+# export of millions of rows runs in bounded memory. Parquet and Arrow need pyarrow
+import io
+import tempfile
+from datetime import datetime
+from typing import Iterator, List
+from decouple import config
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+from app.models.models import Record
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # the parquet and arrow formats are unavailable without pyarrow
+    pa = pq = None
+
+# rows per chunk read from the warehouse, also the rows per Parquet row group and Arrow record batch
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', default=10000, cast=int)
+# rows of an XLSX worksheet including the header, the rows beyond it go to the next worksheet
+XLSX_MAX_ROWS = 1048576
+# bytes per chunk of the streamed XLSX file
+XLSX_READ_SIZE = 1024 * 1024
+
+EXPORT_FORMATS = {
+    "parquet" : ("application/vnd.apache.parquet", "parquet"),
+    "arrow" : ("application/vnd.apache.arrow.stream", "arrows"),
+    "xlsx" : ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+
+
+def export_columns() -> List[str]:
+    """
+    Returns the exportable Record columns, in table order
+    """
+    return list(Record.__fields__.keys())
+
+
+def arrow_available() -> bool:
+    return pa is not None
+
+
+def arrow_schema(columns : List[str]):
+    """
+    Returns the Arrow schema of the Record columns
+    """
+    types = {int : pa.int64(), float : pa.float64(), datetime : pa.timestamp("us"), str : pa.string()}
+    return pa.schema([(column, types[Record.__fields__[column].type_]) for column in columns])
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file collecting the bytes written by an encoder until they are taken
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _record_batch(rows : list, schema):
+    # the row tuples of a chunk as one Arrow record batch
+    arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def chunks_to_arrow(chunks : Iterator[list], columns : List[str]) -> Iterator[bytes]:
+    """
+    Encodes row chunks as an Arrow IPC stream, one record batch per chunk
+    """
+    schema = arrow_schema(columns)
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for rows in chunks:
+            writer.write_batch(_record_batch(rows, schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def chunks_to_parquet(chunks : Iterator[list], columns : List[str]) -> Iterator[bytes]:
+    """
+    Encodes row chunks as a Parquet file, one row group per chunk
+    """
+    schema = arrow_schema(columns)
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_batches([_record_batch(rows, schema)]))
+            yield sink.take()
+    yield sink.take()
+
+
+def _cell(value):
+    # openpyxl refuses strings with control characters, which scraped messages can contain
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    return value
+
+
+def chunks_to_xlsx(chunks : Iterator[list], columns : List[str], max_rows : int = XLSX_MAX_ROWS) -> Iterator[bytes]:
+    """
+    Encodes row chunks as an XLSX workbook written in openpyxl write-only mode, which keeps the
+    worksheets in temporary files instead of memory. The zipped workbook is only complete when
+    all rows are written, it is streamed from a temporary file afterwards
+    """
+    workbook = Workbook(write_only=True)
+    sheet, sheet_rows = None, max_rows
+    for rows in chunks:
+        for row in rows:
+            if sheet_rows >= max_rows:
+                sheet = workbook.create_sheet(f"records_{len(workbook.worksheets) + 1}" if workbook.worksheets else "records")
+                sheet.append(columns)
+                sheet_rows = 1
+            sheet.append([_cell(value) for value in row])
+            sheet_rows += 1
+    if sheet is None: # no records, only the header
+        workbook.create_sheet("records").append(columns)
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        while True:
+            data = f.read(XLSX_READ_SIZE)
+            if not data:
+                return
+            yield data
+
+
+EXPORT_ENCODERS = {"parquet" : chunks_to_parquet, "arrow" : chunks_to_arrow, "xlsx" : chunks_to_xlsx}
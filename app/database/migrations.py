@@ -0,0 +1,135 @@
+# Schema migration of an existing warehouse: columns added to the models are added to tables
+# created before them, and the typed Record columns are backfilled from the string columns in
+# small keyset (id based) chunks, each in its own short transaction, so the table is never
+# locked for long and the backfill can be interrupted and resumed. The lead statistics are
+# rebuilt afterwards, as backfilled records move to their posting day
+#
+#   python -m app.database.migrations [--chunk-size 1000] [--pause-ms 50]
+import argparse
+import logging
+import time
+from decouple import config
+from sqlalchemy import bindparam, inspect, text, update
+from sqlmodel import SQLModel, Session, select
+
+from app.models.models import Record
+from app.database.records import typed_fields
+from app.database.stats import rebuild_stats
+
+# rows updated per transaction, and the pause between transactions so that the backfill
+# leaves room for the regular traffic
+MIGRATION_CHUNK_SIZE = config('MIGRATION_CHUNK_SIZE', default=1000, cast=int)
+MIGRATION_PAUSE_MS = config('MIGRATION_PAUSE_MS', default=0, cast=int)
+
+logger = logging.getLogger(__name__)
+
+TYPED_COLUMNS = ["posted_at", "hourly_from_value", "hourly_to_value", "budget_value"]
+
+
+def missing_columns(engine) -> list:
+    """
+    Returns the model columns missing on existing tables as table.column
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(f"{table.name}.{column.name}" for column in table.columns if column.name not in existing)
+    return missing
+
+
+def missing_indexes(engine) -> list:
+    """
+    Returns the names of the model indexes missing on existing tables
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing.extend(index.name for index in table.indexes if index.name not in existing)
+    return missing
+
+
+def check_schema(engine) -> None:
+    """
+    Checks at startup that the tables have the model columns and indexes, which this migration
+    adds. Raises RuntimeError for missing columns, missing indexes only slow queries down
+    """
+    columns = missing_columns(engine)
+    if columns:
+        raise RuntimeError(f"columns {', '.join(columns)} are missing, run python -m app.database.migrations")
+    indexes = missing_indexes(engine)
+    if indexes:
+        logger.warning("indexes %s are missing, run python -m app.database.migrations", ", ".join(indexes))
+
+
+def add_missing_columns(engine) -> list:
+    """
+    Adds the model columns missing on existing tables as nullable columns, create_all only
+    creates whole tables. Adding a nullable column without default does not rewrite the table.
+    Returns the added columns as table.column
+    """
+    added = missing_columns(engine)
+    with engine.begin() as connection:
+        for name in added:
+            table_name, column_name = name.split(".")
+            column = SQLModel.metadata.tables[table_name].columns[column_name]
+            column_type = column.type.compile(dialect=engine.dialect)
+            connection.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN "{column_name}" {column_type}'))
+    return added
+
+
+def backfill_records(engine, chunk_size : int = MIGRATION_CHUNK_SIZE, pause_ms : int = MIGRATION_PAUSE_MS,
+                     after_id : int = 0) -> int:
+    """
+    Fills the typed Record columns of rows that have none of them set yet, chunk_size rows per
+    transaction in id order starting after after_id. Returns the number of updated rows
+    """
+    pending = (Record.posted_at.is_(None) & Record.hourly_from_value.is_(None) &
+               Record.hourly_to_value.is_(None) & Record.budget_value.is_(None))
+    statement = update(Record.__table__).where(Record.__table__.c.id == bindparam("record_id"))
+    updated = 0
+    while True:
+        with Session(engine) as session:
+            rows = session.exec(
+                select(Record.id, Record.posted_on, Record.hourly_from, Record.hourly_to, Record.budget)
+                .where(Record.id > after_id, pending).order_by(Record.id).limit(chunk_size)).all()
+            if not rows:
+                return updated
+            values = []
+            for row in rows:
+                fields = typed_fields(row.posted_on, row.hourly_from, row.hourly_to, row.budget)
+                if any(value is not None for value in fields.values()): # nothing to store otherwise
+                    values.append({"record_id" : row.id, **fields})
+            if values:
+                session.execute(statement, values)
+                session.commit()
+            updated += len(values)
+            after_id = rows[-1].id
+        if pause_ms:
+            time.sleep(pause_ms / 1000)
+
+
+def main():
+    from app.database.connection import engine_url, create_indexes
+
+    parser = argparse.ArgumentParser(description="Adds missing columns and indexes and backfills the typed Record columns")
+    parser.add_argument("--chunk-size", type=int, default=MIGRATION_CHUNK_SIZE)
+    parser.add_argument("--pause-ms", type=int, default=MIGRATION_PAUSE_MS)
+    parser.add_argument("--after-id", type=int, default=0, help="resume the backfill after this record id")
+    args = parser.parse_args()
+
+    print(f"added columns: {add_missing_columns(engine_url)}")
+    create_indexes(engine_url)
+    print(f"backfilled records: {backfill_records(engine_url, args.chunk_size, args.pause_ms, args.after_id)}")
+    print(f"rebuilt lead statistics: {len(rebuild_stats(engine_url))} differing counts")
+
+
+if __name__ == "__main__":
+    main()
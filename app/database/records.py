@@ -0,0 +1,194 @@
+# Queries over the Record warehouse: filtering, keyset (id based) pagination and
+# streaming of rows with a server-side cursor, so large result sets are never held in memory
+import csv
+import io
+import json
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional
+from sqlmodel import select, Session, or_
+
+from app.models.models import Record, RecordFilter
+
+# formats of Record.posted_on: as sent in the RSS feed, and as filled in by the extraction
+# when a lead has no posting time
+POSTED_ON_FORMATS = ["%B %d, %Y %H:%M UTC", "%d/%m/%Y %H:%M"]
+
+# rows fetched from the cursor at a time when streaming
+STREAM_CHUNK_SIZE = 1000
+
+
+def parse_posted_on(posted_on : str) -> Optional[datetime]:
+    """
+    Parses a posted_on string into a naive UTC datetime, returns None if it cannot be parsed
+    """
+    if not posted_on:
+        return None
+    for fmt in POSTED_ON_FORMATS:
+        try:
+            return datetime.strptime(posted_on.strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_number(value) -> Optional[float]:
+    """
+    Parses an hourly rate or budget, stored as a string, into a float, returns None if it cannot be parsed
+    """
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def typed_fields(posted_on : str, hourly_from, hourly_to, budget) -> dict:
+    """
+    Returns the typed Record columns derived from the string fields of a lead
+    """
+    return {
+        "posted_at" : parse_posted_on(posted_on),
+        "hourly_from_value" : parse_number(hourly_from),
+        "hourly_to_value" : parse_number(hourly_to),
+        "budget_value" : parse_number(budget),
+    }
+
+
+def _naive_utc(value : datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def posted_on_matches(posted_on : str, filters : RecordFilter) -> bool:
+    """
+    Checks a posted_on string against the posted_from/posted_to range of the filters.
+    Records whose posted_on cannot be parsed never match a range
+    """
+    if filters.posted_from is None and filters.posted_to is None:
+        return True
+    posted = parse_posted_on(posted_on)
+    if posted is None:
+        return False
+    if filters.posted_from is not None and posted < _naive_utc(filters.posted_from):
+        return False
+    if filters.posted_to is not None and posted >= _naive_utc(filters.posted_to):
+        return False
+    return True
+
+
+def filtered_statement(filters : RecordFilter, after_id : int = 0, entities : tuple = (Record,),
+                       to_id : Optional[int] = None):
+    """
+    Returns a select of entities (the Record objects, or Record columns) of the records matching
+    the filters with an id greater than after_id (and at most to_id), ordered by id. The posted_on range is matched on
+    posted_at, records whose posted_at is not filled in yet (not backfilled, or unparseable) are
+    selected too and checked by the caller
+    """
+    statement = select(*entities).where(Record.id > after_id)
+    if to_id is not None:
+        statement = statement.where(Record.id <= to_id)
+    if filters.label is not None:
+        statement = statement.where(Record.label == filters.label)
+    if filters.category is not None:
+        statement = statement.where(Record.category == filters.category)
+    if filters.country is not None:
+        statement = statement.where(Record.country == filters.country)
+    if filters.posted_from is not None or filters.posted_to is not None:
+        in_range = Record.posted_at.isnot(None)
+        if filters.posted_from is not None:
+            in_range = in_range & (Record.posted_at >= _naive_utc(filters.posted_from))
+        if filters.posted_to is not None:
+            in_range = in_range & (Record.posted_at < _naive_utc(filters.posted_to))
+        statement = statement.where(or_(in_range, Record.posted_at.is_(None)))
+    return statement.order_by(Record.id)
+
+
+def iter_records(session : Session, filters : RecordFilter, after_id : int = 0, limit : Optional[int] = None,
+                 chunk_size : int = STREAM_CHUNK_SIZE) -> Iterator[Record]:
+    """
+    Yields the records matching filters in id order, fetching chunk_size rows at a time
+    from a server-side cursor
+    """
+    statement = filtered_statement(filters, after_id)
+    # records without posted_at are checked on the parsed posted_on string, so with a posted_on
+    # range the limit is applied while iterating
+    posted_range = filters.posted_from is not None or filters.posted_to is not None
+    if limit is not None and not posted_range:
+        statement = statement.limit(limit)
+    result = session.exec(statement.execution_options(stream_results=True, yield_per=chunk_size))
+    count = 0
+    try:
+        for record in result:
+            if limit is not None and count >= limit:
+                break
+            if record.posted_at is None and not posted_on_matches(record.posted_on, filters):
+                continue
+            count += 1
+            yield record
+    finally:
+        result.close()
+
+
+def iter_row_chunks(session : Session, filters : RecordFilter, columns : List[str], after_id : int = 0,
+                    limit : Optional[int] = None, chunk_size : int = STREAM_CHUNK_SIZE,
+                    to_id : Optional[int] = None) -> Iterator[list]:
+    """
+    Yields the values of columns of the records matching filters with ids in (after_id, to_id] in id order,
+    as lists of up to chunk_size row tuples fetched from a server-side cursor. Only the selected columns are read
+    """
+    posted_range = filters.posted_from is not None or filters.posted_to is not None
+    entities = [getattr(Record, column) for column in columns]
+    if posted_range: # to check records without posted_at, see iter_records
+        entities += [Record.posted_at, Record.posted_on]
+    statement = filtered_statement(filters, after_id, tuple(entities), to_id)
+    if limit is not None and not posted_range:
+        statement = statement.limit(limit)
+    result = session.execute(statement.execution_options(stream_results=True, yield_per=chunk_size))
+    count = 0
+    try:
+        for partition in result.partitions(chunk_size):
+            rows = []
+            for row in partition:
+                if limit is not None and count >= limit:
+                    break
+                if posted_range:
+                    if row[-2] is None and not posted_on_matches(row[-1], filters):
+                        continue
+                    row = row[:-2]
+                count += 1
+                rows.append(tuple(row))
+            if rows:
+                yield rows
+            if limit is not None and count >= limit:
+                return
+    finally:
+        result.close()
+
+
+def records_to_ndjson(records : Iterator[Record]) -> Iterator[str]:
+    """
+    Serializes records as newline delimited JSON, one line per record
+    """
+    for record in records:
+        yield json.dumps(record.dict(), default=str) + "\n"
+
+
+def records_to_csv(records : Iterator[Record], chunk_size : int = STREAM_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Serializes records as CSV with a header row, yielding chunk_size rows at a time
+    """
+    fields = list(Record.__fields__.keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    rows = 0
+    for record in records:
+        writer.writerow([getattr(record, field) for field in fields])
+        rows += 1
+        if rows % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,167 @@
+# Lead statistics: the number of warehouse records per posting day, label, category and country,
+# stored in the LeadStat table. The counts are incremented in the transactions inserting the records,
+# so the aggregates are read from a table whose size depends on the distinct days, labels, categories
+# and countries instead of the number of records. rebuild_stats recomputes them with one GROUP BY
+# over Record, to check or restore their consistency while records are inserted
+#
+#   python -m app.database.stats [--check]
+import argparse
+import sys
+from collections import Counter
+from datetime import date
+from typing import Iterable, Optional
+from sqlalchemy import func, insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Session, select
+
+from app.models.models import LeadStat, Record
+
+# columns of the LeadStat key, the columns the statistics can be grouped by
+STAT_KEYS = ("day", "label", "category", "country")
+
+
+def stat_key(posted_at, label : Optional[str], category : Optional[str], country : Optional[str]) -> tuple:
+    """
+    Returns the LeadStat key of a record
+    """
+    day = posted_at.strftime("%Y-%m-%d") if posted_at is not None else ""
+    return (day, label or "", category or "", country or "")
+
+
+def count_records(records : Iterable) -> Counter:
+    """
+    Returns the number of records per LeadStat key, of Record objects or dicts of Record columns
+    """
+    counts = Counter()
+    for record in records:
+        if isinstance(record, dict):
+            counts[stat_key(record.get("posted_at"), record.get("label"), record.get("category"), record.get("country"))] += 1
+        else:
+            counts[stat_key(record.posted_at, record.label, record.category, record.country)] += 1
+    return counts
+
+
+def _dialect_insert(dialect_name : str):
+    # INSERT .. ON CONFLICT DO UPDATE of the databases supporting it
+    if dialect_name == "postgresql":
+        return postgresql.insert
+    if dialect_name == "sqlite":
+        return sqlite.insert
+    return None
+
+
+def add_stats(session : Session, counts : Counter) -> None:
+    """
+    Adds counts (LeadStat key -> number of records, negative to subtract) to the statistics
+    in the transaction of session, the caller commits it together with the counted records
+    """
+    table = LeadStat.__table__
+    # keys in a fixed order, so concurrent transactions lock the rows they share in the same order
+    rows = [dict(zip(STAT_KEYS, key), leads=leads) for key, leads in sorted(counts.items()) if leads]
+    if not rows:
+        return
+    dialect_insert = _dialect_insert(session.get_bind().dialect.name)
+    if dialect_insert is not None:
+        statement = dialect_insert(table)
+        statement = statement.on_conflict_do_update(index_elements=list(STAT_KEYS),
+                                                    set_={"leads" : table.c.leads + statement.excluded.leads})
+        session.execute(statement, rows)
+        return
+    for row in rows: # other databases: update the row, insert it if there is none yet
+        result = session.execute(update(table).where(*[table.c[key] == row[key] for key in STAT_KEYS])
+                                 .values(leads=table.c.leads + row["leads"]))
+        if result.rowcount == 0:
+            session.execute(insert(table), row)
+
+
+def query_stats(session : Session, group_by : Iterable[str] = (), day_from : Optional[date] = None,
+                day_to : Optional[date] = None) -> list:
+    """
+    Returns the number of records per combination of the group_by columns (all records without),
+    as dicts of the group_by values and leads. With day_from (inclusive) or day_to (exclusive)
+    only records of known posting days in that range are counted
+    """
+    group_by = list(group_by)
+    columns = [LeadStat.__table__.c[key] for key in group_by]
+    statement = select(*columns, func.sum(LeadStat.leads))
+    if day_from is not None or day_to is not None:
+        statement = statement.where(LeadStat.day != "")
+    if day_from is not None:
+        statement = statement.where(LeadStat.day >= day_from.isoformat())
+    if day_to is not None:
+        statement = statement.where(LeadStat.day < day_to.isoformat())
+    if columns:
+        statement = statement.group_by(*columns).order_by(*columns)
+    groups = []
+    for row in session.execute(statement):
+        if row[-1]: # groups whose records were all moved to other keys
+            groups.append({**dict(zip(group_by, row[:-1])), "leads" : int(row[-1])})
+    return groups
+
+
+def record_stats(session : Session) -> Counter:
+    """
+    Returns the number of records per LeadStat key, computed from the warehouse
+    """
+    day = func.date(Record.posted_at)
+    statement = (select(day, Record.label, Record.category, Record.country, func.count())
+                 .group_by(day, Record.label, Record.category, Record.country))
+    counts = Counter()
+    for posted_day, label, category, country, leads in session.execute(statement):
+        # date() returns a string on SQLite and a date on Postgres; NULL and "" share a key
+        counts[(str(posted_day) if posted_day is not None else "", label or "", category or "", country or "")] += leads
+    return counts
+
+
+def stored_stats(session : Session) -> Counter:
+    """
+    Returns the number of records per LeadStat key, as stored in LeadStat
+    """
+    counts = Counter()
+    for stat in session.exec(select(LeadStat)):
+        counts[(stat.day, stat.label, stat.category, stat.country)] += stat.leads
+    return counts
+
+
+def rebuild_stats(engine, check_only : bool = False) -> dict:
+    """
+    Recomputes the statistics from the warehouse and corrects the stored ones that differ.
+    Returns LeadStat key -> (stored, recomputed) number of records for every key that differed.
+    With check_only nothing is written
+    """
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            # both from one snapshot, without locking out the transactions inserting records meanwhile:
+            # they add their counts in the same transaction, so they are either in both or in neither
+            connection = connection.execution_options(isolation_level="REPEATABLE READ")
+        with Session(connection) as session:
+            recomputed = record_stats(session)
+            stored = stored_stats(session)
+    differences = {key : (stored[key], recomputed[key]) for key in stored.keys() | recomputed.keys()
+                   if stored[key] != recomputed[key]}
+    if differences and not check_only:
+        # the differences are added to the stored counts like the counts of inserted records,
+        # so the counts added since the snapshot are kept and the LeadStat rows are only locked briefly
+        with Session(engine) as session:
+            add_stats(session, Counter({key : leads - stored_leads for key, (stored_leads, leads) in differences.items()}))
+            session.commit()
+    return differences
+
+
+def main():
+    from app.database.connection import engine_url
+
+    parser = argparse.ArgumentParser(description="Rebuilds the lead statistics from the warehouse")
+    parser.add_argument("--check", action="store_true",
+                        help="only report the differing counts, exit with status 1 if any differs")
+    args = parser.parse_args()
+
+    differences = rebuild_stats(engine_url, check_only=args.check)
+    for key, (stored, recomputed) in sorted(differences.items()):
+        print(f"{dict(zip(STAT_KEYS, key))}: stored {stored}, recomputed {recomputed}")
+    print(f"{len(differences)} differing counts{'' if args.check else ' rebuilt'}")
+    sys.exit(1 if args.check and differences else 0)
+
+
+if __name__ == "__main__":
+    main()
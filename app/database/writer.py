@@ -0,0 +1,144 @@
+# Optional write-behind of Record rows: label_fetch enqueues the record and returns the label,
+# a background thread inserts the queued records in bulk on size or time thresholds
+import logging
+import threading
+import time
+from collections import deque
+from decouple import config
+from sqlalchemy import insert
+from sqlmodel import Session
+
+from app.models.models import Record
+from app.database.connection import engine_url
+from app.database.stats import add_stats, count_records
+
+logger = logging.getLogger(__name__)
+
+# write-behind is off by default, label_fetch then commits every record before returning
+WRITE_BEHIND = config('WRITE_BEHIND', default=False, cast=bool)
+# maximum records waiting in memory, records per bulk insert, and the longest time
+# a record waits before it is flushed
+WRITE_BEHIND_QUEUE_SIZE = config('WRITE_BEHIND_QUEUE_SIZE', default=10000, cast=int)
+WRITE_BEHIND_BATCH_SIZE = config('WRITE_BEHIND_BATCH_SIZE', default=500, cast=int)
+WRITE_BEHIND_INTERVAL_MS = config('WRITE_BEHIND_INTERVAL_MS', default=200, cast=int)
+
+
+class RecordWriter:
+    """
+    Buffers Record rows in a bounded queue and inserts them with one executemany per batch
+    from a background thread. submit never blocks: when the queue is full it returns False
+    and the caller saves the record itself.
+    """
+
+    def __init__(self, engine=engine_url, enabled : bool = WRITE_BEHIND, queue_size : int = WRITE_BEHIND_QUEUE_SIZE,
+                 batch_size : int = WRITE_BEHIND_BATCH_SIZE, interval_ms : int = WRITE_BEHIND_INTERVAL_MS):
+        self.engine = engine
+        self.enabled = enabled
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self._rows = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self.written = 0
+        self.flushes = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """
+        Starts the background flushing thread, if not running
+        """
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="record-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, record : Record) -> bool:
+        """
+        Enqueues a record for the next bulk insert, returns False if the queue is full
+        """
+        self.start()
+        with self._cond:
+            if len(self._rows) >= self.queue_size:
+                self.rejected += 1
+                return False
+            self._rows.append(record.dict(exclude={'id'}))
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def _take_batch(self) -> list:
+        # waits for the first row, then until batch_size rows are queued or interval has passed
+        with self._cond:
+            self._cond.wait_for(lambda: self._rows or self._stopping)
+            deadline = time.monotonic() + self.interval
+            while len(self._rows) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+
+    def _run(self) -> None:
+        while True:
+            rows = self._take_batch()
+            if rows:
+                self.flush_rows(rows)
+            elif self._stopping:
+                return
+
+    def flush_rows(self, rows : list) -> None:
+        """
+        Inserts rows into the warehouse with one executemany statement
+        """
+        try:
+            with Session(self.engine) as session:
+                session.execute(insert(Record.__table__), rows)
+                add_stats(session, count_records(rows))
+                session.commit()
+            self.written += len(rows)
+            self.flushes += 1
+        except Exception:
+            self.failed += len(rows)
+            logger.exception("%d records could not be saved in the warehouse", len(rows))
+
+    def flush(self) -> None:
+        """
+        Inserts every queued record now
+        """
+        while True:
+            with self._cond:
+                rows = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+            if not rows:
+                return
+            self.flush_rows(rows)
+
+    def stop(self, timeout : float = 30) -> None:
+        """
+        Stops the background thread after the queued records have been written
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled" : self.enabled,
+            "queued" : len(self._rows),
+            "written" : self.written,
+            "flushes" : self.flushes,
+            "rejected" : self.rejected,
+            "failed" : self.failed,
+        }
+
+
+# writer shared by all label_fetch requests of this process
+record_writer = RecordWriter()
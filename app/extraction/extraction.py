@@ -0,0 +1,47 @@
+# contains code to extract information from RSS Feed - One feed at a time
+from app.extraction.processing import StringProc
+
+# fields of an extracted lead, the Record fields without id
+DB_FIELDS = ['posted_on', 'category', 'skills', 'country', 'message', 'hourly_from', 'hourly_to', 'budget', 'label']
+
+
+def extractor(feed : str) -> dict:
+    """
+    Extracts information from a lead's message content received as RSS feed.
+    """
+    # Instantiating StringProc for string processing operations
+    processor = StringProc()
+    # embedded info extraction
+    single_info_dict= processor.extract_info(feed)
+
+    if 'skills' in single_info_dict.keys():# if skills found in the data
+        # cleaning: skills
+        skills = single_info_dict['skills']
+        skills = processor.remove_extra_whitespaces(skills)
+        single_info_dict['skills'] = skills
+
+    ## Job description extraction and cleaning: html, URLs, &amp; and &nbsp; and extra
+    ## whitespaces along with newlines etc are removed in one fused pass
+    message_content = processor.clean_message(feed)
+
+    # adding extracted message into extracted info dict
+    single_info_dict['message'] = message_content
+
+    # Hourly Range and Budget processing
+    if "hourly_range" in single_info_dict.keys():
+        single_info_dict = processor.hourly_split_modify(data=single_info_dict)
+    elif "budget" in single_info_dict.keys():
+        single_info_dict = processor.budget_modify(data=single_info_dict)
+
+    # removing hourly_range from the dictionary, not needed as converted into from and to informaiton
+    if 'hourly_range' in single_info_dict.keys():
+        del single_info_dict['hourly_range']
+
+    ## amending single_info_dict to contain all db fields for query generation and label prediction
+    for key in DB_FIELDS: # if single_info_dict does not have the database field then add it with empty
+        if key in single_info_dict.keys():
+            continue
+        else:
+            single_info_dict[key] = ""
+
+    return single_info_dict
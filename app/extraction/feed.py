@@ -0,0 +1,89 @@
+# Incremental parsing of RSS documents into leads. Items are handed out as soon as their closing
+# tag has been read and are then dropped from the parsed tree, so feeds with thousands of items
+# are parsed in bounded memory while they are still being received
+import re
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from xml.etree.ElementTree import XMLPullParser
+from decouple import config
+
+from app.extraction.extraction import extractor
+
+# number of feed items classified and saved together
+FEED_BATCH_SIZE = config('FEED_BATCH_SIZE', default=256, cast=int)
+
+# the extraction expects the embedded fields of a description to end with <br>
+BR_TAG = re.compile(r"<br\s*/?>")
+
+
+def _local_name(tag : str) -> str:
+    """
+    Returns the tag without its {namespace} prefix
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+class FeedParser:
+    """
+    Incremental RSS parser: feed() the raw document chunk by chunk and receive the items
+    completed by that chunk as dicts of child tag -> text
+    """
+
+    def __init__(self):
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._open = [] # elements whose end tag has not been read yet
+        self.items = 0
+
+    def feed(self, chunk : bytes) -> list:
+        """
+        Parses the next chunk of the document, returns the items it completed
+        """
+        self._parser.feed(chunk)
+        return self._read_items()
+
+    def close(self) -> list:
+        """
+        Ends the document, raises xml.etree.ElementTree.ParseError if it is incomplete
+        """
+        self._parser.close()
+        return self._read_items()
+
+    def _read_items(self) -> list:
+        items = []
+        for event, element in self._parser.read_events():
+            if event == "start":
+                self._open.append(element)
+                continue
+            self._open.pop()
+            if _local_name(element.tag) != "item":
+                continue
+            items.append({_local_name(child.tag) : (child.text or "") for child in element})
+            # drop the item from the tree, so parsed items do not accumulate
+            if self._open:
+                self._open[-1].remove(element)
+            self.items += 1
+        return items
+
+
+def pub_date(value : str) -> str:
+    """
+    Formats an RSS pubDate like the posted_on of the embedded lead info, e.g. August 06, 2023 09:40 UTC
+    """
+    try:
+        return parsedate_to_datetime(value).astimezone(timezone.utc).strftime("%B %d, %Y %H:%M UTC")
+    except (TypeError, ValueError):
+        return value
+
+
+def item_lead(item : dict, model_name : str) -> dict:
+    """
+    Extracts the lead fields from a feed item's description, as expected by Lead
+    """
+    description = BR_TAG.sub("<br>", item.get("description", ""))
+    lead = extractor(description)
+    # the item's pubDate is used if the description has no posting time
+    if 'Posted On</b>' not in description and item.get("pubDate"):
+        lead['posted_on'] = pub_date(item['pubDate'])
+    del lead['label']
+    lead['model_name'] = model_name
+    return lead
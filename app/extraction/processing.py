@@ -0,0 +1,218 @@
+import re
+from datetime import datetime
+from typing import Iterable
+
+# patterns are compiled once at import instead of on every call
+EMBEDDED_INFO = re.compile(r"<b>(.*?)<br>|<b>(.*?)\n")
+HTML_TAG = re.compile(r'<.*?>')
+URL = re.compile(r'https?://\S+')
+SPACES = re.compile(r' +')
+SEPARATORS = re.compile(r'\+')
+WHITESPACE = re.compile(r'\s+')
+PUNCTUATION = re.compile(r'[^\w\s]')
+PRICE_SYMBOLS = re.compile(r'[$,]')
+EMOJI_CHARS = ("\U0001F600-\U0001F64F" # emoticons
+               "\U0001F300-\U0001F5FF" # symbols & pictographs
+               "\U0001F680-\U0001F6FF" # transport & map symbols
+               "\U0001F1E0-\U0001F1FF" # flags (iOS)
+               "\U00002500-\U00002BEF" # chinese char
+               "\U00002702-\U000027B0"
+               "\U000024C2-\U0001F251"
+               "\U0001f926-\U0001f937"
+               "\U00010000-\U0010ffff"
+               "\u2640-\u2642"
+               "\u2600-\u2B55"
+               "\u200d"
+               "\u23cf"
+               "\u23e9"
+               "\u231a"
+               "\ufe0f" # dingbats
+               "\u3030")
+EMOJI = re.compile(f"[{EMOJI_CHARS}]+")
+
+# fused message cleaning, equivalent to strip_html, strip_urls, replace_amp, replace_nbsp and
+# remove_all_extra_symbols applied one after the other, with two regex passes:
+# 1. html tags are removed
+# 2. URLs are replaced by a space. A URL always extends up to whitespace or the end of the
+#    text, so the space instead of nothing only adds whitespace that is collapsed anyway
+# the entities and + signs are then replaced, and the whitespace collapsed, with str methods,
+# as substituting every single space with re is the most expensive step of the original passes
+
+
+class StringProc:
+    """
+    This class contains methods for information extraction from passed string
+    and performing cleaning operations
+    """
+
+    def extract_info(self, txt: str) -> dict:
+        """
+        Extracts information of Hourly Rate, Budget, Category, Skills, Country
+        from the passed string and returns a dictionary with keys named after the
+        aforementioned keywords and their respective values
+        """
+        raw_extract = EMBEDDED_INFO.findall(txt)
+        if len(raw_extract)==0: # if job does not have embedded information
+            date_time_now = datetime.now()
+            date_time_now = date_time_now.strftime("%d/%m/%Y %H:%M")
+            return {'posted_on': date_time_now, 'budget':'', 'category':'', 'country':'', 'skills':''}
+
+        raw_ext = [] # raw_extract has tuples that have null strings along with info - extracting relevant info into this list
+        for tupl in raw_extract:
+            for entry in tupl:
+                if entry != '':
+                    raw_ext.append(entry)
+
+        extracted_dict = dict()
+        for item in raw_ext:
+                if 'Budget</b>' in item:
+                    value = item.split(":")[1] # split item on : select the info at index pos 1
+                    value = value.strip()
+                    extracted_dict['budget'] = value
+                elif 'Hourly Range</b>' in item:
+                    value = item.split(":")[1]
+                    value = value.strip()
+                    extracted_dict['hourly_range'] = value
+                elif 'Skills</b>' in item:
+                    value = item.split(":")[1]
+                    value = value.strip()
+                    extracted_dict['skills'] = value
+                elif 'Category</b>' in item:
+                    value = item.split(":")[1]
+                    value = value.strip()
+                    extracted_dict['category'] = value
+                elif 'Country</b>' in item:
+                    value = item.split(":")[1]
+                    value = value.strip()
+                    extracted_dict['country'] = value
+                elif 'Posted On</b>' in item:
+                    # finds first occurrence of : and slice to extract time.
+                    # As time also has : in it, so slicing on first occurrence of : instead
+                    # of splitting on :
+                    value = item[item.find(":")+1 : ]
+                    value = value.strip()
+                    extracted_dict['posted_on'] = value
+
+        return extracted_dict
+
+    def strip_html(self, txt: str) -> str:
+        """
+        Removes html tags from the text - potentially removes any other text between <> symbols as well
+        """
+        return HTML_TAG.sub("", txt)
+
+    def strip_urls(self, txt: str) -> str:
+        """
+        Strips away the urls in the pased string
+        """
+        return URL.sub("", txt)
+
+    def extract_message_txt(self, txt: str) -> str:
+        """
+        Returns string from start to the first occurrence of bold tag <b>
+        """
+        return txt[:txt.find("<b>")]
+
+    def remove_extra_whitespaces(self, text):
+        """
+        Only removes more than one space. Does not remove newline tab etc characters.
+        """
+        return SPACES.sub(' ', text)
+
+    def remove_all_extra_symbols(self, text):
+        """
+        Removes all extra whitespaces and some symbols along with newlines tabs etc
+        """
+        text = SEPARATORS.sub(' ', text) # + signs are replaced by spaces
+        return WHITESPACE.sub(' ', text).strip()
+
+    def replace_amp(self, text):
+        """
+        Replaces &amp; with a space : " "
+        """
+        text = text.replace('&amp;', ' ')
+        return text
+
+    def replace_nbsp(self, text):
+        """
+        Replaces &nbsp; with a space : " "
+        """
+        text = text.replace('&nbsp;', ' ')
+        return text
+
+    def punctuation_remove(self, text):
+        """
+        Removes punctuation and special characters from the passed text
+        """
+        text = PUNCTUATION.sub('', text)
+        return WHITESPACE.sub(' ', text).strip()
+
+    def emoji_remove(self, text : str) -> str:
+        """
+        Removes Emojis from passed string
+        """
+        return EMOJI.sub('', text)
+
+    def clean_message(self, txt : str, remove_emoji : bool = False) -> str:
+        """
+        Returns the cleaned job description of a lead's message content:
+        the text up to the first bold tag <b>, without html tags, URLs, &amp; and &nbsp;
+        entities, + signs and extra whitespace (and emojis with remove_emoji)
+        """
+        return self.clean_messages([txt], remove_emoji=remove_emoji)[0]
+
+    def clean_messages(self, texts : Iterable[str], remove_emoji : bool = False) -> list:
+        """
+        Cleans a list (or pandas column) of messages like clean_message, returns a list
+        """
+        tags_sub, emoji_sub, urls_sub = HTML_TAG.sub, EMOJI.sub, URL.sub
+        cleaned = []
+        for txt in texts:
+            txt = tags_sub("", txt[:txt.find("<b>")])
+            if remove_emoji:
+                txt = emoji_sub("", txt)
+            txt = urls_sub(" ", txt)
+            txt = txt.replace('&amp;', ' ').replace('&nbsp;', ' ').replace('+', ' ')
+            cleaned.append(" ".join(txt.split())) # str.split() splits on the same whitespace as \s
+        return cleaned
+
+    def price_modify(self, txt: str) -> float:
+        """
+        Strips away the dollar $ sign and , from the pased string which is representing
+        price e.g $500 or $2,000 and returns a float value after type casting
+        """
+        return PRICE_SYMBOLS.sub("", txt)
+
+    def hourly_split_modify(self, data: dict)->dict:
+        """Extracts Hourly from and Hourly to info from Hourly Range from the
+        passed dictionary object, modifies them by removing $ sign and , and
+        add this info into dict object and returns it
+        """
+        try:
+            price_range = data['hourly_range']
+            price_range = price_range.split("-")
+            for i, price in enumerate(price_range):
+                price_range[i] = self.price_modify(price)
+            data['hourly_from'] = float(price_range[0])
+            data['hourly_to'] = float(price_range[1])
+        except Exception as e: # exception occurs when split does not find - to split over i.e. empty Hourly Range
+            data['hourly_from']  = ''
+            data['hourly_to'] = ''
+
+        return data
+
+
+    def budget_modify(self, data: dict)->dict:
+        """Reads Budget info from the passed dictionary object, modifies it by
+        removing $ sign and ,
+        """
+        try:
+            price_value = data['budget']
+            if not(isinstance(price_value, float)): # if budget is not a float value, then modify it
+                price_value = self.price_modify(price_value)
+                price_value = float(price_value)
+                data['budget'] = price_value
+        except Exception as e: # exception occurs on float type casting of an empty string i.e. empty Budget price
+            data['budget'] = ''
+
+        return data
@@ -0,0 +1,178 @@
+# Prometheus-compatible metrics: counters and latency histograms are updated in place while
+# serving (a lock, a bisect and a few increments), gauges are only computed when /metrics is
+# scraped, and the text exposition format is rendered on scrape as well
+import bisect
+import math
+import threading
+import time
+
+# upper bounds in seconds of the latency histogram buckets, from 100us to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names : tuple, values : tuple, extra : str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value : float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A metric family with a name, help text and label names, added to the registry it is created in
+    """
+    kind = "untyped"
+
+    def __init__(self, name : str, documentation : str, labelnames : tuple = (), registry : list = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).append(self)
+
+    def samples(self) -> list:
+        """
+        Returns (sample name, label string, value) tuples
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count per label values, e.g. Counter(...).inc("label_fetch")
+    """
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount : float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [(f"{self.name}_total", _labels(self.labelnames, key), value) for key, value in values]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (seconds) per label values, in cumulative buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, *args, buckets : tuple = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self._values = {} # label values -> [count per bucket (+ overflow), sum]
+
+    def observe(self, value : float, *labelvalues) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labelvalues) -> "_Timer":
+        """
+        Returns a context manager observing the duration of its with block
+        """
+        return _Timer(self, labelvalues)
+
+    def count(self, *labelvalues) -> int:
+        entry = self._values.get(labelvalues)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> list:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", _labels(self.labelnames, key, f'le="{_number(bound)}"'), cumulative))
+            samples.append((f"{self.name}_sum", _labels(self.labelnames, key), total))
+            samples.append((f"{self.name}_count", _labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class _Timer:
+    # a plain class instead of a generator based context manager, which costs a few times more per block
+    __slots__ = ("histogram", "labelvalues", "start")
+
+    def __init__(self, histogram : Histogram, labelvalues : tuple):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+        return False
+
+
+class Gauge(Metric):
+    """
+    Current values read from a callback at scrape time: the callback returns
+    a dict of label values tuple -> value (the empty tuple without labels)
+    """
+    kind = "gauge"
+
+    def __init__(self, name : str, documentation : str, callback, labelnames : tuple = (), registry : list = None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def samples(self) -> list:
+        return [(self.name, _labels(self.labelnames, key), value) for key, value in self.callback().items()]
+
+
+# metrics exposed by /metrics of this process
+REGISTRY = []
+
+
+def render(registry : list = REGISTRY) -> str:
+    """
+    Returns the metrics in the Prometheus text exposition format. A failing gauge callback
+    is left out instead of failing the scrape
+    """
+    families = []
+    for metric in registry:
+        try:
+            families.append(metric.render())
+        except Exception:
+            continue
+    return "\n".join(families) + "\n"
+
+
+# --------------- label_fetch and batch endpoint metrics -------------------
+REQUESTS = Counter("leadapi_requests", "Requests handled per endpoint", ["endpoint"])
+ERRORS = Counter("leadapi_errors", "Failed requests and leads per endpoint and error type", ["endpoint", "type"])
+PREDICTIONS = Counter("leadapi_predictions", "Predicted labels per model", ["model", "label"])
+REQUEST_SECONDS = Histogram("leadapi_request_seconds", "Request latency per endpoint", ["endpoint"])
+# jwt, model_lookup, model_load, encode, predict, record_commit (or record_queue with write-behind)
+STAGE_SECONDS = Histogram("leadapi_stage_seconds", "Latency of the stages of serving a lead", ["stage"])
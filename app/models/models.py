@@ -1,6 +1,8 @@
 from pydantic import BaseModel, Field, EmailStr
 from typing import Union, Optional
+from datetime import datetime
 from sqlmodel import SQLModel, Field, Column
+from sqlalchemy import UniqueConstraint
 # from sqlalchemy import Column, Integer, Float
 
 class Lead(BaseModel):
@@ -38,14 +40,20 @@ class Record(SQLModel, table=True):
     """
     id : Optional[int] = Field(default=None, primary_key=True)
     posted_on : str = None  # None -> same as : null=True
-    category : str = None
+    category : str = Field(default=None, index=True)
     skills : str = None
-    country : str = None
+    country : str = Field(default=None, index=True)
     message : str = None
     hourly_from : str = None
     hourly_to : str = None
     budget : str = None
-    label : str = None
+    label : str = Field(default=None, index=True)
+    # typed copies of posted_on (parsed, naive UTC), hourly_from, hourly_to and budget, so the
+    # warehouse can be filtered and aggregated in SQL. None where the string cannot be parsed
+    posted_at : Optional[datetime] = Field(default=None, index=True)
+    hourly_from_value : Optional[float] = None
+    hourly_to_value : Optional[float] = None
+    budget_value : Optional[float] = None
     class Config:
         the_schema = {
             "lead_demo" :{
@@ -62,13 +70,40 @@ class Record(SQLModel, table=True):
         }
 
 
+class RecordFilter(BaseModel):
+    """
+    Query parameters filtering the records returned by data_fetch and data_stream
+    """
+    label : Optional[str] = None
+    category : Optional[str] = None
+    country : Optional[str] = None
+    posted_from : Optional[datetime] = None # inclusive
+    posted_to : Optional[datetime] = None # exclusive
+
+
+class LeadStat(SQLModel, table=True):
+    """
+    Number of warehouse records per posting day, label, category and country, kept up to date
+    in the transactions inserting the records. Missing values are stored as empty strings,
+    so that every combination is one row of the unique key
+    """
+    __table_args__ = (UniqueConstraint("day", "label", "category", "country"),)
+    id : Optional[int] = Field(default=None, primary_key=True)
+    day : str = Field(index=True) # YYYY-MM-DD of posted_at, empty when unknown
+    label : str
+    category : str
+    country : str
+    leads : int = 0
+
+
 class MLModel(SQLModel, table=True):
     """
     Model containing ml model name details
     """
     id : Optional[int] = Field(default=None, primary_key=True)
-    model_name : str
-    model_file : str
+    model_name : str = Field(index=True, unique=True)
+    model_file : str # content addressed: models/<sha256 of the file>.<extension>
+    metrics : Optional[str] = None # JSON evaluation metrics of models trained from the warehouse
     class Config:
         the_schema = {
             "mlmodel_demo" :{
@@ -77,6 +112,63 @@ class MLModel(SQLModel, table=True):
         }
 
 
+class TrainingJob(SQLModel, table=True):
+    """
+    A model training run on the warehouse records, its progress and result
+    """
+    id : Optional[int] = Field(default=None, primary_key=True)
+    model_name : str # name the trained model is registered under
+    parameters : str # JSON of the TrainingRequest
+    status : str = "queued" # queued, running, succeeded, failed
+    stage : Optional[str] = None # loading, training, evaluating, registering
+    records : int = 0 # labeled records loaded so far
+    metrics : Optional[str] = None # JSON
+    error : Optional[str] = None
+    created_at : datetime = Field(default_factory=datetime.utcnow)
+    started_at : Optional[datetime] = None
+    finished_at : Optional[datetime] = None
+
+
+class RescoringJob(SQLModel, table=True):
+    """
+    A re-scoring of the stored records with ids in (from_id, to_id] by a model version,
+    last_id is the checkpoint it resumes from
+    """
+    id : Optional[int] = Field(default=None, primary_key=True)
+    model_name : str
+    from_id : int = 0
+    to_id : int
+    last_id : int = 0
+    status : str = "queued" # queued, running, succeeded, failed
+    records : int = 0 # records scored so far
+    changed : int = 0 # records whose label changed
+    error : Optional[str] = None
+    created_at : datetime = Field(default_factory=datetime.utcnow)
+    finished_at : Optional[datetime] = None
+
+
+class TrainingRequest(SQLModel):
+    """
+    Training Job Schema: the name of the new model version, the forest parameters and
+    optionally the posted_on range of the records to train on
+    """
+    model_name : str
+    n_estimators : int = Field(default=100, ge=1)
+    max_depth : Optional[int] = Field(default=None, ge=1)
+    test_fraction : float = Field(default=0.2, gt=0, lt=1) # records held out for the evaluation
+    posted_from : Optional[datetime] = None
+    posted_to : Optional[datetime] = None
+    random_state : int = 0
+    class Config:
+        the_schema = {
+            "training_request_demo" :{
+                "model_name" : "jkl_v1",
+                "n_estimators" : 100,
+                "test_fraction" : 0.2,
+            }
+        }
+
+
 class MLModelDelete(SQLModel):
     """
     Model Delte Schema
@@ -90,11 +182,47 @@ class MLModelDelete(SQLModel):
         }
 
 
+class ModelAlias(SQLModel, table=True):
+    """
+    Alias (e.g. production, candidate) pointing at an uploaded model version,
+    optionally with a shadow model scoring the same leads in the background
+    """
+    id : Optional[int] = Field(default=None, primary_key=True)
+    alias : str = Field(index=True, unique=True)
+    model_name : str
+    shadow_model_name : Optional[str] = None
+    class Config:
+        the_schema = {
+            "model_alias_demo" :{
+                "alias" : "production",
+                "model_name" : "jkl_v1",
+                "shadow_model_name" : "jkl_v2",
+            }
+        }
+
+
+class ModelAliasUpdate(SQLModel):
+    """
+    Model Alias repoint Schema
+    """
+    alias : str
+    model_name : str
+    shadow_model_name : Optional[str] = None
+    class Config:
+        the_schema = {
+            "model_alias_demo" :{
+                "alias" : "production",
+                "model_name" : "jkl_v1",
+                "shadow_model_name" : "jkl_v2",
+            }
+        }
+
+
 class Users(SQLModel, table=True):
     id : Optional[int] = Field(default=None, primary_key=True)
     fullname : str = Field(default=None)
-    email : EmailStr = Field(default=None) # EmailStr is an email validator
-    password : str = Field(default=None)
+    email : EmailStr = Field(default=None, index=True, unique=True) # EmailStr is an email validator
+    password : str = Field(default=None) # salted hash, see app.auth.password
     class Config:
         the_schema = {
             "user_demo" :{
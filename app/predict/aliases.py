@@ -0,0 +1,131 @@
+# Model aliases and shadow scoring. A lead's model_name may name an uploaded model version or an
+# alias such as 'production'; repointing an alias is a single row update, done only after the new
+# version is loaded and warmed, so swaps do not interrupt label_fetch
+import asyncio
+import logging
+from typing import Optional
+from sqlmodel import select, Session
+
+from app.models.models import MLModel, ModelAlias
+from app.predict.executor import inference_executor, InferenceExecutor, InferenceSaturated
+from app.predict.predict import Predict
+from app.predict.registry import model_registry, ModelRegistry
+from app.predict.warmup import warm_model
+
+logger = logging.getLogger(__name__)
+
+
+def get_model(session : Session, model_name : str) -> MLModel:
+    """
+    Returns the MLModel row of an uploaded model version, raises NoResultFound if missing
+    """
+    statement = select(MLModel).where(MLModel.model_name==model_name)
+    return session.exec(statement).one()
+
+
+def resolve_model(session : Session, name : str) -> tuple:
+    """
+    Resolves a model name or alias into (MLModel, shadow MLModel or None).
+    Uploaded model names take precedence over aliases
+    """
+    statement = select(MLModel).where(MLModel.model_name==name)
+    ml_model = session.exec(statement).first()
+    if ml_model is not None:
+        return ml_model, None
+    statement = select(ModelAlias).where(ModelAlias.alias==name)
+    model_alias = session.exec(statement).one()
+    shadow = None
+    if model_alias.shadow_model_name:
+        shadow = session.exec(select(MLModel).where(MLModel.model_name==model_alias.shadow_model_name)).first()
+    return get_model(session, model_alias.model_name), shadow
+
+
+def load_and_warm(session : Session, model_name : str, registry : ModelRegistry = model_registry) -> MLModel:
+    """
+    Loads a model version into the registry and runs a dummy prediction through it
+    """
+    ml_model = get_model(session, model_name)
+    warm_model(registry.get(ml_model.model_name, ml_model.model_file))
+    return ml_model
+
+
+def repoint_alias(session : Session, alias : str, model_name : str, shadow_model_name : Optional[str] = None,
+                  registry : ModelRegistry = model_registry) -> ModelAlias:
+    """
+    Warms the target (and shadow) version, then points the alias at it in one committed row update
+    """
+    if session.exec(select(MLModel).where(MLModel.model_name==alias)).first() is not None:
+        raise ValueError(f"{alias} is the name of an uploaded model")
+    load_and_warm(session, model_name, registry)
+    if shadow_model_name:
+        load_and_warm(session, shadow_model_name, registry)
+    model_alias = session.exec(select(ModelAlias).where(ModelAlias.alias==alias)).first()
+    if model_alias is None:
+        model_alias = ModelAlias(alias=alias, model_name=model_name)
+    model_alias.model_name = model_name
+    model_alias.shadow_model_name = shadow_model_name
+    session.add(model_alias)
+    session.commit()
+    session.refresh(model_alias)
+    return model_alias
+
+
+class ShadowScorer:
+    """
+    Scores already encoded vectors with a shadow model in the background and counts and logs
+    disagreements with the label that was returned. Never delays the response: when the
+    inference executor is saturated the comparison is skipped
+    """
+
+    def __init__(self, executor : InferenceExecutor = inference_executor, registry : ModelRegistry = model_registry):
+        self.executor = executor
+        self.registry = registry
+        self._tasks = set()
+        self.compared = 0
+        self.disagreements = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def schedule(self, shadow : MLModel, vector, label : str, primary_name : str) -> None:
+        """
+        Starts the shadow prediction of vector without waiting for it
+        """
+        task = asyncio.ensure_future(self._score(shadow.model_name, shadow.model_file, vector, label, primary_name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _predict(self, model_name : str, model_file : str, vector) -> str:
+        model = self.registry.get(model_name, model_file)
+        return Predict().predict_lead(vector=vector, ml_model=model)
+
+    async def _score(self, model_name : str, model_file : str, vector, label : str, primary_name : str) -> None:
+        if self.executor.pending >= self.executor.max_workers:
+            self.skipped += 1 # only use idle inference threads
+            return
+        try:
+            shadow_label = await self.executor.run(self._predict, model_name, model_file, vector)
+        except InferenceSaturated:
+            self.skipped += 1
+            return
+        except Exception:
+            self.errors += 1
+            logger.exception("shadow model %s could not predict", model_name)
+            return
+        self.compared += 1
+        if shadow_label != label:
+            self.disagreements += 1
+            logger.info("shadow model %s predicted %s, %s predicted %s for %s",
+                        model_name, shadow_label, primary_name, label, vector.tolist())
+
+    def stats(self) -> dict:
+        return {
+            "compared" : self.compared,
+            "disagreements" : self.disagreements,
+            "disagreement_rate" : self.disagreements / self.compared if self.compared else 0.0,
+            "skipped" : self.skipped,
+            "errors" : self.errors,
+        }
+
+
+# shadow scorer shared by all label_fetch requests of this process
+shadow_scorer = ShadowScorer()
@@ -0,0 +1,336 @@
+# Memory-mappable storage of tree ensemble models. The nodes of all trees are stored as raw
+# NumPy arrays (.npy) in a model directory and opened with mmap_mode='r', so every uvicorn
+# worker process shares the same read-only pages from the OS page cache instead of holding
+# its own unpickled copy of every tree
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from decouple import config
+
+# format of newly uploaded models: 'pickle' keeps the uploaded file,
+# 'mmap' converts tree ensembles into a memory-mappable model directory
+MODEL_STORAGE = config('MODEL_STORAGE', default='pickle')
+# how tree ensembles loaded from pickle files predict: 'sklearn' calls the model's own predict,
+# 'compiled' flattens the ensemble into ForestArrays at load time
+INFERENCE_BACKEND = config('INFERENCE_BACKEND', default='sklearn')
+# above this many rows a compiled model hands the batch to the sklearn model it was compiled
+# from, whose per-row Cython traversal is faster for large batches
+COMPILED_MAX_BATCH = config('COMPILED_MAX_BATCH', default=128, cast=int)
+FOREST_SUFFIX = ".forest"
+FOREST_FORMAT_VERSION = 1
+FOREST_ARRAYS = ["roots", "children", "feature", "threshold", "value", "classes"]
+
+
+class ForestArrays:
+    """
+    Tree ensemble classifier compiled into flat node arrays, predicting like sklearn's
+    RandomForestClassifier: the class with the highest mean leaf probability over all trees.
+    The children of node i are children[2*i] (feature <= threshold) and children[2*i+1],
+    a leaf is its own child, so every row of every tree is walked down max_depth steps at
+    once without checking for leaves
+    """
+
+    def __init__(self, roots : np.array, children : np.array, feature : np.array, threshold : np.array,
+                 value : np.array, classes : np.array, n_features_in : int, max_depth : int):
+        self.roots = roots
+        self.children = children
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value # (nodes, classes) leaf class probabilities
+        self.classes_ = classes
+        self.n_features_in_ = n_features_in
+        self.max_depth = max_depth
+        self.fallback = None # sklearn model used for batches above COMPILED_MAX_BATCH rows
+
+    @classmethod
+    def from_sklearn(cls, model : object) -> "ForestArrays":
+        """
+        Compiles a fitted single output sklearn forest (or a single decision tree) into node arrays
+        """
+        estimators = getattr(model, "estimators_", [model])
+        if getattr(model, "n_outputs_", 1) != 1 or not all(hasattr(e, "tree_") for e in estimators):
+            raise ValueError("only single output tree ensembles can be compiled")
+        roots, children, feature, threshold, value = [], [], [], [], []
+        offset = 0
+        for estimator in estimators:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count) + offset
+            is_leaf = tree.children_left < 0
+            roots.append(offset)
+            left = np.where(is_leaf, nodes, tree.children_left + offset)
+            right = np.where(is_leaf, nodes, tree.children_right + offset)
+            children.append(np.column_stack([left, right]).ravel())
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, 0.0, tree.threshold))
+            counts = tree.value[:, 0, :]
+            normalizer = counts.sum(axis=1, keepdims=True)
+            normalizer[normalizer == 0.0] = 1.0
+            value.append(counts / normalizer)
+            offset += tree.node_count
+        return cls(
+            roots=np.array(roots, dtype=np.intp),
+            children=np.concatenate(children).astype(np.intp),
+            feature=np.concatenate(feature).astype(np.intp),
+            threshold=np.concatenate(threshold).astype(np.float64),
+            value=np.concatenate(value).astype(np.float64),
+            classes=np.asarray(model.classes_),
+            n_features_in=int(model.n_features_in_),
+            max_depth=max(int(e.tree_.max_depth) for e in estimators),
+        )
+
+    def apply(self, X : np.array) -> np.array:
+        """
+        Returns the leaf reached by every row in every tree, shape (rows, trees)
+        """
+        rows = np.arange(len(X))[:, None]
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            go_right = X[rows, self.feature[node]] > self.threshold[node]
+            node = self.children[2 * node + go_right]
+        return node
+
+    def predict_proba(self, X : np.array) -> np.array:
+        # sklearn trees compare float32 features against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has shape {X.shape}, expected (n, {self.n_features_in_})")
+        # rejected like sklearn does, the node arrays would walk NaN and inf to arbitrary leaves
+        if np.isnan(X).any():
+            raise ValueError("Input X contains NaN.")
+        if not np.isfinite(X).all():
+            raise ValueError("Input X contains infinity or a value too large for dtype('float32').")
+        # summed tree by tree in estimator order, as sklearn does
+        return self.value[self.apply(X)].sum(axis=1) / len(self.roots)
+
+    def predict(self, X : np.array) -> np.array:
+        if self.fallback is not None and len(X) > COMPILED_MAX_BATCH:
+            return self.fallback.predict(X)
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    def arrays(self) -> dict:
+        return {name : getattr(self, "classes_" if name == "classes" else name) for name in FOREST_ARRAYS}
+
+
+def is_forest_dir(model_file : str) -> bool:
+    return os.path.isdir(model_file) and os.path.exists(os.path.join(model_file, "meta.json"))
+
+
+def save_forest_arrays(forest : ForestArrays, directory : str) -> str:
+    """
+    Writes the node arrays as .npy files plus meta.json into directory. The directory is
+    written under a temporary name and renamed, so readers never see a partial model
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        for name, array in forest.arrays().items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array), allow_pickle=False)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"format" : "forest", "version" : FOREST_FORMAT_VERSION,
+                       "n_features_in" : forest.n_features_in_, "max_depth" : forest.max_depth}, f)
+        os.rename(tmp_dir, directory)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return directory
+
+
+def load_forest_arrays(directory : str, mmap_mode : str = 'r') -> ForestArrays:
+    """
+    Opens a model directory, the node arrays are memory-mapped read-only
+    """
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {name : np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+              for name in FOREST_ARRAYS}
+    return ForestArrays(n_features_in=meta["n_features_in"], max_depth=meta["max_depth"], **arrays)
+
+
+def load_model_file(model_file : str, backend : str = INFERENCE_BACKEND) -> object:
+    """
+    Loads a model from a memory-mappable model directory or a pickle file.
+    With the 'compiled' backend, pickled tree ensembles are compiled into ForestArrays
+    """
+    if is_forest_dir(model_file):
+        return load_forest_arrays(model_file)
+    with open(model_file, 'rb') as f:
+        model = pickle.load(f)
+    if backend == 'compiled':
+        try:
+            forest = ForestArrays.from_sklearn(model)
+        except (ValueError, AttributeError): # not a tree ensemble, keeps its own predict
+            return model
+        forest.fallback = model
+        return forest
+    return model
+
+
+def convert_model_file(model_file : str, remove : bool = True) -> str:
+    """
+    Converts a pickled tree ensemble into a model directory next to it, and removes the pickle.
+    Returns the path to store for the model, the pickle itself if it is not a tree ensemble
+    """
+    with open(model_file, 'rb') as f:
+        model = pickle.load(f)
+    try:
+        forest = ForestArrays.from_sklearn(model)
+    except (ValueError, AttributeError):
+        return model_file
+    directory = save_forest_arrays(forest, os.path.splitext(model_file)[0] + FOREST_SUFFIX)
+    if remove:
+        os.remove(model_file)
+    return directory
+
+
+def validate_model_file(model_file : str, n_features : int = 5) -> None:
+    """
+    Loads a model file and runs a dummy (1, n_features) vector through its predict,
+    raises ValueError if the file is not a usable model
+    """
+    try:
+        model = load_model_file(model_file, backend='sklearn')
+    except Exception as e:
+        raise ValueError(f"model file could not be loaded: {e}")
+    if not hasattr(model, "predict"):
+        raise ValueError("model has no predict method")
+    if getattr(model, "n_features_in_", n_features) != n_features:
+        raise ValueError(f"model expects {model.n_features_in_} features, leads have {n_features}")
+    try:
+        model.predict(np.zeros((1, n_features)))
+    except Exception as e:
+        raise ValueError(f"model could not predict: {e}")
+
+
+def store_model_file(temp_file : str, digest : str, extension : str, directory : str = "models",
+                     storage : str = MODEL_STORAGE) -> str:
+    """
+    Validates an uploaded model file and moves it to its content address <directory>/<digest>.<extension>,
+    converted into a model directory with 'mmap' storage. An already stored identical file is reused.
+    Returns the path to store for the model
+    """
+    final_file = os.path.join(directory, f"{digest}.{extension}")
+    forest_dir = os.path.join(directory, digest + FOREST_SUFFIX)
+    if storage == 'mmap' and is_forest_dir(forest_dir):
+        os.remove(temp_file)
+        return forest_dir
+    if os.path.exists(final_file):
+        os.remove(temp_file)
+        return final_file
+
+    try:
+        validate_model_file(temp_file)
+    except ValueError:
+        os.remove(temp_file)
+        raise
+    os.replace(temp_file, final_file) # atomic, readers never see a partial file
+    if storage == 'mmap':
+        try:
+            return convert_model_file(final_file)
+        except OSError:
+            # converted concurrently by an identical upload
+            if is_forest_dir(forest_dir):
+                return forest_dir
+            raise
+    return final_file
+
+
+def remove_model_file(model_file : str) -> None:
+    """
+    Removes a stored model, a pickle file or a model directory
+    """
+    if os.path.isdir(model_file):
+        shutil.rmtree(model_file)
+    else:
+        os.remove(model_file)
+
+
+def lock_model_files(session) -> None:
+    """
+    Blocks writes to the MLModel table by other transactions until the session's transaction ends,
+    so that storing a model file and adding its row does not interleave with removing a row and
+    its no longer used file. Only Postgres is locked, which the API processes share
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy import text
+        from app.models.models import MLModel
+        session.execute(text(f'LOCK TABLE "{MLModel.__tablename__}" IN SHARE ROW EXCLUSIVE MODE'))
+
+
+def _array_bytes(array : np.array) -> tuple:
+    # (private bytes, mapped bytes) of an array, views of a memmap count as mapped
+    base = array
+    while base is not None:
+        if isinstance(base, np.memmap):
+            return 0, array.nbytes
+        base = getattr(base, "base", None)
+    return array.nbytes, 0
+
+
+def _tree_arrays(model : object) -> list:
+    # node and value arrays of the trees of a sklearn tree ensemble (or a single decision tree)
+    arrays = []
+    for estimator in getattr(model, "estimators_", [model]):
+        tree = getattr(estimator, "tree_", None)
+        if tree is not None:
+            state = tree.__getstate__()
+            arrays.extend([state["nodes"], state["values"]])
+    return arrays
+
+
+def model_memory(model : object) -> dict:
+    """
+    Estimates the bytes of the model's arrays held privately by this process and
+    the bytes mapped from shared model files. A compiled model counts its sklearn fallback too
+    """
+    private, mapped = 0, 0
+    if isinstance(model, ForestArrays):
+        arrays = list(model.arrays().values())
+        if model.fallback is not None:
+            arrays.extend(_tree_arrays(model.fallback))
+    else:
+        arrays = _tree_arrays(model)
+    for array in arrays:
+        array_private, array_mapped = _array_bytes(array)
+        private += array_private
+        mapped += array_mapped
+    return {"private_bytes" : private, "mapped_bytes" : mapped}
+
+
+def process_rss_bytes() -> int:
+    """
+    Resident memory of this process in bytes, 0 where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def convert_stored_models() -> None:
+    """
+    Converts every uploaded pickled tree ensemble into a model directory and repoints its MLModel row
+    """
+    from sqlmodel import select, Session
+    from app.database.connection import engine_url
+    from app.models.models import MLModel
+
+    with Session(engine_url) as session:
+        for ml_model in session.exec(select(MLModel)).all():
+            if is_forest_dir(ml_model.model_file):
+                continue
+            pickle_file = ml_model.model_file
+            ml_model.model_file = convert_model_file(pickle_file, remove=False)
+            session.add(ml_model)
+            session.commit()
+            if ml_model.model_file != pickle_file:
+                os.remove(pickle_file)
+            print(ml_model.model_name, ":", pickle_file, "->", ml_model.model_file)
+
+
+if __name__ == '__main__':
+    # converts the already uploaded models: python -m app.predict.artifacts
+    convert_stored_models()
@@ -0,0 +1,110 @@
+# Dynamic micro-batching of concurrent single lead predictions: a request is predicted right away
+# when no prediction of its model is running, vectors of the requests that arrive meanwhile are
+# stacked and predicted with one predict call once it finishes
+import asyncio
+from collections import Counter
+import numpy as np
+from decouple import config
+
+from app.predict.predict import Predict
+from app.predict.executor import inference_executor, InferenceExecutor
+
+# longest wait of a queued request for the running prediction of its model (0 -> until it finishes),
+# and the batch size that is predicted right away without waiting any longer
+BATCH_MAX_WAIT_MS = config('BATCH_MAX_WAIT_MS', default=0.0, cast=float)
+BATCH_MAX_SIZE = config('BATCH_MAX_SIZE', default=32, cast=int)
+
+
+class MicroBatcher:
+    """
+    Predicts a (1,5) vector right away when no prediction of its model is running. Otherwise
+    collects the vectors per model until the running prediction finishes, max_size vectors are
+    queued or (if set) max_wait_ms milliseconds passed, predicts the stacked matrix in the inference
+    executor and hands every awaiting request its label. Must be used from the event loop thread.
+    """
+
+    def __init__(self, executor : InferenceExecutor = inference_executor,
+                 max_wait_ms : float = BATCH_MAX_WAIT_MS, max_size : int = BATCH_MAX_SIZE):
+        self.executor = executor
+        self.max_wait_ms = max_wait_ms
+        self.max_size = max_size
+        self._pending = {} # key -> list of (vector, future)
+        self._timers = {}
+        self._tasks = set() # running predictions, referenced until done
+        self._running = Counter() # key -> number of running predictions
+        self.batch_sizes = Counter() # batch size -> number of batches
+
+    async def predict(self, key, model : object, vector : np.array) -> str:
+        """
+        Returns the label of vector, predicted together with the other vectors queued under key.
+        key identifies the model, e.g. its name and the loaded model object. Raises ValueError for
+        a vector with NaN, infinite or beyond float32 values, which would fail the predict call of
+        the whole batch
+        """
+        with np.errstate(over='ignore'): # the models predict in float32
+            if not np.isfinite(np.asarray(vector, dtype=np.float32)).all():
+                raise ValueError("Input X contains NaN, infinity or a value too large for dtype('float32').")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entries = self._pending.setdefault(key, [])
+        entries.append((vector, future))
+        if len(entries) >= self.max_size or not self._running[key]:
+            self._flush(key, model)
+        elif len(entries) == 1 and self.max_wait_ms > 0:
+            self._timers[key] = loop.call_later(self.max_wait_ms / 1000, self._flush, key, model)
+        return await future
+
+    def _flush(self, key, model : object) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        entries = self._pending.pop(key, [])
+        if not entries:
+            return
+        self.batch_sizes[len(entries)] += 1
+        self._running[key] += 1
+        task = asyncio.ensure_future(self._run(key, model, entries))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _finished(self, key, model : object) -> None:
+        # predicts the vectors queued while the prediction ran
+        self._running[key] -= 1
+        if not self._running[key]:
+            del self._running[key]
+            self._flush(key, model)
+
+    async def _run(self, key, model : object, entries : list) -> None:
+        try:
+            await self._predict(model, entries)
+        finally:
+            self._finished(key, model)
+
+    async def _predict(self, model : object, entries : list) -> None:
+        try:
+            matrix = np.vstack([vector for vector, _ in entries])
+            labels = await self.executor.run(Predict().predict_leads, matrix, model)
+        except Exception as e:
+            for _, future in entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), label in zip(entries, labels):
+            if not future.done():
+                future.set_result(label)
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        leads = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "max_wait_ms" : self.max_wait_ms,
+            "max_size" : self.max_size,
+            "batches" : batches,
+            "leads" : leads,
+            "mean_batch_size" : leads / batches if batches else 0.0,
+            "batch_sizes" : dict(sorted(self.batch_sizes.items())),
+        }
+
+
+# batcher shared by all label_fetch requests of this process
+micro_batcher = MicroBatcher()
@@ -0,0 +1,109 @@
+# Runs CPU bound and blocking inference work (model loading, predict, warehouse commit)
+# in a bounded thread pool, so it does not stall the event loop serving other requests
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from decouple import config
+
+from app.profiling.profiling import active_profile
+
+# number of inference threads, and how many requests may wait for a free thread
+# before new requests are rejected
+INFERENCE_WORKERS = config('INFERENCE_WORKERS', default=4, cast=int)
+INFERENCE_QUEUE_SIZE = config('INFERENCE_QUEUE_SIZE', default=64, cast=int)
+# worker processes for CPU heavy one-off work, e.g. validating an uploaded model
+PROCESS_WORKERS = config('PROCESS_WORKERS', default=1, cast=int)
+
+
+class InferenceSaturated(Exception):
+    """
+    Raised when all inference threads are busy and the wait queue is full
+    """
+
+
+class InferenceExecutor:
+    """
+    Bounded thread pool for inference. Admission is counted on the event loop:
+    at most max_workers calls run and max_queue calls wait, further calls are rejected
+    with InferenceSaturated so the caller can answer 503 instead of piling up requests.
+    """
+
+    def __init__(self, max_workers : int = INFERENCE_WORKERS, max_queue : int = INFERENCE_QUEUE_SIZE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = None
+        self.pending = 0 # running + waiting calls
+        self.completed = 0
+        self.rejected = 0
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        # created lazily, so the pool can be shut down and re-created with the application
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        return self._pool
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) in the pool and returns its result
+        """
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise InferenceSaturated("inference pool is saturated")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            call = functools.partial(fn, *args, **kwargs)
+            # calls of a profiled request are profiled in the worker thread
+            profile = active_profile()
+            if profile is not None:
+                call = functools.partial(profile.run, call)
+            return await loop.run_in_executor(self._get_pool(), call)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def shutdown(self, wait : bool = True) -> None:
+        """
+        Waits for running calls and releases the threads
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            "max_workers" : self.max_workers,
+            "max_queue" : self.max_queue,
+            "running" : min(self.pending, self.max_workers),
+            "queued" : max(self.pending - self.max_workers, 0),
+            "completed" : self.completed,
+            "rejected" : self.rejected,
+        }
+
+
+# executor shared by all inference routes of this process
+inference_executor = InferenceExecutor()
+
+
+_process_pool = None
+
+
+async def run_in_process(fn, *args):
+    """
+    Runs fn(*args) in a worker process, so unpickling and CPU heavy work neither
+    blocks the event loop nor holds this process's GIL. fn and args must be picklable
+    """
+    global _process_pool
+    if _process_pool is None:
+        # spawned, a fork of this multi-threaded process could inherit a lock held by another thread
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_process_pool, fn, *args)
+
+
+def shutdown_process_pool() -> None:
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True)
+        _process_pool = None
@@ -1,7 +1,94 @@
 import pickle
+from typing import List
 import numpy as np
+import pandas as pd
 # from extraction import single_info_dict
 
+# Integer codes of the categorical fields, as used when the models were trained
+CATEGORY_CODES = {'Accounting': 0, 'Automation Testing': 1, 'Back-End Development': 2, 'Bookkeeping': 3, 'Business Analysis &amp; Strategy': 4, 'Business Applications Development': 5, 'CMS Development': 6, 'Coding Tutoring': 7, 'Community Management': 8, 'Data Engineering': 9, 'Data Entry': 10, 'Data Extraction': 11, 'Data Visualization': 12, 'Database Administration': 13, 'Database Development': 14, 'Desktop Software Development': 15, 'DevOps Engineering': 16, 'Development &amp; IT Project Management': 17, 'Digital Project Management': 18, 'Ecommerce Website Development': 19, 'Email, Phone &amp; Chat Support': 20, 'Executive Virtual Assistance': 21, 'Financial Analysis &amp; Modeling': 22, 'Financial Management/CFO': 23, 'Front-End Development': 24, 'Full Stack Development': 25, 'General Virtual Assistance': 26, 'Graphic Design': 27, 'HR Administration': 28, 'Instructional Design': 29, 'Logistics &amp; Supply Chain Management': 30, 'Manual Testing': 31, 'Mobile App Development': 32, 'Network Administration': 33, 'Other Digital Marketing': 34, 'Packaging Design': 35, 'Recruiting &amp; Talent Sourcing': 36, 'SEO': 37, 'Sales &amp; Business Development': 38, 'Scripting &amp; Automation': 39, 'Search Engine Marketing': 40, 'Solution Architecture': 41, 'Sourcing &amp; Procurement': 42, 'Systems Administration': 43, 'Systems Engineering': 44, 'Tech Support': 45, 'Training &amp; Development': 46, 'Web Design': 47}
+COUNTRY_CODES = {'Albania': 0, 'Algeria': 1, 'Andorra': 2, 'Australia': 3, 'Austria': 4, 'Bahrain': 5, 'Bangladesh': 6, 'Belgium': 7, 'Belize': 8, 'Bulgaria': 9, 'Burkina Faso': 10, 'Canada': 11, 'Chile': 12, 'China': 13, 'Colombia': 14, "Cote d'Ivoire": 15, 'Croatia': 16, 'Curacao': 17, 'Dominican Republic': 18, 'Egypt': 19, 'Estonia': 20, 'France': 21, 'French Polynesia': 22, 'Germany': 23, 'Ghana': 24, 'Guatemala': 25, 'Hong Kong': 26, 'India': 27, 'Indonesia': 28, 'Ireland': 29, 'Israel': 30, 'Italy': 31, 'Jordan': 32, 'Kenya': 33, 'Kuwait': 34, 'Latvia': 35, 'Lebanon': 36, 'Lithuania': 37, 'Luxembourg': 38, 'Madagascar': 39, 'Malaysia': 40, 'Malta': 41, 'Mauritius': 42, 'Mexico': 43, 'Morocco': 44, 'Myanmar': 45, 'Nepal': 46, 'Netherlands': 47, 'New Zealand': 48, 'Nigeria': 49, 'Norway': 50, 'Oman': 51, 'Pakistan': 52, 'Palestinian Territories': 53, 'Panama': 54, 'Peru': 55, 'Philippines': 56, 'Poland': 57, 'Portugal': 58, 'Puerto Rico': 59, 'Qatar': 60, 'Romania': 61, 'Rwanda': 62, 'Saudi Arabia': 63, 'Sierra Leone': 64, 'Singapore': 65, 'Somalia': 66, 'South Africa': 67, 'South Korea': 68, 'Spain': 69, 'Sri Lanka': 70, 'Suriname': 71, 'Sweden': 72, 'Switzerland': 73, 'Taiwan': 74, 'Tanzania': 75, 'Thailand': 76, 'Trinidad and Tobago': 77, 'Tunisia': 78, 'Turkey': 79, 'Uganda': 80, 'Ukraine': 81, 'United Arab Emirates': 82, 'United Kingdom': 83, 'United States': 84, 'United States Virgin Islands': 85, 'Vietnam': 86, 'Yemen': 87}
+
+# if empty, category and country are filled with the most common one found in the data
+DEFAULT_CATEGORY_CODE = 25 # full stack development
+DEFAULT_COUNTRY_CODE = 84 # united states
+# code for a category or country not seen in the training data
+UNKNOWN_CODE = -1
+# class codes of the labels the models predict
+LABEL_CODES = {'Applied' : 0, 'Rejected' : 1}
+# labels of the predicted class codes
+LABEL_NAMES = {code : label for label, code in LABEL_CODES.items()}
+
+
+class LeadEncoder:
+    """
+    Integer encodes leads with lookup tables built once at import time.
+    Encodes a single lead dict, or a whole list of leads into a 2D np array with one row per lead
+    """
+
+    def __init__(self, category_codes : dict = CATEGORY_CODES, country_codes : dict = COUNTRY_CODES):
+        self.category_codes = category_codes
+        self.country_codes = country_codes
+
+    def _numeric(self, value) -> float:
+        # empty string -> 0.0
+        return 0.0 if value == '' else float(value)
+
+    def encode(self, data : dict) -> dict:
+        """
+        Takes a dictionary and returns a copy with its categorical values integer encoded
+        and its empty numeric values set to 0.0
+        """
+        encoded = dict(data)
+        category = data['category']
+        country = data['country']
+        encoded['category'] = DEFAULT_CATEGORY_CODE if category == '' else self.category_codes.get(category, UNKNOWN_CODE)
+        encoded['country'] = DEFAULT_COUNTRY_CODE if country == '' else self.country_codes.get(country, UNKNOWN_CODE)
+        encoded['budget'] = self._numeric(data['budget'])
+        encoded['hourly_from'] = self._numeric(data['hourly_from'])
+        encoded['hourly_to'] = self._numeric(data['hourly_to'])
+        return encoded
+
+    def encode_codes(self, values : list, codes : dict, default_code : int) -> np.array:
+        """
+        Integer encodes a column of categorical values. Each distinct value is looked up once
+        """
+        if len(values) == 0:
+            return np.empty(0, dtype=float)
+        uniques, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        unique_codes = np.array([default_code if value == '' else codes.get(value, UNKNOWN_CODE) for value in uniques],
+                                dtype=float)
+        return unique_codes[inverse]
+
+    def encode_numeric(self, values : list) -> np.array:
+        """
+        Converts a column of numeric values to floats, empty strings become 0.0 and
+        values that are not numbers become NaN. So do infinite values and values beyond
+        the float32 range, which the models cannot predict
+        """
+        column = pd.Series(values, dtype=object).replace('', 0.0)
+        numbers = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float)
+        with np.errstate(over='ignore'):
+            numbers[~np.isfinite(numbers.astype(np.float32))] = np.nan
+        return numbers
+
+    def encode_matrix(self, data : List[dict]) -> np.array:
+        """
+        Takes a list of lead dictionaries and returns a 2D np array of shape (n,5).
+        Vector item sequence [budget, hourly_from, hourly_to, encoded_country, encoded_category].
+        Rows of leads with a non numeric or out of range budget or hourly value contain NaN
+        """
+        matrix = np.empty((len(data), 5), dtype=float)
+        matrix[:, 0] = self.encode_numeric([d['budget'] for d in data])
+        matrix[:, 1] = self.encode_numeric([d['hourly_from'] for d in data])
+        matrix[:, 2] = self.encode_numeric([d['hourly_to'] for d in data])
+        matrix[:, 3] = self.encode_codes([d['country'] for d in data], self.country_codes, DEFAULT_COUNTRY_CODE)
+        matrix[:, 4] = self.encode_codes([d['category'] for d in data], self.category_codes, DEFAULT_CATEGORY_CODE)
+        return matrix
+
+
+# encoder shared by all predictions
+lead_encoder = LeadEncoder()
+
 
 class Predict:
     """
@@ -10,45 +97,19 @@ class Predict:
 
     def encode_lead(self, data: dict) -> dict :
         """
-        Takes a dictionary, integer encodes its categorical values, and returns it
+        Takes a dictionary, integer encodes its categorical values, and returns it as a new dictionary.
+        Unseen categories and countries are encoded as UNKNOWN_CODE
         """
         # Encoding fields: category and country. 
         # hourly_ to and from and budget are in numeric form
-        category_codes = {'Accounting': 0, 'Automation Testing': 1, 'Back-End Development': 2, 'Bookkeeping': 3, 'Business Analysis &amp; Strategy': 4, 'Business Applications Development': 5, 'CMS Development': 6, 'Coding Tutoring': 7, 'Community Management': 8, 'Data Engineering': 9, 'Data Entry': 10, 'Data Extraction': 11, 'Data Visualization': 12, 'Database Administration': 13, 'Database Development': 14, 'Desktop Software Development': 15, 'DevOps Engineering': 16, 'Development &amp; IT Project Management': 17, 'Digital Project Management': 18, 'Ecommerce Website Development': 19, 'Email, Phone &amp; Chat Support': 20, 'Executive Virtual Assistance': 21, 'Financial Analysis &amp; Modeling': 22, 'Financial Management/CFO': 23, 'Front-End Development': 24, 'Full Stack Development': 25, 'General Virtual Assistance': 26, 'Graphic Design': 27, 'HR Administration': 28, 'Instructional Design': 29, 'Logistics &amp; Supply Chain Management': 30, 'Manual Testing': 31, 'Mobile App Development': 32, 'Network Administration': 33, 'Other Digital Marketing': 34, 'Packaging Design': 35, 'Recruiting &amp; Talent Sourcing': 36, 'SEO': 37, 'Sales &amp; Business Development': 38, 'Scripting &amp; Automation': 39, 'Search Engine Marketing': 40, 'Solution Architecture': 41, 'Sourcing &amp; Procurement': 42, 'Systems Administration': 43, 'Systems Engineering': 44, 'Tech Support': 45, 'Training &amp; Development': 46, 'Web Design': 47}
-        country_codes = {'Albania': 0, 'Algeria': 1, 'Andorra': 2, 'Australia': 3, 'Austria': 4, 'Bahrain': 5, 'Bangladesh': 6, 'Belgium': 7, 'Belize': 8, 'Bulgaria': 9, 'Burkina Faso': 10, 'Canada': 11, 'Chile': 12, 'China': 13, 'Colombia': 14, "Cote d'Ivoire": 15, 'Croatia': 16, 'Curacao': 17, 'Dominican Republic': 18, 'Egypt': 19, 'Estonia': 20, 'France': 21, 'French Polynesia': 22, 'Germany': 23, 'Ghana': 24, 'Guatemala': 25, 'Hong Kong': 26, 'India': 27, 'Indonesia': 28, 'Ireland': 29, 'Israel': 30, 'Italy': 31, 'Jordan': 32, 'Kenya': 33, 'Kuwait': 34, 'Latvia': 35, 'Lebanon': 36, 'Lithuania': 37, 'Luxembourg': 38, 'Madagascar': 39, 'Malaysia': 40, 'Malta': 41, 'Mauritius': 42, 'Mexico': 43, 'Morocco': 44, 'Myanmar': 45, 'Nepal': 46, 'Netherlands': 47, 'New Zealand': 48, 'Nigeria': 49, 'Norway': 50, 'Oman': 51, 'Pakistan': 52, 'Palestinian Territories': 53, 'Panama': 54, 'Peru': 55, 'Philippines': 56, 'Poland': 57, 'Portugal': 58, 'Puerto Rico': 59, 'Qatar': 60, 'Romania': 61, 'Rwanda': 62, 'Saudi Arabia': 63, 'Sierra Leone': 64, 'Singapore': 65, 'Somalia': 66, 'South Africa': 67, 'South Korea': 68, 'Spain': 69, 'Sri Lanka': 70, 'Suriname': 71, 'Sweden': 72, 'Switzerland': 73, 'Taiwan': 74, 'Tanzania': 75, 'Thailand': 76, 'Trinidad and Tobago': 77, 'Tunisia': 78, 'Turkey': 79, 'Uganda': 80, 'Ukraine': 81, 'United Arab Emirates': 82, 'United Kingdom': 83, 'United States': 84, 'United States Virgin Islands': 85, 'Vietnam': 86, 'Yemen': 87}
-
-        # if empty fill with the most common one found in the data 
-        # otherwise fill with encoding value
-        category = data['category']
-        country = data['country']
-        budget = data['budget']
-        hourly_from = data['hourly_from']
-        hourly_to = data['hourly_to']
+        return lead_encoder.encode(data)
 
-        if category == '':
-            data['category'] = 25 # full stack development
-        
-        if country == '':
-            data['country'] = 84 # united states
-        
-        if hourly_from == '':
-            data['hourly_from'] = 0.0
-        
-        if hourly_to == '':
-            data['hourly_to'] = 0.0
-        
-        if budget == '':
-            data['budget'] = 0.0
-        
-        if category != '':
-            code = category_codes[category]
-            data['category'] = code
-        
-        if country != '':
-            code = country_codes[country]
-            data['country'] = code
-
-        return data
+    def encode_leads(self, data : List[dict]) -> np.array:
+        """
+        Takes a list of dictionaries and encodes and vectorizes them at once into a 2D np array
+        of shape: (n,5). Rows of leads that could not be encoded contain NaN
+        """
+        return lead_encoder.encode_matrix(data)
 
     def vectorize_lead(self, data : dict) -> np.array:
         """
@@ -59,18 +120,22 @@ class Predict:
         vector = vector.reshape(1, -1) # model requires the vector to be 2D in shape
         
         return vector
-    
+
     def predict_lead(self, vector : np.array, ml_model : object) -> str:
         """
         Takes a vector of shape (1,5), 
         """
-        lead_codes = {'Applied': 0, 'Rejected': 1}
         prediction = ml_model.predict(vector) # list is returned
-        
+
         # inverting the prediction label to class name
-        label = ""
-        for key, val in lead_codes.items():
-            if val == prediction[0]:
-                label = key
-        
-        return label
+        return LABEL_NAMES.get(prediction[0], "")
+
+    def predict_leads(self, matrix : np.array, ml_model : object) -> List[str]:
+        """
+        Takes a matrix of shape (n,5), predicts all rows with a single predict call
+        and returns the class names in row order
+        """
+        if len(matrix) == 0:
+            return []
+        predictions = ml_model.predict(matrix)
+        return [LABEL_NAMES.get(prediction, "") for prediction in predictions]
@@ -0,0 +1,146 @@
+# In-process cache of unpickled ML models, so label_fetch does not read and unpickle
+# the model file from disk for every lead
+import os
+import threading
+from collections import OrderedDict
+from decouple import config
+
+from app.predict.artifacts import ForestArrays, load_model_file, model_memory, process_rss_bytes
+
+# maximum number of models held in memory, and optional upper bound on their summed
+# sizes on disk in bytes, the files of model directories and the node arrays of models
+# compiled in memory included (0 -> no byte bound)
+MODEL_CACHE_SIZE = config('MODEL_CACHE_SIZE', default=8, cast=int)
+MODEL_CACHE_MAX_BYTES = config('MODEL_CACHE_MAX_BYTES', default=0, cast=int)
+
+
+class ModelRegistry:
+    """
+    LRU cache of loaded ML models keyed by model name.
+    An entry is only served if the model file it was loaded from is unchanged
+    (same path, size and modification time), otherwise the model is reloaded.
+    """
+
+    def __init__(self, max_models : int = MODEL_CACHE_SIZE, max_bytes : int = MODEL_CACHE_MAX_BYTES):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # model_name -> (file identity, size in bytes, model)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _file_identity(self, model_file : str) -> tuple:
+        """
+        Returns a tuple identifying the current content of the model file on disk
+        """
+        st = os.stat(model_file)
+        return (model_file, st.st_size, st.st_mtime_ns)
+
+    def _model_bytes(self, model_file : str, model : object) -> int:
+        """
+        Returns the size of a model file, or the summed size of the array files of a model directory.
+        A pickled model compiled in memory holds its node arrays besides the unpickled sklearn fallback
+        """
+        if os.path.isdir(model_file):
+            with os.scandir(model_file) as entries:
+                return sum(entry.stat().st_size for entry in entries if entry.is_file())
+        size = os.stat(model_file).st_size
+        if isinstance(model, ForestArrays) and model.fallback is not None:
+            size += sum(array.nbytes for array in model.arrays().values())
+        return size
+
+    def load(self, model_file : str) -> object:
+        """
+        Reads and unpickles a model file from disk, or memory-maps a model directory
+        """
+        return load_model_file(model_file)
+
+    def get(self, model_name : str, model_file : str) -> object:
+        """
+        Returns the loaded model for model_name, loading it from model_file on a miss
+        """
+        identity = self._file_identity(model_file)
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry is not None and entry[0] == identity:
+                self._entries.move_to_end(model_name) # most recently used
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        # unpickling happens outside the lock so other models can still be served
+        model = self.load(model_file)
+        size = self._model_bytes(model_file, model)
+        with self._lock:
+            self._entries[model_name] = (identity, size, model)
+            self._entries.move_to_end(model_name)
+            self._evict()
+        return model
+
+    def put(self, model_name : str, model_file : str, model : object) -> None:
+        """
+        Adds an already loaded model to the cache
+        """
+        identity = self._file_identity(model_file)
+        size = self._model_bytes(model_file, model)
+        with self._lock:
+            self._entries[model_name] = (identity, size, model)
+            self._entries.move_to_end(model_name)
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        Drops least recently used models until the count and byte bounds hold.
+        The most recently used model is always kept. Caller must hold the lock.
+        """
+        while len(self._entries) > 1:
+            over_count = len(self._entries) > self.max_models
+            over_bytes = self.max_bytes > 0 and self.cached_bytes() > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def cached_bytes(self) -> int:
+        """
+        Returns the summed size of the cached models, see _model_bytes
+        """
+        return sum(entry[1] for entry in self._entries.values())
+
+    def invalidate(self, model_name : str) -> None:
+        """
+        Removes model_name from the cache, e.g. after it has been uploaded or deleted
+        """
+        with self._lock:
+            if self._entries.pop(model_name, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters
+        """
+        with self._lock:
+            return {
+                "models" : list(self._entries.keys()),
+                "size" : len(self._entries),
+                "max_models" : self.max_models,
+                "cached_bytes" : self.cached_bytes(),
+                "max_bytes" : self.max_bytes,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "invalidations" : self.invalidations,
+                # array memory per model: private to this process or mapped from shared model files
+                "model_memory" : {name : model_memory(entry[2]) for name, entry in self._entries.items()},
+                "process_rss_bytes" : process_rss_bytes(),
+            }
+
+
+# registry shared by all requests served by this process
+model_registry = ModelRegistry()
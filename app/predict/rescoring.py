@@ -0,0 +1,190 @@
+# Re-scoring of the stored records with another model version, e.g. after deploying a better model.
+# The records of an id range are read in batches, each with one query over a server-side cursor,
+# encoded as whole matrices and predicted in a pool of worker processes while the next batches are
+# read. Changed labels are written back with one executemany update per batch, in the transaction
+# that also moves the lead statistics and advances the job's checkpoint, so an interrupted job
+# resumes after the last written batch. Pauses and a rate limit leave room for the live traffic
+#
+#   python -m app.predict.rescoring --model production [--from-id 0] [--to-id N] [--batch-size 5000]
+#       [--workers 2] [--pause-ms 50] [--max-rate 2000]
+#   python -m app.predict.rescoring --resume JOB_ID
+import argparse
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Optional
+from decouple import config
+from sqlalchemy import bindparam, func, update
+from sqlmodel import Session, select
+
+from app.models.models import Record, RecordFilter, RescoringJob
+from app.database.records import iter_row_chunks
+from app.database.stats import add_stats, stat_key
+from app.predict.aliases import resolve_model, get_model
+from app.predict.artifacts import load_model_file
+from app.predict.predict import Predict
+from app.predict.training import FEATURE_COLUMNS, encode_records
+
+# records per batch, prediction worker processes and the niceness added to them
+RESCORE_BATCH_SIZE = config('RESCORE_BATCH_SIZE', default=5000, cast=int)
+RESCORE_WORKERS = config('RESCORE_WORKERS', default=2, cast=int)
+RESCORE_NICE = config('RESCORE_NICE', default=10, cast=int)
+# pause after every batch, and the most records scored per second (0 -> unlimited)
+RESCORE_PAUSE_MS = config('RESCORE_PAUSE_MS', default=0, cast=int)
+RESCORE_MAX_RATE = config('RESCORE_MAX_RATE', default=0, cast=float)
+
+# Record columns read per record: the key, the current label and statistics key, and the lead vector
+RESCORE_COLUMNS = ["id", "label", "posted_at"] + FEATURE_COLUMNS
+
+# model of a worker process, loaded once by its initializer
+_worker_model = None
+
+
+def _init_worker(model_file : str, nice : int) -> None:
+    global _worker_model
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+    _worker_model = load_model_file(model_file)
+
+
+def _predict(matrix) -> list:
+    return Predict().predict_leads(matrix=matrix, ml_model=_worker_model)
+
+
+def create_job(session : Session, model_name : str, from_id : int = 0, to_id : Optional[int] = None) -> RescoringJob:
+    """
+    Adds a job re-scoring the records with ids in (from_id, to_id] with a model version or the version
+    an alias points at now. Without to_id, up to the newest record: records added later are scored
+    by the live traffic
+    """
+    ml_model, _ = resolve_model(session, model_name)
+    if to_id is None:
+        to_id = session.exec(select(func.max(Record.id))).one() or 0
+    job = RescoringJob(model_name=ml_model.model_name, from_id=from_id, to_id=to_id, last_id=from_id)
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def read_batch(session : Session, after_id : int, to_id : int, batch_size : int) -> list:
+    """
+    Returns up to batch_size records with ids in (after_id, to_id] as dicts of RESCORE_COLUMNS
+    """
+    # read to the end within the call, so the cursor is closed before the batch is written
+    return [dict(zip(RESCORE_COLUMNS, row))
+            for chunk in iter_row_chunks(session, RecordFilter(), RESCORE_COLUMNS, after_id=after_id,
+                                         limit=batch_size, chunk_size=batch_size, to_id=to_id)
+            for row in chunk]
+
+
+def write_batch(session : Session, job : RescoringJob, records : list, valid, labels : list) -> None:
+    """
+    Updates the changed labels of a scored batch, moves their records in the lead statistics
+    and advances the checkpoint of the job, in one transaction
+    """
+    scored = [record for record, is_valid in zip(records, valid) if is_valid]
+    changes = []
+    counts = Counter()
+    for record, label in zip(scored, labels):
+        if label == record["label"]:
+            continue
+        changes.append({"record_id" : record["id"], "new_label" : label})
+        counts[stat_key(record["posted_at"], record["label"], record["category"], record["country"])] -= 1
+        counts[stat_key(record["posted_at"], label, record["category"], record["country"])] += 1
+    if changes:
+        table = Record.__table__
+        session.execute(update(table).where(table.c.id == bindparam("record_id")).values(label=bindparam("new_label")),
+                        changes)
+        add_stats(session, counts)
+    job.last_id = records[-1]["id"]
+    job.records += len(scored)
+    job.changed += len(changes)
+    session.add(job)
+    session.commit()
+
+
+def rescore_records(engine, job_id : int, batch_size : int = RESCORE_BATCH_SIZE, workers : int = RESCORE_WORKERS,
+                    pause_ms : int = RESCORE_PAUSE_MS, max_rate : float = RESCORE_MAX_RATE, nice : int = RESCORE_NICE,
+                    progress=None) -> RescoringJob:
+    """
+    Runs a re-scoring job from its checkpoint to the end of its id range, returns the finished job.
+    Up to workers batches are predicted while the next ones are read. progress is called with the
+    job after every written batch
+    """
+    with Session(engine) as session:
+        job = session.get(RescoringJob, job_id)
+        ml_model = get_model(session, job.model_name)
+        job.status, job.error, job.finished_at = "running", None, None
+        session.add(job)
+        session.commit()
+        start, scored = time.monotonic(), 0
+        try:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                     initargs=(ml_model.model_file, nice)) as pool:
+                in_flight = deque()
+                read_id, exhausted = job.last_id, False
+                while True:
+                    while len(in_flight) < workers and not exhausted:
+                        records = read_batch(session, read_id, job.to_id, batch_size)
+                        if not records:
+                            exhausted = True
+                            break
+                        read_id = records[-1]["id"]
+                        matrix, valid = encode_records(records)
+                        in_flight.append((records, valid, pool.submit(_predict, matrix[valid])))
+                    if not in_flight:
+                        break
+                    records, valid, future = in_flight.popleft()
+                    write_batch(session, job, records, valid, future.result())
+                    if progress is not None:
+                        progress(job)
+                    # throttling, the records scored in this run are spread to max_rate per second
+                    scored += len(records)
+                    if pause_ms:
+                        time.sleep(pause_ms / 1000)
+                    if max_rate:
+                        ahead = scored / max_rate - (time.monotonic() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            job.status, job.finished_at = "succeeded", datetime.utcnow()
+        except BaseException as e: # also interruptions, the job resumes from its checkpoint
+            session.rollback()
+            job.status, job.error, job.finished_at = "failed", f"{type(e).__name__}: {e}", datetime.utcnow()
+            raise
+        finally:
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+    return job
+
+
+def main():
+    from app.database.connection import engine_url
+
+    parser = argparse.ArgumentParser(description="Re-scores the stored records with a model version")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--model", help="model name or alias to score with")
+    target.add_argument("--resume", type=int, metavar="JOB_ID", help="resume a job from its checkpoint")
+    parser.add_argument("--from-id", type=int, default=0, help="re-score the records after this id")
+    parser.add_argument("--to-id", type=int, help="re-score the records up to this id, default the newest")
+    parser.add_argument("--batch-size", type=int, default=RESCORE_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=RESCORE_WORKERS)
+    parser.add_argument("--pause-ms", type=int, default=RESCORE_PAUSE_MS)
+    parser.add_argument("--max-rate", type=float, default=RESCORE_MAX_RATE, help="records per second, 0 unlimited")
+    args = parser.parse_args()
+
+    with Session(engine_url) as session:
+        job_id = args.resume if args.resume else create_job(session, args.model, args.from_id, args.to_id).id
+    print(f"rescoring job {job_id}")
+    job = rescore_records(engine_url, job_id, args.batch_size, args.workers, args.pause_ms, args.max_rate,
+                          progress=lambda job: print(f"checkpoint {job.last_id}/{job.to_id}: {job.records} scored, {job.changed} changed"))
+    print(f"rescoring job {job.id} {job.status}: {job.records} scored, {job.changed} changed")
+
+
+if __name__ == "__main__":
+    main()
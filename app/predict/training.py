@@ -0,0 +1,279 @@
+# Training of new model versions from the labeled warehouse records. A training job runs in its own
+# spawned process at a lower scheduling priority, so it neither holds the GIL of the API process nor
+# takes CPU time the API needs: it reads the records in keyset (id based) chunks over its own database
+# connection, encodes them with the lead encoder used for predictions, trains a random forest on all
+# cores, evaluates it on held out records and registers it as a new MLModel version. Its progress and
+# result are written to the TrainingJob row, which the API reads
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+from datetime import datetime
+from typing import Optional
+import numpy as np
+from decouple import config
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, confusion_matrix, precision_recall_fscore_support
+from sklearn.model_selection import train_test_split
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, create_engine, select
+
+from app.models.models import MLModel, RecordFilter, TrainingJob, TrainingRequest
+from app.database.records import iter_row_chunks
+from app.predict.artifacts import store_model_file, remove_model_file, lock_model_files
+from app.predict.predict import lead_encoder, LABEL_CODES
+
+# cores used by the forest (-1 all), and the niceness added to the training process
+TRAINING_N_JOBS = config('TRAINING_N_JOBS', default=-1, cast=int)
+TRAINING_NICE = config('TRAINING_NICE', default=10, cast=int)
+# records read per query, fewest labeled records to train on, training jobs running at a time per API process
+TRAINING_CHUNK_SIZE = config('TRAINING_CHUNK_SIZE', default=10000, cast=int)
+TRAINING_MIN_RECORDS = config('TRAINING_MIN_RECORDS', default=20, cast=int)
+TRAINING_MAX_RUNNING = config('TRAINING_MAX_RUNNING', default=1, cast=int)
+
+# Record columns in the order of the lead vector, see LeadEncoder.encode_matrix
+FEATURE_COLUMNS = ["budget", "hourly_from", "hourly_to", "country", "category"]
+
+
+class TrainingBusy(Exception):
+    """
+    Raised when TRAINING_MAX_RUNNING training jobs are running already
+    """
+
+
+def _update(session : Session, job : TrainingJob, **fields) -> None:
+    # commits new values of the job row, so the API sees the progress right away
+    for field, value in fields.items():
+        setattr(job, field, value)
+    session.add(job)
+    session.commit()
+
+
+def fail_unfinished_jobs(session : Session, job_ids : list, error : str) -> None:
+    """
+    Marks the jobs that are still queued or running as failed, e.g. after their process exited
+    """
+    for job_id in job_ids:
+        job = session.get(TrainingJob, job_id)
+        if job is not None:
+            session.refresh(job) # the process may have recorded its result just before exiting
+            if job.status in ("queued", "running"):
+                _update(session, job, status="failed", error=error, finished_at=datetime.utcnow())
+
+
+def encode_records(records : list) -> tuple:
+    """
+    Encodes dicts of Record columns with the lead encoder, returns the (n,5) lead matrix and
+    the mask of the rows that could be encoded
+    """
+    matrix = lead_encoder.encode_matrix([
+        {column : '' if record[column] is None else record[column] for column in FEATURE_COLUMNS} for record in records])
+    return matrix, ~np.isnan(matrix).any(axis=1)
+
+
+def load_training_data(session : Session, request : TrainingRequest, progress=None,
+                       chunk_size : int = TRAINING_CHUNK_SIZE) -> tuple:
+    """
+    Reads and encodes the records labeled Applied or Rejected, chunk_size records per query,
+    returns the (n,5) lead matrix and the n class codes. Records that cannot be encoded are left out.
+    progress is called with the number of loaded records after every chunk
+    """
+    filters = RecordFilter(posted_from=request.posted_from, posted_to=request.posted_to)
+    columns = ["id", "label"] + FEATURE_COLUMNS
+    matrices, codes = [], []
+    loaded, after_id = 0, 0
+    while True:
+        # one short query per chunk instead of a cursor open for the whole job
+        rows = [row for chunk in iter_row_chunks(session, filters, columns, after_id=after_id, limit=chunk_size,
+                                                 chunk_size=chunk_size) for row in chunk]
+        if not rows:
+            break
+        after_id = rows[-1][0]
+        rows = [row for row in rows if row[1] in LABEL_CODES]
+        if rows:
+            matrix, valid = encode_records([dict(zip(columns, row)) for row in rows])
+            matrices.append(matrix[valid])
+            codes.append(np.array([LABEL_CODES[row[1]] for row in rows])[valid])
+            loaded += int(valid.sum())
+        if progress is not None:
+            progress(loaded)
+    if not matrices:
+        return np.empty((0, len(FEATURE_COLUMNS))), np.empty(0, dtype=int)
+    return np.concatenate(matrices), np.concatenate(codes)
+
+
+def split_data(X : np.array, y : np.array, request : TrainingRequest) -> tuple:
+    """
+    Splits the records into training and test records, stratified by label
+    """
+    return train_test_split(X, y, test_size=request.test_fraction, random_state=request.random_state, stratify=y)
+
+
+def train_model(X : np.array, y : np.array, request : TrainingRequest, n_jobs : int = TRAINING_N_JOBS) -> object:
+    model = RandomForestClassifier(n_estimators=request.n_estimators, max_depth=request.max_depth,
+                                   n_jobs=n_jobs, random_state=request.random_state)
+    model.fit(X, y)
+    model.n_jobs = 1 # predictions of single leads are slower on a thread pool
+    return model
+
+
+def evaluate_model(model : object, X : np.array, y : np.array) -> dict:
+    """
+    Returns the accuracy, the precision, recall and f1 score per label and the confusion matrix
+    (rows true, columns predicted labels) of the model on the test records
+    """
+    labels = list(LABEL_CODES)
+    codes = [LABEL_CODES[label] for label in labels]
+    predicted = model.predict(X)
+    precision, recall, f1, support = precision_recall_fscore_support(y, predicted, labels=codes, zero_division=0)
+    return {
+        "accuracy" : float(accuracy_score(y, predicted)),
+        "test_records" : int(len(y)),
+        "labels" : {label : {"precision" : float(precision[i]), "recall" : float(recall[i]), "f1" : float(f1[i]),
+                             "support" : int(support[i])} for i, label in enumerate(labels)},
+        "confusion_matrix" : {"labels" : labels, "matrix" : confusion_matrix(y, predicted, labels=codes).tolist()},
+    }
+
+
+def register_model(session : Session, model_name : str, model : object, metrics : dict, directory : str = "models") -> MLModel:
+    """
+    Pickles the model, stores it under its content hash like an uploaded model and adds its MLModel row,
+    holding the model files lock of model_upload and model_delete
+    """
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".train-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(model, f)
+        digest = hashlib.sha256()
+        with open(temp_path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        # a concurrent model_delete cannot remove an identical stored file before the row is added
+        lock_model_files(session)
+        model_file = store_model_file(temp_path, digest.hexdigest(), "model", directory)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    ml_model = MLModel(model_name=model_name, model_file=model_file, metrics=json.dumps(metrics))
+    try:
+        session.add(ml_model)
+        session.commit()
+    except Exception: # e.g. the name was taken concurrently
+        session.rollback()
+        # remove the stored file, unless an identical model under another name uses it
+        if session.exec(select(MLModel).where(MLModel.model_file==model_file)).first() is None:
+            remove_model_file(model_file)
+        raise
+    return ml_model
+
+
+def run_training_job(job_id : int, database_url : str, n_jobs : int = TRAINING_N_JOBS, nice : int = TRAINING_NICE) -> None:
+    """
+    Runs a queued training job, the entry point of the training process
+    """
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+    engine = create_engine(database_url, poolclass=NullPool)
+    try:
+        with Session(engine) as session:
+            job = session.get(TrainingJob, job_id)
+            request = TrainingRequest.parse_raw(job.parameters)
+            _update(session, job, status="running", stage="loading", started_at=datetime.utcnow())
+            try:
+                X, y = load_training_data(session, request, lambda loaded: _update(session, job, records=loaded))
+                counts = np.bincount(y, minlength=len(LABEL_CODES))
+                if len(y) < TRAINING_MIN_RECORDS or counts.min() < 2:
+                    raise ValueError(f"not enough labeled records to train on: {dict(zip(LABEL_CODES, counts.tolist()))}")
+                X_train, X_test, y_train, y_test = split_data(X, y, request)
+                _update(session, job, stage="training")
+                model = train_model(X_train, y_train, request, n_jobs)
+                _update(session, job, stage="evaluating")
+                metrics = evaluate_model(model, X_test, y_test)
+                metrics["train_records"] = int(len(y_train))
+                _update(session, job, stage="registering")
+                register_model(session, job.model_name, model, metrics)
+                _update(session, job, status="succeeded", stage=None, metrics=json.dumps(metrics), finished_at=datetime.utcnow())
+            except Exception as e:
+                session.rollback()
+                _update(session, job, status="failed", error=f"{type(e).__name__}: {e}", finished_at=datetime.utcnow())
+    finally:
+        engine.dispose()
+
+
+def job_status(job : TrainingJob) -> dict:
+    """
+    Returns the job row as a dict, with its JSON columns decoded
+    """
+    status = job.dict()
+    for field in ("parameters", "metrics"):
+        if status[field] is not None:
+            status[field] = json.loads(status[field])
+    return status
+
+
+class TrainingJobs:
+    """
+    Starts training jobs in spawned processes, at most max_running at a time, and tells
+    which of them exited. Spawned rather than forked, as the API process runs threads
+    """
+
+    def __init__(self, max_running : int = TRAINING_MAX_RUNNING):
+        self.max_running = max_running
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = {} # job id -> process
+        self._exitcodes = {} # job id -> exit code of the processes forgotten since they exited
+        self._lock = threading.Lock()
+
+    def running(self) -> list:
+        """
+        Returns the ids of the jobs whose process is running
+        """
+        with self._lock:
+            return [job_id for job_id, process in self._processes.items() if process.is_alive()]
+
+    def start(self, job_id : int, database_url : str) -> None:
+        """
+        Starts the process of a queued job, raises TrainingBusy if max_running jobs are running
+        """
+        with self._lock:
+            # forget the processes of finished jobs, keeping their exit codes
+            for finished in [job_id for job_id, process in self._processes.items() if process.exitcode is not None]:
+                process = self._processes.pop(finished)
+                self._exitcodes[finished] = process.exitcode
+                process.close()
+            if len(self._processes) >= self.max_running:
+                raise TrainingBusy()
+            process = self._context.Process(target=run_training_job, args=(job_id, database_url),
+                                            name=f"training-job-{job_id}", daemon=True)
+            process.start()
+            self._processes[job_id] = process
+
+    def exitcode(self, job_id : int) -> Optional[int]:
+        """
+        Returns the exit code of the job's process, None while it runs or if it was not started here
+        """
+        with self._lock:
+            process = self._processes.get(job_id)
+            return self._exitcodes.get(job_id) if process is None else process.exitcode
+
+    def shutdown(self, timeout : float = 5) -> list:
+        """
+        Terminates the running training processes, returns the ids of their jobs
+        """
+        with self._lock:
+            processes = dict(self._processes)
+            self._processes.clear()
+        terminated = []
+        for job_id, process in processes.items():
+            if process.is_alive():
+                process.terminate()
+                terminated.append(job_id)
+            process.join(timeout)
+        return terminated
+
+
+# training jobs started by this API process
+training_jobs = TrainingJobs()
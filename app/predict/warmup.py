@@ -0,0 +1,46 @@
+# Preloads ML models into the in-process cache and runs a dummy prediction through each,
+# so the first leads after a deploy or restart do not pay unpickling and cold start costs
+import numpy as np
+from decouple import config, Csv
+from sqlmodel import select, Session
+
+from app.models.models import MLModel
+from app.predict.predict import Predict
+from app.predict.registry import model_registry, ModelRegistry
+
+# comma separated model names to preload at startup, empty -> all uploaded models
+PRELOAD_MODELS = config('PRELOAD_MODELS', default='', cast=Csv())
+
+# a lead with every field empty, encoded with the default codes
+DUMMY_LEAD = {'category' : '', 'country' : '', 'budget' : '', 'hourly_from' : '', 'hourly_to' : ''}
+
+
+def warm_model(model : object) -> None:
+    """
+    Runs a dummy vector through the model's predict, so lazy imports and allocations happen now
+    """
+    pr = Predict()
+    vector = pr.vectorize_lead(pr.encode_lead(DUMMY_LEAD))
+    pr.predict_lead(vector=vector, ml_model=model)
+    pr.predict_leads(matrix=np.repeat(vector, 2, axis=0), ml_model=model)
+
+
+def preload_models(session : Session, model_names : list = PRELOAD_MODELS,
+                   registry : ModelRegistry = model_registry) -> dict:
+    """
+    Loads the configured models (all if model_names is empty) into the registry and warms them up.
+    At most registry.max_models models are preloaded, so preloading does not evict itself.
+    Returns a dict of model name -> "ready" or the error message
+    """
+    statement = select(MLModel).order_by(MLModel.id)
+    if model_names:
+        statement = statement.where(MLModel.model_name.in_(model_names))
+    status = {}
+    for ml_model in session.exec(statement).all()[:registry.max_models]:
+        try:
+            model = registry.get(ml_model.model_name, ml_model.model_file)
+            warm_model(model)
+            status[ml_model.model_name] = "ready"
+        except Exception as e:
+            status[ml_model.model_name] = f"error: {e}"
+    return status
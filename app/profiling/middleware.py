@@ -0,0 +1,69 @@
+# Opt-in profiling of single requests under real traffic: a request is profiled when an authenticated
+# client sends the X-Profile header to a route requiring a bearer token, or when it is sampled at
+# PROFILE_SAMPLE_RATE. Both are off by default
+import random
+import time
+from decouple import config
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+from app.profiling.profiling import start_request_profile, end_request_profile, save_profile, PROFILE_DIR
+
+# the X-Profile header is honoured for requests with a valid bearer token
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=False, cast=bool)
+# fraction of all requests profiled without the header, 0 -> none
+PROFILE_SAMPLE_RATE = config('PROFILE_SAMPLE_RATE', default=0.0, cast=float)
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests carrying the X-Profile header, from the point jwtBearer verified their bearer
+    token on, and a sample of all requests. The name of the saved profile is returned in the
+    X-Profile-Id response header. Work done on the event loop itself is not profiled, it is shared
+    by all concurrent requests.
+    A plain ASGI middleware, requests that are not profiled are passed on as they are
+    """
+
+    def __init__(self, app, enabled : bool = PROFILING_ENABLED, sample_rate : float = PROFILE_SAMPLE_RATE,
+                 directory : str = PROFILE_DIR):
+        self.app = app
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.directory = directory
+
+    def should_profile(self, headers : Headers) -> tuple:
+        """
+        Returns whether to start a profile for the request, and whether it is active from the start.
+        The profile of a request asking for one is activated by jwtBearer, which verifies its token
+        """
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return True, True
+        return self.enabled and PROFILE_HEADER in headers, False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profiled, active = self.should_profile(Headers(scope=scope))
+        if not profiled:
+            await self.app(scope, receive, send)
+            return
+        profile, context_token = start_request_profile(active)
+        start = time.perf_counter()
+
+        async def send_with_profile(message):
+            # the blocking work of the request is done once the response starts
+            if message["type"] == "http.response.start":
+                stats = profile.stats()
+                if stats is not None:
+                    label = f"{scope['method']}-{scope['path']}-{1000 * (time.perf_counter() - start):.0f}ms"
+                    name = await run_in_threadpool(save_profile, stats, label, self.directory)
+                    MutableHeaders(scope=message).append(PROFILE_ID_HEADER, name)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            end_request_profile(context_token)
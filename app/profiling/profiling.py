@@ -0,0 +1,160 @@
+# Per-request profiling: the blocking work of a profiled request - sync routes in the thread pool and
+# calls in the inference pool - runs under cProfile, and the merged profile is saved to PROFILE_DIR as
+# a pstats file. Which requests are profiled is decided by app.profiling.middleware, a request asking
+# for a profile is only profiled once jwtBearer verified its token
+import asyncio
+import cProfile
+import functools
+import io
+import os
+import pstats
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+from decouple import config
+from fastapi.routing import APIRoute
+
+# directory of the saved profiles, and how many of the newest profiles are kept
+PROFILE_DIR = config('PROFILE_DIR', default='profiles')
+PROFILE_MAX_FILES = config('PROFILE_MAX_FILES', default=100, cast=int)
+
+# profile of the request being served in this context, copied into the thread pools with the context
+_request_profile = ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """
+    Collects one cProfile per blocking call of a request, possibly made from several threads,
+    once it is active
+    """
+
+    def __init__(self, active : bool = True):
+        self.active = active
+        self._profiles = []
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) in the current thread under a new cProfile
+        """
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+                self.calls += 1
+
+    def stats(self) -> Optional[pstats.Stats]:
+        """
+        Returns the merged statistics of all profiled calls, None if no call was profiled
+        """
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+def active_profile() -> Optional[RequestProfile]:
+    """
+    Returns the profile of the request served in the current context, if it is profiled
+    """
+    profile = _request_profile.get()
+    return profile if profile is not None and profile.active else None
+
+
+def start_request_profile(active : bool = True) -> tuple:
+    """
+    Starts profiling the request served in the current context, right away or once it is activated.
+    Returns the profile and the token to pass to end_request_profile
+    """
+    profile = RequestProfile(active)
+    return profile, _request_profile.set(profile)
+
+
+def activate_request_profile() -> None:
+    """
+    Activates the profile of the request served in the current context, if one was started for it
+    """
+    profile = _request_profile.get()
+    if profile is not None:
+        profile.active = True
+
+
+def end_request_profile(token) -> None:
+    _request_profile.reset(token)
+
+
+def profiled(fn):
+    """
+    Wraps a sync function, e.g. a route, to run under the profile of the request calling it
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        profile = active_profile()
+        if profile is None:
+            return fn(*args, **kwargs)
+        return profile.run(fn, *args, **kwargs)
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Route whose sync endpoint runs under the profile of the request, as FastAPI runs it in its thread pool
+    """
+
+    def __init__(self, path : str, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            endpoint = profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def profile_path(name : str, directory : str = PROFILE_DIR) -> Optional[str]:
+    """
+    Returns the path of a saved profile, None for names that are not a profile in directory
+    """
+    if os.path.basename(name) != name or not name.endswith(".prof"):
+        return None
+    path = os.path.join(directory, name)
+    return path if os.path.isfile(path) else None
+
+
+def list_profiles(directory : str = PROFILE_DIR) -> list:
+    """
+    Returns the names of the saved profiles, newest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.endswith(".prof")]
+    return sorted(names, key=lambda name: os.path.getmtime(os.path.join(directory, name)), reverse=True)
+
+
+def save_profile(stats : pstats.Stats, label : str, directory : str = PROFILE_DIR,
+                 max_files : int = PROFILE_MAX_FILES) -> str:
+    """
+    Dumps the statistics to directory, removes the oldest profiles beyond max_files, returns the file name
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.urandom(4).hex()}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', label)[:80]}.prof"
+    stats.dump_stats(os.path.join(directory, name))
+    for old in list_profiles(directory)[max_files:]:
+        os.remove(os.path.join(directory, old))
+    return name
+
+
+def profile_report(path : str, sort : str = "cumulative", limit : int = 50) -> str:
+    """
+    Returns the pstats text report of a saved profile
+    """
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
@@ -1,167 +1,667 @@
-import copy
-import pickle
+import hashlib
 import os
-from secrets import token_hex # for hashing
-from typing import List
+import tempfile
+import time
+from collections import Counter
+from datetime import date
+from typing import List, Optional
+from xml.etree.ElementTree import ParseError
 
-from fastapi import Body, Depends, APIRouter 
-from fastapi import UploadFile, File
-from sqlmodel import select, Session
+import numpy as np
+from fastapi import Body, Depends, APIRouter, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse
+from decouple import config
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select, Session, or_
 
 from app.auth.jwt_handler import signJWT
-from app.auth.jwt_bearer import jwtBearer  
-from app.models.models import Lead, MLModel, UserLogin, Users, Record, MLModelDelete
-from app.database.connection import get_session
+from app.auth.jwt_bearer import jwtBearer, token_cache
+from app.auth.password import hash_password, verify_password, needs_rehash
+from app.models.models import Lead, MLModel, UserLogin, Users, Record, MLModelDelete, RecordFilter, ModelAlias, ModelAliasUpdate, TrainingJob, TrainingRequest
+from app.database.connection import get_session, pool_stats
+from app.database.records import iter_records, iter_row_chunks, records_to_ndjson, records_to_csv, typed_fields
+from app.database.export import EXPORT_CHUNK_SIZE, EXPORT_ENCODERS, EXPORT_FORMATS, arrow_available, export_columns
+from app.database.writer import record_writer
+from app.database.stats import STAT_KEYS, add_stats, count_records, query_stats
 from app.predict.predict import Predict 
+from app.predict.registry import model_registry
+from app.predict.artifacts import store_model_file, remove_model_file, lock_model_files
+from app.predict.executor import inference_executor, InferenceSaturated, run_in_process
+from app.predict.batcher import micro_batcher
+from app.predict.aliases import resolve_model, repoint_alias, shadow_scorer
+from app.predict.training import training_jobs, job_status, fail_unfinished_jobs, TrainingBusy
+from app.extraction.feed import FeedParser, item_lead, FEED_BATCH_SIZE
+from app.routes.uploads import UploadParser
+from app.profiling.profiling import ProfiledRoute, list_profiles, profile_path, profile_report
+from app.metrics.metrics import Gauge, render, REQUESTS, ERRORS, PREDICTIONS, REQUEST_SECONDS, STAGE_SECONDS
 
 
 
-routes_router = APIRouter(tags=["routes"])
+# model uploads are streamed to disk as they are received, up to a maximum size
+MODEL_UPLOAD_MAX_BYTES = config('MODEL_UPLOAD_MAX_BYTES', default=1024 * 1024 * 1024, cast=int)
+# documents the multipart body model_upload parses itself
+MODEL_UPLOAD_OPENAPI = {"requestBody" : {"required" : True, "content" : {"multipart/form-data" : {"schema" : {
+    "type" : "object", "required" : ["file"], "properties" : {"file" : {"type" : "string", "format" : "binary"}}}}}}}
+
+# sync routes run under the profile of profiled requests
+routes_router = APIRouter(tags=["routes"], route_class=ProfiledRoute)
 
 
 
 @routes_router.get("/data_fetch", dependencies=[Depends(jwtBearer())], response_model=List[Record])
-async def data_fetch(session=Depends(get_session)):
+def data_fetch(response : Response, limit : Optional[int] = Query(default=None, ge=1), after_id : int = 0,
+               filters : RecordFilter = Depends(), session=Depends(get_session)):
     """
-    Fetches all data from the database and returns as JSON in response
+    Fetches data from the database and returns as JSON in response.
+    With limit, returns one page of the records with an id greater than after_id,
+    the after_id of the next page is returned in the X-Next-After-Id header
     """
-    statement = select(Record)
-    all_records = session.exec(statement).all() # .all() gives a list of the returned query set
+    records = list(iter_records(session, filters, after_id=after_id, limit=limit))
+    if limit is not None and len(records) == limit:
+        response.headers["X-Next-After-Id"] = str(records[-1].id)
+    return records
 
-    return all_records
 
+@routes_router.get("/data_stream", dependencies=[Depends(jwtBearer())])
+def data_stream(output_format : str = Query(default="ndjson", alias="format", pattern="^(ndjson|csv)$"),
+                limit : Optional[int] = Query(default=None, ge=1), after_id : int = 0,
+                filters : RecordFilter = Depends(), session=Depends(get_session)):
+    """
+    Streams the records from a server-side cursor as newline delimited JSON or CSV,
+    without loading the whole result in memory
+    """
+    records = iter_records(session, filters, after_id=after_id, limit=limit)
+    if output_format == "csv":
+        return StreamingResponse(records_to_csv(records), media_type="text/csv")
+    return StreamingResponse(records_to_ndjson(records), media_type="application/x-ndjson")
 
-@routes_router.post("/label_fetch", dependencies=[Depends(jwtBearer())])
-async def label_fetch(rss_feed : Lead, session=Depends(get_session)):
+
+@routes_router.get("/data_export", dependencies=[Depends(jwtBearer())])
+def data_export(output_format : str = Query(alias="format", pattern="^(parquet|arrow|xlsx)$"),
+                columns : List[str] = Query(default=[]), limit : Optional[int] = Query(default=None, ge=1), after_id : int = 0,
+                filters : RecordFilter = Depends(), session=Depends(get_session)):
     """
-    Receives a lead in json format,
-    classify it using ML model, saves it in datawarehouse,
-    returns as dict with label info to the client
+    Streams the columns (all without) of the records matching the filters as a Parquet file,
+    an Arrow IPC stream or an XLSX workbook, reading EXPORT_CHUNK_SIZE rows at a time
     """
-    # get model from the database and unpickle the model file for inference
-    try:
-        statement = select(MLModel).where(MLModel.model_name==rss_feed.model_name)
-        model = session.exec(statement).one()
-        model = pickle.load(open(model.model_file, 'rb'))
+    available = export_columns()
+    unknown = [column for column in columns if column not in available]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown columns {', '.join(unknown)}")
+    if output_format != "xlsx" and not arrow_available():
+        raise HTTPException(status_code=501, detail=f"{output_format} export needs pyarrow, which is not installed")
+    columns = columns or available
+    chunks = iter_row_chunks(session, filters, columns, after_id=after_id, limit=limit, chunk_size=EXPORT_CHUNK_SIZE)
+    media_type, extension = EXPORT_FORMATS[output_format]
+    return StreamingResponse(EXPORT_ENCODERS[output_format](chunks, columns), media_type=media_type,
+                             headers={"Content-Disposition" : f'attachment; filename="records.{extension}"'})
+
+
+@routes_router.get("/lead_stats", dependencies=[Depends(jwtBearer())])
+def lead_stats(group_by : List[str] = Query(default=[]), day_from : Optional[date] = None, day_to : Optional[date] = None,
+               session=Depends(get_session)):
+    """
+    Returns the number of leads per combination of the group_by columns (day, label, category, country),
+    from the statistics kept up to date with the warehouse, and their total.
+    day_from (inclusive) and day_to (exclusive) restrict the count to leads posted in that range
+    """
+    unknown = [key for key in group_by if key not in STAT_KEYS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"cannot group by {', '.join(unknown)}, only by {', '.join(STAT_KEYS)}")
+    groups = query_stats(session, group_by, day_from, day_to)
+    return {"total" : sum(group["leads"] for group in groups), "groups" : groups}
 
+
+# --------------- Inference -------------------
+# these helpers block on file I/O, predict and the warehouse commit,
+# the routes run them in the inference thread pool
+def prepare_lead(rss_feed : Lead, session : Session) -> tuple:
+    """
+    Loads the ML model (or the model an alias points at) of the lead and encodes and vectorizes the lead,
+    returns the MLModel row, the loaded model, the (1,5) vector and the shadow MLModel row or None
+    """
+    # get model from the database, the unpickled model is served from the in-process cache
+    with STAGE_SECONDS.time("model_lookup"):
+        ml_model, shadow = resolve_model(session, rss_feed.model_name)
+    with STAGE_SECONDS.time("model_load"):
+        model = model_registry.get(ml_model.model_name, ml_model.model_file)
+
+    with STAGE_SECONDS.time("encode"):
         pr = Predict()
         # encode the lead
-        encoded_info = pr.encode_lead(data=copy.deepcopy(rss_feed.dict())) # pass as a dictionary
+        encoded_info = pr.encode_lead(data=rss_feed.dict()) # pass as a dictionary, a new dict is returned
         # vectorize the lead
         vec = pr.vectorize_lead(encoded_info)
-        # predict the lead
-        predicted_label = pr.predict_lead(vector=vec, ml_model=model)
-    except(Exception) as e:
-        return {"error" : "prediction could not be carried out", "detail" : e}
-    
-    # save the lead as Record object in the data-warehouse
+    return ml_model, model, vec, shadow
+
+
+def lead_record(rss_feed : Lead, predicted_label : str) -> Record:
+    """
+    Returns the lead as Record object for the data-warehouse
+    """
+    return Record(
+        posted_on=rss_feed.posted_on,
+        category=rss_feed.category,
+        skills=rss_feed.skills,
+        country=rss_feed.country,
+        message=rss_feed.message,
+        hourly_from=rss_feed.hourly_from,
+        hourly_to=rss_feed.hourly_to,
+        budget=rss_feed.budget,
+        label=predicted_label,
+        **typed_fields(rss_feed.posted_on, rss_feed.hourly_from, rss_feed.hourly_to, rss_feed.budget)
+    )
+
+
+def save_lead(rss_feed : Lead, predicted_label : str, session : Session) -> dict:
+    """
+    Saves the lead as Record object in the data-warehouse, returns a dict with label info
+    """
     try:
-        record = Record(
-            posted_on=rss_feed.posted_on,
-            category=rss_feed.category,
-            skills=rss_feed.skills,
-            country=rss_feed.country,
-            message=rss_feed.message,
-            hourly_from=rss_feed.hourly_from,
-            hourly_to=rss_feed.hourly_to,
-            budget=rss_feed.budget,
-            label=predicted_label
-        )
-        session.add(record)
-        session.commit()
+        with STAGE_SECONDS.time("record_commit"):
+            record = lead_record(rss_feed, predicted_label)
+            session.add(record)
+            add_stats(session, count_records([record]))
+            session.commit()
     except(Exception) as e:
+        ERRORS.inc("label_fetch", type(e).__name__)
         return{"error" : "record could not be saved in the warehouse", "detail" : e}
     
     # return the label
     return {'label' : predicted_label}
 
 
-@routes_router.post("/model_upload", dependencies=[Depends(jwtBearer())])
-async def model_upload(file : UploadFile = File(...), session=Depends(get_session)):
-    file_extension = file.filename.split(".").pop()
-    model_name = file.filename.split(".")[0]
-    
-    # check if a model under this name already exists in the database
-    statement = select(MLModel)
-    fetched_models = session.exec(statement)
-    for model in fetched_models:
-        if model.model_name == model_name:
-            return {"Error" : "Cannot upload the model as another model under this name already exists."}
-
-    hashed_file_name = token_hex(10) # name size 10 bytes
-    new_file_name = f"{hashed_file_name}.{file_extension}"
-    file_path = os.path.join("models",new_file_name)
-    
-    # save file on server
-    with open(file_path, 'wb') as f:
-        content = await file.read()
-        f.write(content)
-
-    # # save model's file_path in database
-    ml_model = MLModel(model_name=model_name, model_file=file_path)
-    session.add(ml_model)
-    session.commit()
+def label_leads(rss_feeds : List[Lead], session : Session) -> list:
+    """
+    Classifies leads with one predict call per ML model, saves them in the datawarehouse
+    in a single transaction, returns a list of label dicts in the order of the passed leads.
+    A lead that cannot be classified gets an error dict without failing the other leads.
+    """
+    pr = Predict()
+    results = [None] * len(rss_feeds)
+
+    # group lead positions by model name, so that each model is loaded and called once
+    positions_by_model = {}
+    for position, rss_feed in enumerate(rss_feeds):
+        positions_by_model.setdefault(rss_feed.model_name, []).append(position)
+
+    for model_name, positions in positions_by_model.items():
+        try:
+            model, _ = resolve_model(session, model_name)
+            model = model_registry.get(model.model_name, model.model_file)
+        except(Exception) as e:
+            for position in positions:
+                results[position] = {"error" : "prediction could not be carried out", "detail" : str(e)}
+            continue
+
+        # encode all leads of this model into one matrix and predict them at once,
+        # a lead that cannot be encoded is reported on its own
+        try:
+            matrix = pr.encode_leads([rss_feeds[position].dict() for position in positions])
+            valid_rows = ~np.isnan(matrix).any(axis=1)
+            encoded_positions = [position for position, valid in zip(positions, valid_rows) if valid]
+            for position, valid in zip(positions, valid_rows):
+                if not valid:
+                    results[position] = {"error" : "prediction could not be carried out", "detail" : "lead could not be encoded"}
+            predicted_labels = pr.predict_leads(matrix=matrix[valid_rows], ml_model=model)
+        except(Exception) as e:
+            for position in positions:
+                results[position] = {"error" : "prediction could not be carried out", "detail" : str(e)}
+            continue
+        for position, predicted_label in zip(encoded_positions, predicted_labels):
+            results[position] = {'label' : predicted_label}
+            PREDICTIONS.inc(model_name, predicted_label)
+
+    # save all classified leads as Record objects in the data-warehouse in one transaction
+    saved_positions = [position for position, result in enumerate(results) if 'label' in result]
+    try:
+        records = [lead_record(rss_feeds[position], results[position]['label']) for position in saved_positions]
+        session.add_all(records)
+        add_stats(session, count_records(records))
+        session.commit()
+    except(Exception) as e:
+        session.rollback()
+        for position in saved_positions:
+            results[position] = {"error" : "record could not be saved in the warehouse", "detail" : str(e)}
+
+    return results
+
+
+def label_feed_items(items : List[dict], model_name : str, session : Session) -> list:
+    """
+    Extracts the leads of RSS feed items and classifies and saves them with label_leads,
+    returns a list of label dicts in the order of the items. An item whose lead cannot be
+    extracted gets an error dict without failing the other items
+    """
+    results = [None] * len(items)
+    rss_feeds, positions = [], []
+    for position, item in enumerate(items):
+        try:
+            rss_feeds.append(Lead(**item_lead(item, model_name)))
+            positions.append(position)
+        except(Exception) as e:
+            results[position] = {"error" : "lead could not be extracted", "detail" : str(e)}
+    for position, result in zip(positions, label_leads(rss_feeds, session)):
+        results[position] = result
+    return results
+
+
+@routes_router.post("/label_fetch", dependencies=[Depends(jwtBearer())])
+async def label_fetch(rss_feed : Lead, session=Depends(get_session)):
+    """
+    Receives a lead in json format,
+    classify it using ML model, saves it in datawarehouse,
+    returns as dict with label info to the client
+    """
+    REQUESTS.inc("label_fetch")
+    start = time.perf_counter()
+    try:
+        ml_model, model, vec, shadow = await inference_executor.run(prepare_lead, rss_feed, session)
+        # predict the lead together with concurrent requests for the same model
+        with STAGE_SECONDS.time("predict"):
+            predicted_label = await micro_batcher.predict((ml_model.model_name, id(model)), model, vec)
+        PREDICTIONS.inc(rss_feed.model_name, predicted_label)
+        if shadow is not None: # compared in the background, the response does not wait for it
+            shadow_scorer.schedule(shadow, vec, predicted_label, ml_model.model_name)
+        # with write-behind the record is inserted later in bulk, unless the write queue is full
+        if record_writer.enabled:
+            with STAGE_SECONDS.time("record_queue"):
+                queued = record_writer.submit(lead_record(rss_feed, predicted_label))
+            if queued:
+                return {'label' : predicted_label}
+        return await inference_executor.run(save_lead, rss_feed, predicted_label, session)
+    except InferenceSaturated:
+        ERRORS.inc("label_fetch", "InferenceSaturated")
+        raise HTTPException(status_code=503, detail="Inference is saturated, retry later")
+    except(Exception) as e:
+        ERRORS.inc("label_fetch", type(e).__name__)
+        return {"error" : "prediction could not be carried out", "detail" : e}
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, "label_fetch")
+
+
+@routes_router.post("/label_fetch_batch", dependencies=[Depends(jwtBearer())])
+async def label_fetch_batch(rss_feeds : List[Lead], session=Depends(get_session)):
+    """
+    Receives a list of leads in json format,
+    classifies them with one predict call per ML model, saves them in the datawarehouse
+    in a single transaction, returns a list of label dicts in the order of the passed leads.
+    A lead that cannot be classified gets an error dict without failing the other leads.
+    """
+    REQUESTS.inc("label_fetch_batch")
+    try:
+        with REQUEST_SECONDS.time("label_fetch_batch"):
+            results = await inference_executor.run(label_leads, rss_feeds, session)
+    except InferenceSaturated:
+        ERRORS.inc("label_fetch_batch", "InferenceSaturated")
+        raise HTTPException(status_code=503, detail="Inference is saturated, retry later")
+    failed = sum('label' not in result for result in results)
+    if failed:
+        ERRORS.inc("label_fetch_batch", "lead", amount=failed)
+    return results
+
+
+@routes_router.post("/feed_ingest", dependencies=[Depends(jwtBearer())])
+async def feed_ingest(request : Request, model_name : str, session=Depends(get_session)):
+    """
+    Receives a raw RSS document as request body and parses it while it streams in,
+    the leads extracted from its items are classified and saved in batches of FEED_BATCH_SIZE.
+    Returns the number of ingested items, the label counts and the number of failed items
+    """
+    REQUESTS.inc("feed_ingest")
+    start = time.perf_counter()
+    parser = FeedParser()
+    summary = {"items" : 0, "labels" : Counter(), "failed" : 0}
+
+    async def ingest(items : list) -> None:
+        for result in await inference_executor.run(label_feed_items, items, model_name, session):
+            summary["items"] += 1
+            if 'label' in result:
+                summary["labels"][result['label']] += 1
+            else:
+                summary["failed"] += 1
+                summary.setdefault("error", result) # first error, for diagnosis
+                ERRORS.inc("feed_ingest", "lead")
+
+    pending = []
+    try:
+        # the body is not read further while a batch is classified
+        async for chunk in request.stream():
+            pending.extend(parser.feed(chunk))
+            while len(pending) >= FEED_BATCH_SIZE:
+                await ingest(pending[:FEED_BATCH_SIZE])
+                pending = pending[FEED_BATCH_SIZE:]
+        pending.extend(parser.close())
+        if pending:
+            await ingest(pending)
+    except ParseError as e:
+        ERRORS.inc("feed_ingest", "ParseError")
+        raise HTTPException(status_code=400, detail=f"feed could not be parsed after {summary['items']} ingested items: {e}")
+    except InferenceSaturated:
+        ERRORS.inc("feed_ingest", "InferenceSaturated")
+        raise HTTPException(status_code=503, detail=f"Inference is saturated after {summary['items']} ingested items, retry later")
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, "feed_ingest")
+    return summary
+
+
+@routes_router.post("/model_upload", dependencies=[Depends(jwtBearer())], openapi_extra=MODEL_UPLOAD_OPENAPI)
+async def model_upload(request : Request, session=Depends(get_session)):
+    """
+    Receives a model file as multipart/form-data "file" field and parses the body while it streams in,
+    writing the file to disk while hashing it. Validates it in a worker process and stores it under
+    its content hash, so identical uploads share one file
+    """
+    # reject an oversized upload before reading its body
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MODEL_UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Model file is too large")
+    try:
+        parser = UploadParser(request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"upload could not be parsed: {e}")
+
+    # save file on server under a temporary name, chunk by chunk
+    digest = hashlib.sha256()
+    size = 0
+    model_name = None
+    fd, temp_path = tempfile.mkstemp(dir="models", prefix=".upload-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for chunk in request.stream():
+                data = parser.feed(chunk)
+                if model_name is None and parser.filename is not None:
+                    model_name = parser.filename.split(".")[0]
+                    file_extension = parser.filename.split(".").pop()
+                    # check if a model under this name already exists in the database, before reading the file
+                    statement = select(MLModel).where(MLModel.model_name==model_name)
+                    if session.exec(statement).first() is not None:
+                        return {"Error" : "Cannot upload the model as another model under this name already exists."}
+                    statement = select(ModelAlias).where(ModelAlias.alias==model_name)
+                    if session.exec(statement).first() is not None:
+                        return {"Error" : "Cannot upload the model as an alias under this name already exists."}
+                for piece in data:
+                    size += len(piece)
+                    if size > MODEL_UPLOAD_MAX_BYTES:
+                        raise HTTPException(status_code=413, detail="Model file is too large")
+                    digest.update(piece)
+                if data:
+                    await run_in_threadpool(f.writelines, data)
+            parser.close()
+        # validate the model, move it to models/<sha256>.<extension> and save its file_path in the database,
+        # a concurrent model_delete cannot remove an identical stored file before the row is added
+        lock_model_files(session)
+        file_path = await run_in_process(store_model_file, temp_path, digest.hexdigest(), file_extension)
+        ml_model = MLModel(model_name=model_name, model_file=file_path)
+        session.add(ml_model)
+        session.commit()
+    except ValueError as e:
+        session.rollback()
+        return {"Error" : f"Cannot upload the model as it is not a valid model: {e}"}
+    except IntegrityError: # uploaded concurrently under the same name
+        session.rollback()
+        return {"Error" : "Cannot upload the model as another model under this name already exists."}
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
     session.refresh(ml_model)
+    # a cached model under this name is stale now
+    model_registry.invalidate(model_name)
     return {"success" : "ml model has successfully uploaded"}
 
 
 @routes_router.delete("/model_delete", dependencies=[Depends(jwtBearer())])
 async def model_delete(model_details : MLModelDelete, session=Depends(get_session)):
-    # fetch the model and delete from DB
+    # a model version an alias points at cannot be deleted, repoint the alias first
+    statement = select(ModelAlias).where(or_(ModelAlias.model_name==model_details.model_name,
+                                             ModelAlias.shadow_model_name==model_details.model_name))
+    model_alias = session.exec(statement).first()
+    if model_alias is not None:
+        return {'status' : 'Failed', 'message' : f'Model is in use by the alias {model_alias.alias}'}
+    # fetch the model and delete it from DB together with its file on the server, unless an identical
+    # upload under another name still uses it. Both in one transaction, so an identical upload does
+    # not reuse the file while it is removed
     try:
+        lock_model_files(session)
         statement = select(MLModel).where(MLModel.model_name==model_details.model_name)
         model = session.exec(statement).one()
-        model_path = model.model_file
         session.delete(model)
+        statement = select(MLModel).where(MLModel.model_file==model.model_file)
+        if session.exec(statement).first() is None:
+            remove_model_file(model.model_file)
         session.commit()
-    except Exception as e:
-        pass 
-    # Delete model file from Server        
-    try:
-        os.remove(model_path)
     except (Exception, FileNotFoundError) as e:
+        session.rollback()
         return {'status' : 'Failed', 'message' : 'Model file could not be deleted from server', 'exception' : e}
+    finally:
+        # drop the model from the in-process cache
+        model_registry.invalidate(model_details.model_name)
 
     return {'status' : 'Success', 'message' : 'Model deleted from database and server successfully'}
 
 
+@routes_router.post("/model_alias", dependencies=[Depends(jwtBearer())])
+async def model_alias(alias_details : ModelAliasUpdate, session=Depends(get_session)):
+    """
+    Points an alias (e.g. production) at an uploaded model version, optionally with a shadow model.
+    The versions are loaded and warmed before the alias is switched, so the swap has no downtime
+    """
+    try:
+        await inference_executor.run(repoint_alias, session, alias_details.alias, alias_details.model_name,
+                                     alias_details.shadow_model_name)
+    except InferenceSaturated:
+        raise HTTPException(status_code=503, detail="Inference is saturated, retry later")
+    except(Exception) as e:
+        return {"Error" : f"alias could not be repointed: {e}"}
+    return {"success" : f"{alias_details.alias} points at {alias_details.model_name}"}
+
+
+@routes_router.get("/model_aliases", dependencies=[Depends(jwtBearer())])
+async def model_aliases(session=Depends(get_session)):
+    """
+    Returns the aliases, the versions they point at, and the shadow scoring counters
+    """
+    aliases = session.exec(select(ModelAlias).order_by(ModelAlias.alias)).all()
+    return {"aliases" : aliases, "shadow" : shadow_scorer.stats()}
+
+
+@routes_router.post("/training_jobs", dependencies=[Depends(jwtBearer())])
+def training_job_start(training_request : TrainingRequest, session=Depends(get_session)):
+    """
+    Starts training a new model version on the labeled warehouse records in a separate process,
+    returns the queued job. Its progress is polled with GET /training_jobs/{job_id}
+    """
+    if session.exec(select(MLModel).where(MLModel.model_name==training_request.model_name)).first() is not None:
+        raise HTTPException(status_code=400, detail="another model under this name already exists")
+    if session.exec(select(ModelAlias).where(ModelAlias.alias==training_request.model_name)).first() is not None:
+        raise HTTPException(status_code=400, detail="an alias under this name already exists")
+    job = TrainingJob(model_name=training_request.model_name, parameters=training_request.json())
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    try:
+        training_jobs.start(job.id, session.get_bind().url.render_as_string(hide_password=False))
+    except TrainingBusy:
+        session.delete(job)
+        session.commit()
+        raise HTTPException(status_code=409, detail="a training job is running already, retry when it finished")
+    return job_status(job)
+
+
+@routes_router.get("/training_jobs", dependencies=[Depends(jwtBearer())])
+def training_job_list(limit : int = Query(default=20, ge=1), session=Depends(get_session)):
+    """
+    Returns the latest training jobs, newest first
+    """
+    jobs = session.exec(select(TrainingJob).order_by(TrainingJob.id.desc()).limit(limit)).all()
+    return [job_status(job) for job in jobs]
+
+
+@routes_router.get("/training_jobs/{job_id}", dependencies=[Depends(jwtBearer())])
+def training_job(job_id : int, session=Depends(get_session)):
+    """
+    Returns the status, progress and, when it succeeded, the evaluation metrics of a training job
+    """
+    job = session.get(TrainingJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="training job not found")
+    exitcode = training_jobs.exitcode(job_id)
+    if job.status in ("queued", "running") and exitcode is not None:
+        fail_unfinished_jobs(session, [job_id], f"training process exited with code {exitcode}")
+    return job_status(job)
+
+
+@routes_router.get("/model_cache", dependencies=[Depends(jwtBearer())])
+async def model_cache():
+    """
+    Returns hit, miss and eviction counters of the in-process model cache
+    """
+    return model_registry.stats()
+
+
+@routes_router.get("/inference_pool", dependencies=[Depends(jwtBearer())])
+async def inference_pool():
+    """
+    Returns running, queued and rejected counts of the inference thread pool
+    """
+    return inference_executor.stats()
+
+
+@routes_router.get("/inference_batches", dependencies=[Depends(jwtBearer())])
+async def inference_batches():
+    """
+    Returns the distribution of batch sizes achieved by the label_fetch micro-batcher
+    """
+    return micro_batcher.stats()
+
+
+@routes_router.get("/record_writer", dependencies=[Depends(jwtBearer())])
+async def record_writer_stats():
+    """
+    Returns queued, written and rejected counts of the write-behind record writer
+    """
+    return record_writer.stats()
+
+
+@routes_router.get("/db_pool", dependencies=[Depends(jwtBearer())])
+async def db_pool():
+    """
+    Returns usage, overflow and checkout wait times of the database connection pool
+    """
+    return pool_stats()
+
+
+@routes_router.get("/token_cache", dependencies=[Depends(jwtBearer())])
+async def token_cache_stats():
+    """
+    Returns the hit rate of the verified-token cache
+    """
+    return token_cache.stats()
+
+
+# gauges are read from the components when /metrics is scraped
+def _states(stats : dict, states : tuple) -> dict:
+    return {(state,) : stats[state] for state in states}
+
+
+Gauge("leadapi_models_loaded", "Models held in the in-process model cache", lambda: {() : model_registry.stats()["size"]})
+Gauge("leadapi_inference_pool_calls", "Running and queued calls of the inference thread pool",
+      lambda: _states(inference_executor.stats(), ("running", "queued")), ["state"])
+Gauge("leadapi_db_pool_connections", "Connections of the database pool",
+      lambda: _states(pool_stats(), ("pool_size", "checked_out", "checked_in", "overflow")), ["state"])
+Gauge("leadapi_record_writer_queued", "Records waiting in the write-behind queue", lambda: {() : record_writer.stats()["queued"]})
+
+
+@routes_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Prometheus scrape endpoint: request, error and prediction counters, per-stage latency
+    histograms of label_fetch and gauges of the caches and pools, in the text exposition format
+    """
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@routes_router.get("/profiles", dependencies=[Depends(jwtBearer())])
+async def profiles():
+    """
+    Lists the saved request profiles, newest first. A request is profiled when sent with the
+    X-Profile header, the name of its profile is returned in the X-Profile-Id response header
+    """
+    return {"profiles" : await run_in_threadpool(list_profiles)}
+
+
+@routes_router.get("/profiles/{name}", dependencies=[Depends(jwtBearer())])
+async def profile(name : str, output_format : str = Query(default="text", alias="format", pattern="^(text|pstats)$"),
+                  sort : str = Query(default="cumulative", pattern="^(cumulative|tottime|calls|ncalls)$"),
+                  limit : int = Query(default=50, ge=1)):
+    """
+    Returns a saved profile as pstats text report, or as pstats file for snakeviz or pstats
+    """
+    path = profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if output_format == "pstats":
+        return FileResponse(path, media_type="application/octet-stream", filename=name)
+    return PlainTextResponse(await run_in_threadpool(profile_report, path, sort, limit))
+
+
+@routes_router.get("/ready")
+async def ready(request : Request, response : Response):
+    """
+    Readiness probe - 503 until the startup warm-up (tables, connection pool, models) has finished
+    """
+    is_ready = getattr(request.app.state, "ready", False)
+    if not is_ready:
+        response.status_code = 503
+    return {"ready" : is_ready, "models" : getattr(request.app.state, "models", {})}
+
+
 # --------------- Signup - Login Routes -------------------
 # checks if a user already exists in the database before signup or login
 def check_user(data : UserLogin, caller_flag : str, session : Session) -> bool: # UserLoginSchema has email and password
     """ 
-    fetches all users from db and check presence of the passed user as data argument.
+    fetches the user with the email of the passed user as data argument through the unique email index,
+    for login also verifies the password against its salted hash.
     args:
         data : 
         caller_flag :
         session : Session object, as passed by signup or login function. 
     """
-    USER_PRESENT = False
-    statement = select(Users)
-    all_users = session.exec(statement)
-
-    for user in all_users:
-        if caller_flag=='signup':
-            if user.email == data.email:
-                USER_PRESENT = True
-                return USER_PRESENT
-        elif caller_flag=='login':
-            if user.email == data.email and user.password == data.password:
-                USER_PRESENT = True
-                return USER_PRESENT
-        elif caller_flag != 'signup' or caller_flag != 'login':
-            return {"error" : "caller flag not set either signup or login"}
-    print("**** No where USER found")
-    return USER_PRESENT
+    if caller_flag not in ('signup', 'login'):
+        return {"error" : "caller flag not set either signup or login"}
+    statement = select(Users).where(Users.email==data.email)
+    user = session.exec(statement).first()
+    if user is None:
+        return False
+    if caller_flag=='signup':
+        return True
+
+    if not verify_password(data.password, user.password):
+        return False
+    # users signed up before hashing, or with fewer hash iterations, get a fresh hash
+    if needs_rehash(user.password):
+        user.password = hash_password(data.password)
+        session.add(user)
+        session.commit()
+    return True
 
 
 # user sign up - to create a new user
 # include_in_schema=Flase -> hides the endpoint from the generated OpenAPI schema and from auto documentation
+# signup and login are plain def routes, FastAPI runs them in its thread pool so the
+# password hashing does not block the event loop
 @routes_router.post("/user/signup", tags=["user"], include_in_schema=False) 
 def user_signup(user : Users = Body(default=None), session=Depends(get_session)):
     if not check_user(user, caller_flag='signup', session=session): # if USER_PRESENT is False
-        # insert new user in the DB
-        session.add(user)
-        session.commit()
+        # insert new user in the DB, with the password salted and hashed
+        user.password = hash_password(user.password)
+        try:
+            session.add(user)
+            session.commit()
+        except IntegrityError: # signed up concurrently under the same email
+            session.rollback()
+            return {"notification" : "user already exists"}
         session.refresh(user)
         return {"success" : "user has successfully signed up"}
     else:
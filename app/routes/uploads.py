@@ -0,0 +1,78 @@
+# Incremental parsing of multipart/form-data uploads. The data of the uploaded file is handed out
+# chunk by chunk while the request body is received, so an upload is written to disk once, as it
+# streams in, instead of being spooled by the form parser before the route can look at it
+from multipart import MultipartParser
+from multipart.multipart import parse_options_header
+
+
+class UploadParser:
+    """
+    Incremental parser of a multipart/form-data body: feed() the body chunk by chunk and receive
+    the data of the file field it contained. The filename is set once the file's headers are read.
+    Raises ValueError for a body that is not multipart/form-data or has no file under field_name
+    """
+
+    def __init__(self, content_type : str, field_name : str = "file"):
+        _, params = parse_options_header(content_type)
+        if b"boundary" not in params:
+            raise ValueError("Missing boundary in multipart.")
+        self.field_name = field_name
+        self.filename = None
+        self._in_file = False
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._data = []
+        self._parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin" : self._on_part_begin,
+            "on_part_data" : self._on_part_data,
+            "on_part_end" : self._on_part_end,
+            "on_header_field" : self._on_header_field,
+            "on_header_value" : self._on_header_value,
+            "on_header_end" : self._on_header_end,
+            "on_headers_finished" : self._on_headers_finished,
+        })
+
+    def feed(self, chunk : bytes) -> list:
+        """
+        Parses the next chunk of the body, returns the file data it contained
+        """
+        self._parser.write(chunk)
+        data, self._data = self._data, []
+        return data
+
+    def close(self) -> None:
+        """
+        Ends the body, raises ValueError if it contained no file
+        """
+        self._parser.finalize()
+        if self.filename is None:
+            raise ValueError(f'No file in the "{self.field_name}" field.')
+
+    def _on_part_begin(self) -> None:
+        self._disposition = b""
+
+    def _on_part_data(self, data : bytes, start : int, end : int) -> None:
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self) -> None:
+        self._in_file = False
+
+    def _on_header_field(self, data : bytes, start : int, end : int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data : bytes, start : int, end : int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name, self._header_value = b"", b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        # the first file under field_name, other fields and files are skipped
+        if self.filename is None and options.get(b"name") == self.field_name.encode() and b"filename" in options:
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            self._in_file = True
@@ -1,10 +1,51 @@
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from sqlmodel import Session
 from app.routes.routes import routes_router
-from app.database.connection import conn
+from app.profiling.middleware import ProfilingMiddleware, PROFILING_ENABLED, PROFILE_SAMPLE_RATE
+from app.database.connection import conn, warm_pool, engine_url
+from app.database.writer import record_writer
+from app.predict.executor import inference_executor, shutdown_process_pool
+from app.predict.registry import model_registry
+from app.predict.warmup import preload_models
+from app.predict.training import training_jobs, fail_unfinished_jobs
 
-app = FastAPI()
+
+def warm_up() -> dict:
+    # create tables, open the connection pool, preload and warm the ML models
+    conn()
+    warm_pool()
+    with Session(engine_url) as session:
+        return preload_models(session)
+
+
+@asynccontextmanager
+async def lifespan(app : FastAPI):
+    # startup - the application only reports ready once everything is warm
+    app.state.ready = False
+    app.state.models = await run_in_threadpool(warm_up)
+    if record_writer.enabled:
+        record_writer.start()
+    app.state.ready = True
+    yield
+    # shutdown
+    app.state.ready = False
+    # let running predictions finish before the process exits
+    inference_executor.shutdown()
+    shutdown_process_pool()
+    # running training jobs are terminated, they have to be started again
+    with Session(engine_url) as session:
+        fail_unfinished_jobs(session, training_jobs.shutdown(), "interrupted by shutdown")
+    # write the records still waiting in the write-behind queue
+    record_writer.stop()
+    model_registry.clear()
+    engine_url.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Register origins - Allow all origins : * 
 # actually only axiom odoo server will be allowed to access the api
@@ -18,13 +59,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Profile requests sent with the X-Profile header by authenticated clients, and sampled requests
+if PROFILING_ENABLED or PROFILE_SAMPLE_RATE > 0:
+    app.add_middleware(ProfilingMiddleware)
+
 # Register routes
 app.include_router(routes_router)
 
-@app.on_event("startup")
-def on_startup():
-    conn()
-
 
 if __name__== '__main__':
     uvicorn.run("application:app", host="127.0.0.1", port=8000, reload=True)
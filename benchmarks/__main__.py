@@ -0,0 +1,129 @@
+"""
+Runs the benchmark suite and compares results between commits:
+
+    python -m benchmarks run --output results.json [--quick] [--only predict label_fetch]
+    python -m benchmarks compare baseline.json results.json [--threshold 10] [--stats p50 p95]
+        [--min-delta-ms 0.01]
+
+run writes one JSON document with the commit, the environment and the result of every benchmark.
+compare prints the relative change of every latency (the --stats percentiles, p50 by default)
+and throughput measurement and exits with status 1 if any got worse by more than --threshold percent.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+from benchmarks import bench_cleaning, bench_data_fetch, bench_forest, bench_label_fetch, bench_login, bench_predict
+
+# benchmark -> (run function, arguments of a full run, arguments of a quick run)
+SUITES = {
+    "predict" : (bench_predict.run, {}, {"repeat" : 200, "load_repeat" : 2}),
+    "forest" : (bench_forest.run, {}, {"repeat" : 50}),
+    "cleaning" : (bench_cleaning.run, {}, {"n_messages" : 1000, "repeat" : 5}),
+    "label_fetch" : (bench_label_fetch.run, {}, {"requests" : 100, "concurrency_levels" : [1, 8]}),
+    "data_fetch" : (bench_data_fetch.run, {}, {"row_counts" : [10000], "repeat" : 5}),
+    "login" : (bench_login.run, {}, {"users" : 10000, "logins" : 50}),
+}
+LATENCY_KEYS = {"p50", "p95", "p99", "mean"}
+THROUGHPUT_KEYS = {"requests_per_second", "rows_per_second"}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suites(names : list, quick : bool) -> dict:
+    results = {}
+    for name in names:
+        run, full_args, quick_args = SUITES[name]
+        print(f"running {name}", file=sys.stderr)
+        results[name] = run(**(quick_args if quick else full_args))
+    return {
+        "commit" : git_commit(),
+        "timestamp" : datetime.now(timezone.utc).isoformat(),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "quick" : quick,
+        "suites" : results,
+    }
+
+
+def measurements(document : dict, stats : set = LATENCY_KEYS, prefix : str = "") -> dict:
+    """
+    Flattens the latency (stats) and throughput values of a results document into path -> value
+    """
+    values = {}
+    for key, value in document.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(measurements(value, stats, path))
+        elif key in stats | THROUGHPUT_KEYS and isinstance(value, (int, float)):
+            values[path] = value
+    return values
+
+
+def compare(baseline : dict, current : dict, threshold : float, stats : set = {"p50"},
+            min_delta_ms : float = 0.01) -> list:
+    """
+    Returns (path, baseline, current, change in percent, regressed) for every measurement in both.
+    Latencies that grew by less than min_delta_ms are timer noise and never regressions
+    """
+    before, after = measurements(baseline["suites"], stats), measurements(current["suites"], stats)
+    rows = []
+    for path in sorted(before.keys() & after.keys()):
+        if not before[path]:
+            continue
+        change = (after[path] - before[path]) / before[path] * 100
+        # latencies regress when they grow, throughputs when they shrink
+        if path.rsplit(".", 1)[-1] in THROUGHPUT_KEYS:
+            regressed = -change > threshold
+        else:
+            regressed = change > threshold and after[path] - before[path] > min_delta_ms
+        rows.append((path, before[path], after[path], change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", help="file to write the results to, default stdout")
+    run_parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer repeats")
+    run_parser.add_argument("--only", nargs="+", choices=list(SUITES), default=list(SUITES))
+    compare_parser = commands.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent")
+    compare_parser.add_argument("--stats", nargs="+", choices=sorted(LATENCY_KEYS), default=["p50"],
+                                help="latency statistics to compare")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=0.01,
+                                help="latency increase in milliseconds below which nothing regressed")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        document = json.dumps(run_suites(args.only, args.quick), indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(document + "\n")
+        else:
+            print(document)
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold, set(args.stats), args.min_delta_ms)
+    for path, before, after, change, regressed in rows:
+        print(f"{'REGRESSION ' if regressed else ''}{path}: {before:.3f} -> {after:.3f} ({change:+.1f}%)")
+    sys.exit(1 if any(row[4] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Message cleaning of the extraction, the original one-pass-per-step StringProc (_old) against
+the fused StringProc.clean_messages, on a generated corpus of lead descriptions:
+
+    python -m benchmarks.bench_cleaning --messages 5000 --repeat 20
+
+Prints a JSON document with the time to clean the whole corpus in milliseconds (percentiles
+over the repeats), and the number of messages whose cleaned text differs between both.
+"""
+import argparse
+import json
+import random
+
+from _old.extraction_processing import StringProc as LegacyStringProc
+from app.extraction.processing import StringProc
+from benchmarks.common import percentiles, time_calls
+
+# building blocks of the generated descriptions, including the cases the fused cleaner has
+# to treat like the sequential passes: tags inside URLs, entities next to URLs, + runs, emojis
+TOKENS = ["odoo", "python", "developer", "needed", "for", "a", "long", "term", "project", "C++",
+          "R&amp;D", "&amp;", "&nbsp;", "&nbsp;&amp;", "&amp;nbsp;", "+", "++", "a+b", "1+1=2",
+          "https://www.upwork.com/jobs/~01", "http://example.com/a?b=c&amp;d=e", "xhttps://y.z",
+          "http://foo<br />bar", "<a href='http://x.y'>link</a>", "<br />", "<br>", "<p>", "</p>",
+          "<li>item</li>", "\n", "\t", "  ", " ", "\U0001F600", "❤️", "été",
+          "3 < 4 > 2", "&lt;b&gt;", "$500", "50%"]
+EMBEDDED_INFO = ("<b>Hourly Range</b>: $7.00-$20.00\n<br><b>Posted On</b>: August 06, 2023 09:40 UTC<br>"
+                 "<b>Category</b>: Full Stack Development<br><b>Skills</b>:Odoo,     Python<br>"
+                 "<b>Country</b>: Australia\n<br><a href=\"https://www.upwork.com/jobs/~01\">click to apply</a>")
+
+
+def random_messages(n : int, seed : int = 0) -> list:
+    """
+    Returns n lead descriptions of random length, most of them followed by embedded info
+    """
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(n):
+        words = rng.choices(TOKENS, k=rng.randint(0, 400))
+        text = "".join(word + rng.choice([" ", "", "\n", "  "]) for word in words)
+        messages.append(text + (EMBEDDED_INFO if rng.random() < 0.9 else ""))
+    return messages
+
+
+def legacy_clean(processor : LegacyStringProc, txt : str, remove_emoji : bool = False) -> str:
+    """
+    The message cleaning of the extractor, one pass per step
+    """
+    txt = processor.extract_message_txt(txt)
+    txt = processor.strip_html(txt)
+    if remove_emoji:
+        txt = processor.emoji_remove(txt)
+    txt = processor.strip_urls(txt)
+    txt = processor.replace_amp(txt)
+    txt = processor.replace_nbsp(txt)
+    return processor.remove_all_extra_symbols(txt)
+
+
+def run(n_messages : int = 5000, repeat : int = 20) -> dict:
+    """
+    Returns the time to clean the corpus with both cleaners, and their mismatches
+    """
+    messages = random_messages(n_messages)
+    legacy, fused = LegacyStringProc(), StringProc()
+    results = {}
+    for remove_emoji in (False, True):
+        cleaners = {
+            "legacy" : lambda texts: [legacy_clean(legacy, txt, remove_emoji) for txt in texts],
+            "fused" : lambda texts: fused.clean_messages(texts, remove_emoji=remove_emoji),
+        }
+        expected, cleaned = cleaners["legacy"](messages), cleaners["fused"](messages)
+        results["remove_emoji" if remove_emoji else "default"] = {
+            "mismatches" : sum(a != b for a, b in zip(expected, cleaned)),
+            **{name : percentiles(time_calls(lambda: clean(messages), repeat)) for name, clean in cleaners.items()},
+        }
+    return {"benchmark" : "cleaning", "messages" : n_messages, "results" : results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(run(args.messages, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
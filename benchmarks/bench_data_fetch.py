@@ -0,0 +1,119 @@
+"""
+Latency of /data_fetch and /data_stream with a large Record warehouse, run offline against a
+temporary SQLite database:
+
+    python -m benchmarks.bench_data_fetch --rows 10000 100000 1000000 --repeat 20
+
+Prints a JSON document with, per table size, latency percentiles in milliseconds of fetching
+one page (unfiltered, by label, by posted_on range), the time to stream all rows as NDJSON and,
+up to --max-full-rows, to fetch all rows as one JSON list.
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+from sqlmodel import Session
+
+from app.auth.jwt_handler import signJWT
+from app.database.records import typed_fields
+from app.models.models import Record
+from application import app
+from benchmarks.common import percentiles, time_calls, sqlite_engine, override_session
+
+CATEGORIES = ["Full Stack Development", "Web Development", "Mobile Development", "Data Science", "Other"]
+COUNTRIES = ["Australia", "United States", "Pakistan", "Germany", "Canada"]
+INSERT_CHUNK_SIZE = 10000
+
+
+def random_records(n : int, start : int = 0, seed : int = 0) -> list:
+    """
+    Returns n Record rows as dicts, posted one minute apart from 2023-01-01
+    """
+    rng = random.Random(seed + start)
+    first = datetime(2023, 1, 1)
+    records = []
+    for i in range(n):
+        record = {
+            "posted_on" : (first + timedelta(minutes=start + i)).strftime("%B %d, %Y %H:%M UTC"),
+            "category" : rng.choice(CATEGORIES),
+            "skills" : "Python, Odoo",
+            "country" : rng.choice(COUNTRIES),
+            "message" : "odoo expert needed for a long term project " * rng.randint(1, 5),
+            "hourly_from" : str(rng.choice([5.0, 10.0, 20.0])),
+            "hourly_to" : str(rng.choice([20.0, 40.0, 60.0])),
+            "budget" : "",
+            "label" : rng.choice(["Applied", "Rejected"]),
+        }
+        record.update(typed_fields(record["posted_on"], record["hourly_from"], record["hourly_to"], record["budget"]))
+        records.append(record)
+    return records
+
+
+def fill_records(engine, rows : int, existing : int = 0) -> None:
+    """
+    Inserts rows - existing more records, in chunks
+    """
+    with Session(engine) as session:
+        for start in range(existing, rows, INSERT_CHUNK_SIZE):
+            session.execute(insert(Record.__table__), random_records(min(INSERT_CHUNK_SIZE, rows - start), start))
+            session.commit()
+
+
+def run(row_counts : list = (10000, 100000, 1000000), repeat : int = 20, page_size : int = 1000,
+        max_full_rows : int = 100000) -> dict:
+    """
+    Returns the data_fetch and data_stream measurements per table size
+    """
+    token = signJWT("bench@example.com")["access token"]
+    headers = {"Authorization" : f"Bearer {token.decode() if isinstance(token, bytes) else token}"}
+    results = {}
+    with sqlite_engine() as engine, override_session(app, engine):
+        client = TestClient(app)
+        existing = 0
+        for rows in sorted(row_counts):
+            fill_records(engine, rows, existing)
+            existing = rows
+            # pages start at random ids, so every request seeks into the table
+            after_ids = iter([random.randrange(max(rows - page_size, 1)) for _ in range(repeat + 1)])
+            middle = (datetime(2023, 1, 1) + timedelta(minutes=rows // 2)).isoformat()
+
+            def get(path : str, **params):
+                response = client.get(path, headers=headers, params=params)
+                assert response.status_code == 200, response.text
+                return response
+
+            result = {
+                "page_ms" : percentiles(time_calls(
+                    lambda: get("/data_fetch", limit=page_size, after_id=next(after_ids)), repeat)),
+                "page_by_label_ms" : percentiles(time_calls(
+                    lambda: get("/data_fetch", limit=page_size, label="Applied"), repeat)),
+                "page_by_posted_range_ms" : percentiles(time_calls(
+                    lambda: get("/data_fetch", limit=page_size, posted_from=middle), repeat)),
+            }
+            start = time.perf_counter()
+            streamed = get("/data_stream").content.count(b"\n")
+            elapsed = time.perf_counter() - start
+            result["stream"] = {"rows" : streamed, "seconds" : elapsed, "rows_per_second" : streamed / elapsed}
+            if rows <= max_full_rows:
+                result["full_fetch_ms"] = percentiles(time_calls(lambda: get("/data_fetch"), 1, warmup=0))
+            results[str(rows)] = result
+    return {"benchmark" : "data_fetch", "page_size" : page_size, "rows" : results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--max-full-rows", type=int, default=100000,
+                        help="largest table size fetched as one JSON list")
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.repeat, args.page_size, args.max_full_rows), indent=2))
+
+
+if __name__ == "__main__":
+    main()
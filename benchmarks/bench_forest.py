@@ -0,0 +1,52 @@
+"""
+Latency of tree ensemble inference, sklearn's predict against the compiled ForestArrays backend:
+
+    python -m benchmarks.bench_forest --model rf_clf_v0.model --repeat 200
+
+Prints a JSON document with latency percentiles in milliseconds per batch size (1, 32, 1024),
+and whether both backends predicted the same labels.
+"""
+import argparse
+import json
+
+import numpy as np
+
+from app.predict.artifacts import load_model_file
+from benchmarks.common import percentiles, time_calls
+
+
+def random_leads(n : int, seed : int = 0) -> np.array:
+    """
+    Returns n encoded leads: [budget, hourly_from, hourly_to, encoded_country, encoded_category]
+    """
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.choice([0.0, 50.0, 500.0, 5000.0], n), rng.uniform(0, 100, n),
+                            rng.uniform(0, 150, n), rng.integers(0, 88, n), rng.integers(0, 48, n)]).astype(float)
+
+
+def run(model_file : str = "rf_clf_v0.model", repeat : int = 200, batch_sizes : list = (1, 32, 1024)) -> dict:
+    """
+    Returns the predict latencies of both backends per batch size
+    """
+    backends = {name : load_model_file(model_file, backend=name) for name in ("sklearn", "compiled")}
+    results = {}
+    for batch_size in batch_sizes:
+        X = random_leads(batch_size, seed=batch_size)
+        results[str(batch_size)] = {
+            "identical_labels" : bool((backends["sklearn"].predict(X) == backends["compiled"].predict(X)).all()),
+            **{name : percentiles(time_calls(lambda: model.predict(X), repeat)) for name, model in backends.items()},
+        }
+    return {"benchmark" : "forest", "model" : model_file, "batch_sizes" : results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="rf_clf_v0.model")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 1024])
+    args = parser.parse_args()
+    print(json.dumps(run(args.model, args.repeat, args.batch_sizes), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+End-to-end throughput and latency of /label_fetch at several concurrency levels, run offline
+in-process against a temporary SQLite database:
+
+    python -m benchmarks.bench_label_fetch --requests 500 --concurrency 1 8 32
+
+Prints a JSON document with, per concurrency level, the requests per second and the latency
+percentiles in milliseconds, the number of failed requests and the micro-batch sizes reached.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from httpx import AsyncClient
+from sqlmodel import Session
+
+from app.auth.jwt_handler import signJWT
+from app.models.models import MLModel
+from app.predict.batcher import micro_batcher
+from application import app
+from benchmarks.bench_predict import LEAD
+from benchmarks.common import percentiles, sqlite_engine, override_session
+
+
+async def fetch_labels(client : AsyncClient, headers : dict, requests : int, concurrency : int) -> dict:
+    """
+    Sends requests label_fetch requests from concurrency workers, returns the measurements
+    """
+    latencies, failed = [], 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal failed
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.post("/label_fetch", headers=headers, json={**LEAD, "model_name" : "rf_clf_v0"})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or "label" not in response.json():
+                failed += 1
+
+    micro_batcher.batch_sizes.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests_per_second" : requests / elapsed,
+        "latency_ms" : percentiles(latencies),
+        "failed" : failed,
+        "batch_sizes" : {str(size) : count for size, count in sorted(micro_batcher.batch_sizes.items())},
+    }
+
+
+def run(requests : int = 500, concurrency_levels : list = (1, 8, 32), model_file : str = "rf_clf_v0.model") -> dict:
+    """
+    Returns the label_fetch measurements per concurrency level
+    """
+    token = signJWT("bench@example.com")["access token"]
+    headers = {"Authorization" : f"Bearer {token.decode() if isinstance(token, bytes) else token}"}
+
+    async def measure() -> dict:
+        results = {}
+        async with AsyncClient(app=app, base_url="http://bench") as client:
+            await fetch_labels(client, headers, 10, 1) # warm-up: model cache, token cache
+            for concurrency in concurrency_levels:
+                results[str(concurrency)] = await fetch_labels(client, headers, requests, concurrency)
+        return results
+
+    with sqlite_engine() as engine:
+        with Session(engine) as session:
+            session.add(MLModel(model_name="rf_clf_v0", model_file=model_file))
+            session.commit()
+        with override_session(app, engine):
+            results = asyncio.run(measure())
+    return {"benchmark" : "label_fetch", "requests" : requests, "concurrency" : results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--model", default="rf_clf_v0.model")
+    args = parser.parse_args()
+    print(json.dumps(run(args.requests, args.concurrency, args.model), indent=2))
+
+
+if __name__ == "__main__":
+    main()
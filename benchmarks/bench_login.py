@@ -0,0 +1,75 @@
+"""
+Login latency with a large Users table, run offline against a temporary SQLite database:
+
+    python -m benchmarks.bench_login --users 100000 --logins 200
+
+Prints a JSON document with latency percentiles in milliseconds of the indexed email lookup alone,
+of the password verification alone, and of the /user/login endpoint end-to-end.
+The application settings (secret, algorithm, DB_*) are read from the environment or .env as usual.
+"""
+import argparse
+import json
+import random
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+from sqlmodel import Session, select
+
+from app.auth.password import hash_password, verify_password
+from app.models.models import Users
+from application import app
+from benchmarks.common import percentiles, sqlite_engine, override_session
+
+
+def run(users : int = 100000, logins : int = 200) -> dict:
+    """
+    Returns the lookup, password verification and login latencies with users in the table
+    """
+    with sqlite_engine() as engine:
+        # every user shares one hash, only the lookup depends on the table size
+        password_hash = hash_password("string")
+        with Session(engine) as session:
+            session.execute(insert(Users.__table__),
+                            [{"fullname" : f"user{i}", "email" : f"user{i}@example.com", "password" : password_hash}
+                             for i in range(users)])
+            session.commit()
+
+        emails = [f"user{random.randrange(users)}@example.com" for _ in range(logins)]
+        lookup, verify, login = [], [], []
+        with Session(engine) as session:
+            for email in emails:
+                start = time.perf_counter()
+                user = session.exec(select(Users).where(Users.email == email)).first()
+                lookup.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                verify_password("string", user.password)
+                verify.append(time.perf_counter() - start)
+
+        with override_session(app, engine):
+            client = TestClient(app)
+            for email in emails:
+                start = time.perf_counter()
+                response = client.post("/user/login", json={"email" : email, "password" : "string"})
+                login.append(time.perf_counter() - start)
+                assert "access token" in response.json()
+
+    return {
+        "benchmark" : "login",
+        "users" : users,
+        "lookup_ms" : percentiles(lookup),
+        "verify_password_ms" : percentiles(verify),
+        "login_ms" : percentiles(login),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--logins", type=int, default=200)
+    args = parser.parse_args()
+    print(json.dumps(run(args.users, args.logins), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Latency of the single lead scoring steps and of loading the stored models:
+
+    python -m benchmarks.bench_predict --repeat 1000 --load-repeat 5
+
+Prints a JSON document with latency percentiles in milliseconds of Predict.encode_lead,
+vectorize_lead and predict_lead (per inference backend), and of loading every model file
+in models/ (and rf_clf_v0.model) from disk and from the in-process model cache.
+"""
+import argparse
+import glob
+import json
+import os
+
+from app.predict.artifacts import load_model_file
+from app.predict.predict import Predict
+from app.predict.registry import ModelRegistry
+from benchmarks.common import percentiles, time_calls
+
+LEAD = {'posted_on': 'August 06, 2023 09:40 UTC', 'category': 'Full Stack Development', 'skills': 'Odoo',
+        'country': 'Australia', 'message': 'odoo expert', 'hourly_from': 7.0, 'hourly_to': 20.0, 'budget': ''}
+
+
+def model_files(directory : str = "models") -> list:
+    """
+    Returns the stored model files and forest directories, and the bundled rf_clf_v0.model
+    """
+    files = sorted(path for path in glob.glob(os.path.join(directory, "*")) if not os.path.basename(path).startswith("."))
+    if os.path.exists("rf_clf_v0.model"):
+        files.append("rf_clf_v0.model")
+    return files
+
+
+def run(repeat : int = 1000, load_repeat : int = 5, directory : str = "models") -> dict:
+    """
+    Returns the latencies of the scoring steps and of model loading
+    """
+    files = model_files(directory)
+    pr = Predict()
+    encoded = pr.encode_lead(LEAD)
+    vector = pr.vectorize_lead(encoded)
+    steps = {
+        "encode_lead" : percentiles(time_calls(lambda: pr.encode_lead(LEAD), repeat)),
+        "vectorize_lead" : percentiles(time_calls(lambda: pr.vectorize_lead(encoded), repeat)),
+    }
+    if files:
+        for backend in ("sklearn", "compiled"):
+            model = load_model_file(files[-1], backend=backend)
+            steps[f"predict_lead_{backend}"] = percentiles(time_calls(lambda: pr.predict_lead(vector, model), repeat))
+
+    loading = {}
+    for model_file in files:
+        registry = ModelRegistry()
+        registry.get(model_file, model_file)
+        loading[model_file] = {
+            "bytes" : os.path.getsize(model_file) if os.path.isfile(model_file) else None,
+            "load_ms" : percentiles(time_calls(lambda: load_model_file(model_file), load_repeat, warmup=0)),
+            "cache_hit_ms" : percentiles(time_calls(lambda: registry.get(model_file, model_file), repeat)),
+        }
+    return {"benchmark" : "predict", "steps" : steps, "model_loading" : loading}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--load-repeat", type=int, default=5)
+    parser.add_argument("--models", default="models", help="directory of the stored models")
+    args = parser.parse_args()
+    print(json.dumps(run(args.repeat, args.load_repeat, args.models), indent=2))
+
+
+if __name__ == "__main__":
+    main()
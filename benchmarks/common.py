@@ -0,0 +1,67 @@
+"""
+Helpers shared by the benchmarks: latency percentiles, timing loops and a temporary SQLite
+database standing in for Postgres, with the application's session dependency pointed at it
+"""
+import contextlib
+import os
+import tempfile
+import time
+
+import numpy as np
+from sqlmodel import Session, SQLModel, create_engine
+
+from app.database.connection import get_session
+
+
+def percentiles(samples : list) -> dict:
+    """
+    Returns p50, p95, p99 and mean of latency samples given in seconds, in milliseconds
+    """
+    ms = np.array(samples) * 1000
+    return {"p50" : float(np.percentile(ms, 50)), "p95" : float(np.percentile(ms, 95)),
+            "p99" : float(np.percentile(ms, 99)), "mean" : float(ms.mean()), "n" : len(samples)}
+
+
+def time_calls(fn, repeat : int, warmup : int = 1) -> list:
+    """
+    Calls fn() warmup times untimed, then repeat times, returns the durations in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+@contextlib.contextmanager
+def sqlite_engine():
+    """
+    Yields an engine on a new SQLite database file with all tables created, removed afterwards
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                               connect_args={"check_same_thread" : False, "timeout" : 30})
+        SQLModel.metadata.create_all(engine)
+        try:
+            yield engine
+        finally:
+            engine.dispose()
+
+
+@contextlib.contextmanager
+def override_session(app, engine):
+    """
+    Serves the app's get_session dependency from engine while the block runs
+    """
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_session_override
+    try:
+        yield
+    finally:
+        app.dependency_overrides.pop(get_session, None)
@@ -1,14 +1,51 @@
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel import Session, SQLModel, create_engine, select
 from sqlmodel.pool import StaticPool  
 import pytest
 import json
+import os
+import hashlib
+import io
+import openpyxl
+import time
+import asyncio
+from datetime import datetime
+import numpy as np
 
-from app.database.connection import get_session
+from app.database.connection import get_session, pool_stats, TimedQueuePool
 from application import app
-from app.models.models import Record
+from app.routes import routes
+from app.profiling.middleware import ProfilingMiddleware
+from app.models.models import Record, MLModel, Users, RecordFilter, LeadStat
+from app.auth.jwt_handler import signJWT, utcTimestamp
+from app.auth.jwt_bearer import TokenCache
+from app.predict.registry import ModelRegistry
+from app.predict.predict import Predict, UNKNOWN_CODE
+from app.predict.executor import InferenceExecutor, InferenceSaturated
+from app.predict.batcher import MicroBatcher
+from app.predict.warmup import preload_models
+from app.predict.aliases import ShadowScorer
+from app.predict.rescoring import create_job, read_batch, rescore_records
+from app.predict.training import register_model, TrainingJobs
+from sqlalchemy.exc import IntegrityError, OperationalError
+from app.extraction.feed import FeedParser, item_lead
+from app.extraction.processing import StringProc
+from app.database.records import iter_records
+from app.database.migrations import add_missing_columns, backfill_records, check_schema
+from app.database.connection import create_indexes
+from app.database.stats import rebuild_stats
+from app.database.export import chunks_to_xlsx, arrow_available, pa as pyarrow
+from sqlalchemy import Index, inspect, text
+from app.metrics.metrics import Counter, Histogram, render, STAGE_SECONDS, PREDICTIONS
+from benchmarks.bench_cleaning import random_messages, legacy_clean, LegacyStringProc
+from app.predict.artifacts import convert_model_file, load_model_file, model_memory, ForestArrays
+from app.database.writer import RecordWriter
 from httpx import AsyncClient
 
+# a lead as sent to the labeling endpoints, tests vary copies of it
+LEAD = {'posted_on': 'August 06, 2023 09:40 UTC', 'category': 'Full Stack Development', 'skills': 'Odoo', 'country': 'Australia', 'message': 'odoo expert', 'hourly_from': 7.0, 'hourly_to': 20.0, 'budget': '', 'model_name' : 'rf_clf_v0'}
+
+
 # 1 ---- test database and session creation using pytest fixtures to reduce boilerplate code ----
 @pytest.fixture(name="session")
 def session_fixture():
@@ -31,6 +68,13 @@ def client_fixture(session: Session):
     app.dependency_overrides.clear()  
 
 
+@pytest.fixture(name="token")
+def token_fixture():
+    # a token signed with the configured secret, PyJWT 1.x encodes to bytes
+    token = signJWT("abd@example.com")["access token"]
+    return token.decode() if isinstance(token, bytes) else token
+
+
 # 2 ---- Unit tests ----
 
 def test_server_running(client : TestClient):
@@ -111,3 +155,738 @@ def test_signup_login_already_exist(session : Session, client : TestClient):
         )
     data = json.loads(response.text)
     assert data == {"notification" : "user already exists"}
+
+
+def test_model_registry_cache(tmp_path):
+    registry = ModelRegistry(max_models=1)
+    first = registry.get("rf_clf_v0", "rf_clf_v0.model")
+    assert registry.get("rf_clf_v0", "rf_clf_v0.model") is first
+    assert registry.stats()["hits"] == 1 and registry.stats()["misses"] == 1
+
+    # a second model evicts the least recently used one
+    registry.get("other", "models/9592bee3b512fe3467d5.model")
+    assert registry.stats()["evictions"] == 1
+    assert registry.stats()["models"] == ["other"]
+
+    registry.invalidate("other")
+    assert registry.stats()["size"] == 0 and registry.stats()["invalidations"] == 1
+
+
+def test_label_fetch_batch(session : Session, client : TestClient, token : str):
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    lead = dict(LEAD)
+    leads = [lead, dict(lead, model_name='missing'), dict(lead, category='', budget=500.0, hourly_from='', hourly_to=''),
+             dict(lead, budget='not a number')]
+    response = client.post('http://127.0.0.1:8000/label_fetch_batch',
+                           headers={'Authorization' : f'Bearer {token}'},
+                           json=leads)
+    data = json.loads(response.text)
+    assert response.status_code == 200
+    assert len(data) == 4
+    assert data[0]['label'] in ('Applied', 'Rejected')
+    assert 'error' in data[1]
+    assert data[2]['label'] in ('Applied', 'Rejected')
+    assert 'error' in data[3]
+    assert len(session.exec(select(Record)).all()) == 2
+
+
+def test_label_fetch_batch_reports_out_of_range_leads_alone(session : Session, client : TestClient, token : str):
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    # finite in float64 but not in the float32 the models predict in
+    leads = [LEAD, dict(LEAD, budget='1e39'), dict(LEAD, hourly_to='inf'), LEAD]
+    response = client.post('http://127.0.0.1:8000/label_fetch_batch',
+                           headers={'Authorization' : f'Bearer {token}'},
+                           json=leads)
+    data = json.loads(response.text)
+    assert response.status_code == 200
+    assert data[0]['label'] in ('Applied', 'Rejected') and data[3]['label'] == data[0]['label']
+    assert 'error' in data[1] and 'error' in data[2]
+    assert len(session.exec(select(Record)).all()) == 2
+
+
+def test_encode_leads_matches_encode_lead():
+    pr = Predict()
+    leads = [
+        LEAD,
+        {'category': '', 'country': '', 'budget': 500.0, 'hourly_from': '', 'hourly_to': ''},
+        {'category': 'Underwater Basket Weaving', 'country': 'Atlantis', 'budget': 10.0, 'hourly_from': '', 'hourly_to': ''},
+    ]
+    matrix = pr.encode_leads(leads)
+    for row, lead in zip(matrix, leads):
+        assert (row == pr.vectorize_lead(pr.encode_lead(lead))[0]).all()
+    assert matrix[1, 3] == 84 and matrix[1, 4] == 25
+    assert matrix[2, 3] == UNKNOWN_CODE and matrix[2, 4] == UNKNOWN_CODE
+
+
+@pytest.mark.asyncio
+async def test_inference_executor_rejects_when_saturated():
+    executor = InferenceExecutor(max_workers=1, max_queue=0)
+    slow = asyncio.ensure_future(executor.run(time.sleep, 0.2))
+    await asyncio.sleep(0.05)
+    with pytest.raises(InferenceSaturated):
+        await executor.run(time.sleep, 0)
+    await slow
+    assert await executor.run(sum, [1, 2]) == 3
+    assert executor.stats()["rejected"] == 1
+    executor.shutdown()
+
+
+def test_label_fetch(session : Session, client : TestClient, token : str):
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    lead = dict(LEAD)
+    response = client.post('http://127.0.0.1:8000/label_fetch',
+                           headers={'Authorization' : f'Bearer {token}'},
+                           json=lead)
+    assert response.status_code == 200
+    assert json.loads(response.text)['label'] in ('Applied', 'Rejected')
+    assert len(session.exec(select(Record)).all()) == 1
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_coalesces_concurrent_predictions():
+    model = ModelRegistry().get("rf_clf_v0", "rf_clf_v0.model")
+    pr = Predict()
+    leads = [dict(LEAD, hourly_from=float(i)) for i in range(5)]
+    vectors = [pr.vectorize_lead(pr.encode_lead(lead)) for lead in leads]
+    executor = InferenceExecutor(max_workers=1, max_queue=8)
+    batcher = MicroBatcher(executor=executor, max_wait_ms=50, max_size=4)
+
+    labels = await asyncio.gather(*[batcher.predict("rf_clf_v0", model, vector) for vector in vectors])
+    assert labels == [pr.predict_lead(vector, model) for vector in vectors]
+    # the first is predicted right away, the four arriving meanwhile fill a batch
+    assert batcher.stats()["batch_sizes"] == {1 : 1, 4 : 1}
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_predicts_a_lone_request_right_away():
+    model = ModelRegistry().get("rf_clf_v0", "rf_clf_v0.model")
+    pr = Predict()
+    vector = pr.vectorize_lead(pr.encode_lead(LEAD))
+    executor = InferenceExecutor(max_workers=1, max_queue=8)
+    # a request waits for more requests only while a prediction of its model is running
+    batcher = MicroBatcher(executor=executor, max_wait_ms=0, max_size=4)
+
+    assert await batcher.predict("rf_clf_v0", model, vector) == pr.predict_lead(vector, model)
+    assert await batcher.predict("rf_clf_v0", model, vector) == pr.predict_lead(vector, model)
+    assert batcher.stats()["batch_sizes"] == {1 : 2}
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_rejects_non_finite_vectors():
+    model = ModelRegistry().get("rf_clf_v0", "rf_clf_v0.model")
+    pr = Predict()
+    valid = pr.vectorize_lead(pr.encode_lead(LEAD))
+    # NaN, and finite in float64 but not in the float32 the models predict in
+    invalid = [pr.vectorize_lead(pr.encode_lead(dict(LEAD, budget=budget))) for budget in ('NaN', 1e39)]
+    executor = InferenceExecutor(max_workers=1, max_queue=8)
+    batcher = MicroBatcher(executor=executor, max_wait_ms=50, max_size=4)
+
+    labels = await asyncio.gather(batcher.predict("rf_clf_v0", model, valid),
+                                  *[batcher.predict("rf_clf_v0", model, vector) for vector in invalid],
+                                  batcher.predict("rf_clf_v0", model, valid), return_exceptions=True)
+    # the invalid leads fail on their own, the lead they would have been batched with is predicted
+    assert labels[0] == labels[3] == pr.predict_lead(valid, model)
+    assert isinstance(labels[1], ValueError) and isinstance(labels[2], ValueError)
+    assert batcher.stats()["batch_sizes"] == {1 : 2}
+    executor.shutdown()
+
+
+def test_data_fetch_pages_and_stream(session : Session, client : TestClient, token : str):
+    for i in range(5):
+        session.add(Record(posted_on=f'August 0{i + 1}, 2023 09:40 UTC', category='SEO', country='Australia',
+                           label='Applied' if i % 2 == 0 else 'Rejected'))
+    session.commit()
+    headers = {'Authorization' : f'Bearer {token}'}
+
+    response = client.get('http://127.0.0.1:8000/data_fetch', headers=headers, params={'limit' : 2})
+    assert [record['id'] for record in json.loads(response.text)] == [1, 2]
+    next_after_id = response.headers['X-Next-After-Id']
+    response = client.get('http://127.0.0.1:8000/data_fetch', headers=headers, params={'limit' : 2, 'after_id' : next_after_id})
+    assert [record['id'] for record in json.loads(response.text)] == [3, 4]
+
+    response = client.get('http://127.0.0.1:8000/data_fetch', headers=headers,
+                          params={'label' : 'Applied', 'posted_from' : '2023-08-02T00:00:00', 'posted_to' : '2023-08-05T00:00:00'})
+    assert [record['id'] for record in json.loads(response.text)] == [3]
+
+    response = client.get('http://127.0.0.1:8000/data_stream', headers=headers, params={'label' : 'Rejected'})
+    assert [json.loads(line)['id'] for line in response.text.splitlines()] == [2, 4]
+
+    response = client.get('http://127.0.0.1:8000/data_stream', headers=headers, params={'format' : 'csv'})
+    lines = response.text.splitlines()
+    assert lines[0].startswith('id,') and len(lines) == 6
+
+
+def test_lead_stats_incremental_and_rebuild(session : Session, client : TestClient, token : str):
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    lead = dict(LEAD)
+    headers = {'Authorization' : f'Bearer {token}'}
+    client.post('http://127.0.0.1:8000/label_fetch_batch', headers=headers,
+                json=[lead, dict(lead, category='SEO'), dict(lead, category='SEO', posted_on='August 07, 2023 10:00 UTC')])
+    client.post('http://127.0.0.1:8000/label_fetch', headers=headers, json=dict(lead, posted_on='unknown'))
+
+    response = client.get('http://127.0.0.1:8000/lead_stats', headers=headers, params={'group_by' : ['category']})
+    assert response.json() == {"total" : 4, "groups" : [{"category" : "Full Stack Development", "leads" : 2}, {"category" : "SEO", "leads" : 2}]}
+    response = client.get('http://127.0.0.1:8000/lead_stats', headers=headers, params={'group_by' : ['day'], 'day_from' : '2023-08-07'})
+    assert response.json()["groups"] == [{"day" : "2023-08-07", "leads" : 1}]
+    assert client.get('http://127.0.0.1:8000/lead_stats', headers=headers, params={'group_by' : ['skills']}).status_code == 400
+
+    # records written around the statistics and counts without records are corrected by the rebuild
+    session.add(Record(category='SEO', country='Australia', label='Applied'))
+    session.add(LeadStat(day='', label='Rejected', category='SEO', country='Australia', leads=3))
+    session.commit()
+    engine = session.get_bind()
+    assert rebuild_stats(engine, check_only=True) == {("", "Applied", "SEO", "Australia") : (0, 1),
+                                                      ("", "Rejected", "SEO", "Australia") : (3, 0)}
+    rebuild_stats(engine)
+    assert rebuild_stats(engine, check_only=True) == {}
+    response = client.get('http://127.0.0.1:8000/lead_stats', headers=headers)
+    assert response.json() == {"total" : 5, "groups" : [{"leads" : 5}]}
+
+
+def test_data_export(session : Session, client : TestClient, token : str):
+    for i in range(5):
+        session.add(Record(posted_on=f'August 0{i + 1}, 2023 09:40 UTC', category='SEO', message='odoo\x0bexpert',
+                           label='Applied' if i % 2 == 0 else 'Rejected', posted_at=datetime(2023, 8, i + 1, 9, 40)))
+    session.commit()
+    headers = {'Authorization' : f'Bearer {token}'}
+
+    response = client.get('http://127.0.0.1:8000/data_export', headers=headers,
+                          params={'format' : 'xlsx', 'columns' : ['id', 'message', 'posted_at'], 'label' : 'Applied'})
+    assert response.status_code == 200
+    rows = list(openpyxl.load_workbook(io.BytesIO(response.content), read_only=True)["records"].values)
+    assert rows == [('id', 'message', 'posted_at'), (1, 'odooexpert', datetime(2023, 8, 1, 9, 40)),
+                    (3, 'odooexpert', datetime(2023, 8, 3, 9, 40)), (5, 'odooexpert', datetime(2023, 8, 5, 9, 40))]
+    # worksheets are rolled over when full
+    sheets = [list(sheet.values) for sheet in openpyxl.load_workbook(io.BytesIO(b"".join(
+        chunks_to_xlsx(iter([[(1,), (2,)], [(3,)]]), ['id'], max_rows=3))), read_only=True).worksheets]
+    assert sheets == [[('id',), (1,), (2,)], [('id',), (3,)]]
+
+    assert client.get('http://127.0.0.1:8000/data_export', headers=headers,
+                      params={'format' : 'xlsx', 'columns' : ['password']}).status_code == 400
+    response = client.get('http://127.0.0.1:8000/data_export', headers=headers,
+                          params={'format' : 'arrow', 'posted_from' : '2023-08-04T00:00:00'})
+    if not arrow_available():
+        assert response.status_code == 501
+        return
+    table = pyarrow.ipc.open_stream(response.content).read_all()
+    assert table.column('id').to_pylist() == [4, 5]
+    response = client.get('http://127.0.0.1:8000/data_export', headers=headers,
+                          params={'format' : 'parquet', 'columns' : ['id', 'label'], 'limit' : 2})
+    assert pyarrow.parquet.read_table(io.BytesIO(response.content)).to_pydict() == {'id' : [1, 2], 'label' : ['Applied', 'Rejected']}
+
+
+def test_record_writer_bulk_inserts_and_flushes_on_stop():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(engine)
+    writer = RecordWriter(engine=engine, enabled=True, queue_size=3, batch_size=2, interval_ms=10000)
+    assert all(writer.submit(Record(category='SEO', label='Applied')) for _ in range(3))
+    writer.stop()
+    with Session(engine) as session:
+        assert len(session.exec(select(Record)).all()) == 3
+        assert session.exec(select(LeadStat)).one().leads == 3
+    assert writer.stats()["written"] == 3 and writer.stats()["flushes"] == 2
+
+
+def test_pool_stats(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=TimedQueuePool, pool_size=2, max_overflow=1)
+    with engine.connect():
+        stats = pool_stats(engine)
+        assert stats["checked_out"] == 1 and stats["pool_size"] == 2
+    assert pool_stats(engine)["checkouts"] == 1
+
+
+def test_login_hashed_and_legacy_passwords(session : Session, client : TestClient):
+    response = client.post('http://127.0.0.1:8000/user/signup',
+                           json={"fullname": "abd", "email": "abd@example.com", "password": "string"})
+    assert json.loads(response.text) == {"success" : "user has successfully signed up"}
+    stored = session.exec(select(Users).where(Users.email == "abd@example.com")).one()
+    assert stored.password != "string" and stored.password.startswith("pbkdf2_sha256$")
+
+    response = client.post('http://127.0.0.1:8000/user/login', json={"email": "abd@example.com", "password": "string"})
+    assert "access token" in json.loads(response.text)
+    response = client.post('http://127.0.0.1:8000/user/login', json={"email": "abd@example.com", "password": "wrong"})
+    assert json.loads(response.text) == {"error" : "invalid login details"}
+
+    # a user stored with a plaintext password before hashing is upgraded on login
+    session.add(Users(fullname="old", email="old@example.com", password="plain"))
+    session.commit()
+    response = client.post('http://127.0.0.1:8000/user/login', json={"email": "old@example.com", "password": "plain"})
+    assert "access token" in json.loads(response.text)
+    assert session.exec(select(Users).where(Users.email == "old@example.com")).one().password.startswith("pbkdf2_sha256$")
+
+
+def test_token_cache_expires_entries(token : str):
+    cache = TokenCache(max_size=1, ttl=300)
+    assert not cache.is_verified(token)
+    cache.add(token, expires=utcTimestamp() + 3600)
+    assert cache.is_verified(token)
+    # never trusted beyond the token's own expiry
+    cache.add(token, expires=utcTimestamp() - 1)
+    assert not cache.is_verified(token)
+    # bounded: the least recently verified token is dropped
+    cache.add("first", expires=utcTimestamp() + 3600)
+    cache.add("second", expires=utcTimestamp() + 3600)
+    assert not cache.is_verified("first") and cache.is_verified("second")
+    assert cache.stats()["hits"] == 2
+
+
+def test_preload_models_and_ready(session : Session, client : TestClient):
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.add(MLModel(model_name="broken", model_file="missing.model"))
+    session.commit()
+    registry = ModelRegistry()
+    status = preload_models(session, model_names=[], registry=registry)
+    assert status["rf_clf_v0"] == "ready" and status["broken"].startswith("error")
+    assert registry.stats()["models"] == ["rf_clf_v0"]
+
+    # the lifespan warm-up has not run for this client
+    assert client.get('http://127.0.0.1:8000/ready').status_code == 503
+
+
+def test_memory_mapped_forest_matches_pickled_model(tmp_path):
+    pickled = tmp_path / "rf_clf_v0.model"
+    pickled.write_bytes(open("rf_clf_v0.model", "rb").read())
+    directory = convert_model_file(str(pickled))
+    assert directory.endswith(".forest") and not pickled.exists()
+
+    forest = load_model_file(directory)
+    assert isinstance(forest, ForestArrays)
+    assert model_memory(forest)["private_bytes"] == 0 and model_memory(forest)["mapped_bytes"] > 0
+
+    model = load_model_file("rf_clf_v0.model")
+    rng = np.random.default_rng(0)
+    X = np.column_stack([rng.uniform(0, 2000, 500), rng.uniform(0, 100, 500), rng.uniform(0, 150, 500),
+                         rng.integers(-1, 88, 500), rng.integers(-1, 48, 500)]).astype(float)
+    assert (forest.predict(X) == model.predict(X)).all()
+
+    # the byte bound of the cache counts the arrays of a model directory
+    registry = ModelRegistry(max_bytes=1)
+    registry.get("forest", directory)
+    assert registry.cached_bytes() == sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    assert registry.cached_bytes() >= model_memory(forest)["mapped_bytes"]
+
+
+def test_compiled_backend_matches_sklearn():
+    model = load_model_file("rf_clf_v0.model", backend="sklearn")
+    compiled = load_model_file("rf_clf_v0.model", backend="compiled")
+    assert isinstance(compiled, ForestArrays)
+    rng = np.random.default_rng(1)
+    X = np.column_stack([rng.choice([0.0, 50.0, 500.0, 5000.0], 2000), rng.uniform(0, 100, 2000),
+                         rng.uniform(0, 150, 2000), rng.integers(-1, 88, 2000), rng.integers(-1, 48, 2000)]).astype(float)
+    proba = compiled.predict_proba(X)
+    assert np.allclose(proba, model.predict_proba(X))
+    assert (compiled.classes_[np.argmax(proba, axis=1)] == model.predict(X)).all()
+    for batch_size in (1, 32):
+        assert (compiled.predict(X[:batch_size]) == model.predict(X[:batch_size])).all()
+    for value in (np.nan, np.inf, 1e300):
+        row = np.array([[value, 0.0, 0.0, 3, 25]])
+        with pytest.raises(ValueError) as expected:
+            model.predict(row)
+        with pytest.raises(ValueError) as raised:
+            compiled.predict(row)
+        assert str(raised.value) == str(expected.value).split("\n")[0]
+
+    # the memory of the sklearn model kept for large batches is counted with the node arrays
+    arrays_bytes = sum(array.nbytes for array in compiled.arrays().values())
+    assert model_memory(compiled)["private_bytes"] == arrays_bytes + model_memory(model)["private_bytes"]
+    registry = ModelRegistry(max_bytes=1)
+    registry.put("compiled", "rf_clf_v0.model", compiled)
+    assert registry.cached_bytes() == os.path.getsize("rf_clf_v0.model") + arrays_bytes
+
+
+def test_model_upload_content_addressed_and_validated(session : Session, client : TestClient, token : str):
+    headers = {'Authorization' : f'Bearer {token}'}
+    content = open("rf_clf_v0.model", "rb").read()
+    for name in ("upload_a", "upload_b"):
+        response = client.post('http://127.0.0.1:8000/model_upload', headers=headers,
+                               files={"file" : (f"{name}.model", content)})
+        assert json.loads(response.text) == {"success" : "ml model has successfully uploaded"}
+    models = session.exec(select(MLModel).where(MLModel.model_name.in_(["upload_a", "upload_b"]))).all()
+    # identical uploads share one file named by its content hash
+    assert len({model.model_file for model in models}) == 1
+    model_file = models[0].model_file
+    assert os.path.basename(model_file).startswith(hashlib.sha256(content).hexdigest())
+
+    response = client.post('http://127.0.0.1:8000/model_upload', headers=headers,
+                           files={"file" : ("upload_a.model", content)})
+    assert "Error" in json.loads(response.text)
+    response = client.post('http://127.0.0.1:8000/model_upload', headers=headers,
+                           files={"file" : ("not_a_model.model", b"not a pickle")})
+    assert "Error" in json.loads(response.text)
+    assert not [name for name in os.listdir("models") if name.startswith(".upload-")]
+
+    # the shared file is removed with the last model using it
+    client.request("DELETE", 'http://127.0.0.1:8000/model_delete', headers=headers, json={'model_name' : 'upload_a'})
+    assert os.path.exists(model_file)
+    client.request("DELETE", 'http://127.0.0.1:8000/model_delete', headers=headers, json={'model_name' : 'upload_b'})
+    assert not os.path.exists(model_file)
+
+
+def test_model_upload_rejects_oversized_files(session : Session, client : TestClient, token : str, monkeypatch):
+    headers = {'Authorization' : f'Bearer {token}'}
+    content = open("rf_clf_v0.model", "rb").read()
+    monkeypatch.setattr(routes, "MODEL_UPLOAD_MAX_BYTES", len(content) - 1)
+    # by its Content-Length before the body is read, and while a body of unknown length streams in
+    response = client.post('http://127.0.0.1:8000/model_upload', headers=headers,
+                           files={"file" : ("too_large.model", content)})
+    assert response.status_code == 413
+    boundary = "upload-boundary"
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="too_large.model"\r\n\r\n'.encode()
+            + content + f'\r\n--{boundary}--\r\n'.encode())
+    response = client.post('http://127.0.0.1:8000/model_upload', content=iter([body[:4096], body[4096:]]),
+                           headers=dict(headers, **{'Content-Type' : f'multipart/form-data; boundary={boundary}'}))
+    assert response.status_code == 413
+    assert session.exec(select(MLModel).where(MLModel.model_name=="too_large")).first() is None
+    assert not [name for name in os.listdir("models") if name.startswith(".upload-")]
+
+    monkeypatch.setattr(routes, "MODEL_UPLOAD_MAX_BYTES", len(content))
+    response = client.post('http://127.0.0.1:8000/model_upload', content=iter([body[:4096], body[4096:]]),
+                           headers=dict(headers, **{'Content-Type' : f'multipart/form-data; boundary={boundary}'}))
+    assert json.loads(response.text) == {"success" : "ml model has successfully uploaded"}
+    client.request("DELETE", 'http://127.0.0.1:8000/model_delete', headers=headers, json={'model_name' : 'too_large'})
+
+
+def test_training_job_registers_model(tmp_path, client : TestClient, token : str):
+    # the training process connects to the database on its own, so it needs a database file
+    engine = create_engine(f"sqlite:///{tmp_path / 'training.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        for i in range(60):
+            session.add(Record(category='SEO', country='Australia', hourly_from='', hourly_to='', budget=str(i * 10),
+                               label='Applied' if i < 30 else 'Rejected'))
+        session.add(Record(category='SEO', country='Australia', hourly_from='', hourly_to='', budget='', label=''))
+        session.commit()
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+    app.dependency_overrides[get_session] = get_session_override
+    headers = {'Authorization' : f'Bearer {token}'}
+
+    response = client.post('http://127.0.0.1:8000/training_jobs', headers=headers, json={'model_name' : 'trained_v1', 'n_estimators' : 10})
+    job = response.json()
+    assert job['status'] == 'queued' and job['parameters']['n_estimators'] == 10
+    deadline = time.monotonic() + 60
+    while job['status'] in ('queued', 'running') and time.monotonic() < deadline:
+        time.sleep(0.2)
+        job = client.get(f"http://127.0.0.1:8000/training_jobs/{job['id']}", headers=headers).json()
+    assert job['status'] == 'succeeded', job
+    assert job['records'] == 60 # the unlabeled record is left out
+    assert job['metrics']['accuracy'] > 0.8
+    assert job['metrics']['test_records'] + job['metrics']['train_records'] == 60
+
+    with Session(engine) as session:
+        ml_model = session.exec(select(MLModel).where(MLModel.model_name == 'trained_v1')).one()
+    try:
+        assert json.loads(ml_model.metrics) == job['metrics']
+        model = load_model_file(ml_model.model_file, backend='sklearn')
+        assert Predict().predict_leads(np.array([[0.0, 0.0, 0.0, 3, 37], [590.0, 0.0, 0.0, 3, 37]]), model) == ['Applied', 'Rejected']
+        response = client.post('http://127.0.0.1:8000/training_jobs', headers=headers, json={'model_name' : 'trained_v1'})
+        assert response.status_code == 400
+    finally:
+        os.remove(ml_model.model_file)
+    assert [job['id'] for job in client.get('http://127.0.0.1:8000/training_jobs', headers=headers).json()] == [job['id']]
+
+
+def test_rescoring_resumes_from_checkpoint(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'rescoring.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+        for i in range(40):
+            session.add(Record(posted_at=datetime(2023, 8, 1 + i % 3), category='Full Stack Development', country='Australia',
+                               hourly_from=str(i), hourly_to=str(2 * i), budget='' if i % 2 else str(i * 100), label='old'))
+        session.add(Record(category='SEO', hourly_from='not a number', hourly_to='', budget='', label='old'))
+        session.add(Record(category='SEO', label='Applied')) # beyond the re-scored id range
+        session.commit()
+        rebuild_stats(engine)
+        job = create_job(session, "rf_clf_v0", to_id=41)
+        # as if an earlier run was interrupted after the first 10 records
+        job.last_id = 10
+        session.add(job)
+        session.commit()
+        job_id = job.id
+        # batches end at the end of the id range
+        assert [record["id"] for record in read_batch(session, 39, 41, 7)] == [40, 41]
+
+    checkpoints = []
+    job = rescore_records(engine, job_id, batch_size=7, workers=2, nice=0, progress=lambda job: checkpoints.append(job.last_id))
+    # the record that cannot be encoded keeps its label
+    assert (job.status, job.records, job.last_id) == ("succeeded", 30, 41)
+    assert checkpoints == [17, 24, 31, 38, 41]
+
+    model = load_model_file("rf_clf_v0.model")
+    with Session(engine) as session:
+        records = session.exec(select(Record).order_by(Record.id)).all()
+    assert [record.label for record in records[:10] + records[40:]] == ['old'] * 11 + ['Applied']
+    expected = Predict().predict_leads(Predict().encode_leads([record.dict() for record in records[10:40]]), model)
+    assert [record.label for record in records[10:40]] == expected
+    assert job.changed == 30
+    # the lead statistics moved with the labels
+    assert rebuild_stats(engine, check_only=True) == {}
+
+
+def test_training_jobs_keep_exit_codes_of_forgotten_processes(tmp_path):
+    jobs = TrainingJobs(max_running=1)
+    # the process exits with an error, the database it connects to cannot be opened
+    database_url = f"sqlite:///{tmp_path / 'missing' / 'training.db'}"
+    jobs.start(1, database_url)
+    deadline = time.monotonic() + 60
+    while jobs.exitcode(1) is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert jobs.exitcode(1) == 1
+    # starting the next job forgets the exited process, its exit code is still known
+    jobs.start(2, database_url)
+    assert jobs.exitcode(1) == 1
+    jobs.shutdown()
+
+
+def test_register_model_removes_file_of_failed_insert(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'register.db'}")
+    SQLModel.metadata.create_all(engine)
+    model = load_model_file("rf_clf_v0.model")
+    with Session(engine) as session:
+        session.add(MLModel(model_name="taken", model_file="elsewhere.model"))
+        session.commit()
+        with pytest.raises(IntegrityError):
+            register_model(session, "taken", model, {}, directory=str(tmp_path))
+        assert [name for name in os.listdir(tmp_path) if name.endswith(".model")] == []
+
+        # a file shared with an identical registered model is kept
+        stored = register_model(session, "first", model, {}, directory=str(tmp_path))
+        with pytest.raises(IntegrityError):
+            register_model(session, "taken", model, {}, directory=str(tmp_path))
+        assert os.path.exists(stored.model_file)
+
+
+def test_model_alias_repoint(session : Session, client : TestClient, token : str):
+    headers = {'Authorization' : f'Bearer {token}'}
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.add(MLModel(model_name="rf_clf_v1", model_file="models/9592bee3b512fe3467d5.model"))
+    session.commit()
+    lead = dict(LEAD, model_name='production')
+
+    response = client.post('http://127.0.0.1:8000/model_alias', headers=headers,
+                           json={'alias' : 'production', 'model_name' : 'rf_clf_v0', 'shadow_model_name' : 'rf_clf_v1'})
+    assert "success" in json.loads(response.text)
+    response = client.post('http://127.0.0.1:8000/label_fetch', headers=headers, json=lead)
+    assert json.loads(response.text)['label'] in ('Applied', 'Rejected')
+
+    response = client.post('http://127.0.0.1:8000/model_alias', headers=headers,
+                           json={'alias' : 'production', 'model_name' : 'rf_clf_v1'})
+    assert "success" in json.loads(response.text)
+    aliases = json.loads(client.get('http://127.0.0.1:8000/model_aliases', headers=headers).text)["aliases"]
+    assert [(a['alias'], a['model_name'], a['shadow_model_name']) for a in aliases] == [('production', 'rf_clf_v1', None)]
+
+    # repointing at a missing version leaves the alias untouched
+    response = client.post('http://127.0.0.1:8000/model_alias', headers=headers,
+                           json={'alias' : 'production', 'model_name' : 'missing'})
+    assert "Error" in json.loads(response.text)
+    # a version in use by an alias cannot be deleted
+    response = client.request("DELETE", 'http://127.0.0.1:8000/model_delete', headers=headers, json={'model_name' : 'rf_clf_v1'})
+    assert json.loads(response.text)['status'] == 'Failed'
+
+
+@pytest.mark.asyncio
+async def test_shadow_scorer_counts_disagreements():
+    pr = Predict()
+    vector = pr.vectorize_lead(pr.encode_lead({'category': '', 'country': '', 'budget': '', 'hourly_from': '', 'hourly_to': ''}))
+    # a free worker per comparison, so none is skipped
+    executor = InferenceExecutor(max_workers=2, max_queue=8)
+    scorer = ShadowScorer(executor=executor, registry=ModelRegistry())
+    shadow = MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model")
+    shadow_label = pr.predict_lead(vector, load_model_file("rf_clf_v0.model"))
+    other_label = 'Rejected' if shadow_label == 'Applied' else 'Applied'
+    # the primary model agreed with the shadow model on the first lead and not on the second
+    scorer.schedule(shadow, vector, shadow_label, "primary")
+    scorer.schedule(shadow, vector, other_label, "primary")
+    await asyncio.gather(*scorer._tasks)
+    stats = scorer.stats()
+    assert (stats["compared"], stats["disagreements"], stats["skipped"], stats["errors"]) == (2, 1, 0, 0)
+    assert stats["disagreement_rate"] == 0.5
+    executor.shutdown()
+
+
+FEED_ITEM = """<item><title>Odoo expert</title><pubDate>Sun, 06 Aug 2023 09:40:00 +0000</pubDate>
+<description>Need an odoo expert &lt;br /&gt;&lt;b&gt;Hourly Range&lt;/b&gt;: $7.00-$20.00
+&lt;br /&gt;&lt;b&gt;Category&lt;/b&gt;: Full Stack Development&lt;br /&gt;&lt;b&gt;Skills&lt;/b&gt;:Odoo,     Python
+&lt;br /&gt;&lt;b&gt;Country&lt;/b&gt;: Australia
+&lt;br /&gt;</description></item>"""
+
+
+def test_feed_parser_extracts_items_incrementally():
+    document = f"<rss><channel><title>jobs</title>{FEED_ITEM * 3}</channel></rss>".encode()
+    parser = FeedParser()
+    items = []
+    for start in range(0, len(document), 100):
+        items.extend(parser.feed(document[start:start + 100]))
+    items.extend(parser.close())
+    assert len(items) == 3 and parser.items == 3
+    lead = item_lead(items[0], "rf_clf_v0")
+    assert lead == {'posted_on': 'August 06, 2023 09:40 UTC', 'category': 'Full Stack Development', 'skills': 'Odoo, Python',
+                    'country': 'Australia', 'message': 'Need an odoo expert', 'hourly_from': 7.0, 'hourly_to': 20.0,
+                    'budget': '', 'model_name': 'rf_clf_v0'}
+
+
+def test_feed_ingest(session : Session, client : TestClient, token : str):
+    headers = {'Authorization' : f'Bearer {token}'}
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    document = f"<rss><channel>{FEED_ITEM * 300}</channel></rss>"
+    response = client.post('http://127.0.0.1:8000/feed_ingest?model_name=rf_clf_v0', headers=headers, content=document)
+    summary = json.loads(response.text)
+    assert summary["items"] == 300 and summary["failed"] == 0
+    assert sum(summary["labels"].values()) == 300
+    assert len(session.exec(select(Record)).all()) == 300
+
+    response = client.post('http://127.0.0.1:8000/feed_ingest?model_name=rf_clf_v0', headers=headers, content="<rss><channel>")
+    assert response.status_code == 400
+
+
+def test_feed_ingest_skips_malformed_items(session : Session, client : TestClient, token : str):
+    headers = {'Authorization' : f'Bearer {token}'}
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    bad_item = "<item><title>Budget only</title><description>&lt;b&gt;Budget&lt;/b&gt; 500&lt;br /&gt;</description></item>"
+    document = f"<rss><channel>{FEED_ITEM}{bad_item}{FEED_ITEM * 2}</channel></rss>"
+    response = client.post('http://127.0.0.1:8000/feed_ingest?model_name=rf_clf_v0', headers=headers, content=document)
+    assert response.status_code == 200
+    summary = json.loads(response.text)
+    assert summary["items"] == 4 and summary["failed"] == 1
+    assert summary["error"]["error"] == "lead could not be extracted"
+    assert len(session.exec(select(Record)).all()) == 3
+
+
+def test_clean_messages_matches_sequential_cleaning():
+    messages = random_messages(300, seed=1)
+    legacy, processor = LegacyStringProc(), StringProc()
+    for remove_emoji in (False, True):
+        expected = [legacy_clean(legacy, txt, remove_emoji) for txt in messages]
+        assert processor.clean_messages(messages, remove_emoji=remove_emoji) == expected
+    assert processor.clean_message(messages[0]) == legacy_clean(legacy, messages[0])
+
+
+def test_metrics_render_exposition_format():
+    registry = []
+    requests = Counter("requests", "Requests", ["endpoint"], registry=registry)
+    latency = Histogram("latency_seconds", "Latency", ["stage"], buckets=(0.1, 1.0), registry=registry)
+    requests.inc("label_fetch")
+    requests.inc("label_fetch")
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, "predict")
+    text = render(registry)
+    assert 'requests_total{endpoint="label_fetch"} 2.0' in text
+    assert 'latency_seconds_bucket{stage="predict",le="0.1"} 2.0' in text
+    assert 'latency_seconds_bucket{stage="predict",le="1.0"} 3.0' in text
+    assert 'latency_seconds_bucket{stage="predict",le="+Inf"} 4.0' in text
+    assert 'latency_seconds_count{stage="predict"} 4.0' in text
+    assert "# TYPE latency_seconds histogram" in text
+
+
+def test_metrics_endpoint_after_label_fetch(session : Session, client : TestClient, token : str):
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    lead = dict(LEAD)
+    stages = ("jwt", "model_lookup", "model_load", "encode", "predict", "record_commit")
+    before = {stage : STAGE_SECONDS.count(stage) for stage in stages}
+    label = json.loads(client.post('http://127.0.0.1:8000/label_fetch', headers={'Authorization' : f'Bearer {token}'}, json=lead).text)['label']
+    assert all(STAGE_SECONDS.count(stage) == before[stage] + 1 for stage in stages)
+    assert PREDICTIONS.value("rf_clf_v0", label) >= 1
+
+    response = client.get('http://127.0.0.1:8000/metrics')
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'leadapi_stage_seconds_count{stage="predict"}' in response.text
+    assert f'leadapi_predictions_total{{model="rf_clf_v0",label="{label}"}}' in response.text
+    assert 'leadapi_db_pool_connections{state="checked_out"}' in response.text
+
+
+def test_profiled_requests(session : Session, client : TestClient, token : str):
+    session.add(MLModel(model_name="rf_clf_v0", model_file="rf_clf_v0.model"))
+    session.commit()
+    headers = {'Authorization' : f'Bearer {token}'}
+    lead = dict(LEAD)
+
+    # profiling is opt-in, the header is ignored unless it is enabled
+    response = client.post('http://127.0.0.1:8000/label_fetch', headers={**headers, 'X-Profile' : '1'}, json=lead)
+    assert "X-Profile-Id" not in response.headers
+    client = TestClient(ProfilingMiddleware(app, enabled=True))
+    response = client.post('http://127.0.0.1:8000/label_fetch', headers=headers, json=lead)
+    assert "X-Profile-Id" not in response.headers
+    # the header is ignored without a valid token, and on routes that do not verify one
+    response = client.get('http://127.0.0.1:8000/data_fetch', headers={'X-Profile' : '1'})
+    assert "X-Profile-Id" not in response.headers
+    response = client.post('http://127.0.0.1:8000/user/login', headers={**headers, 'X-Profile' : '1'},
+                           json={"email" : "nobody@example.com", "password" : "string"})
+    assert "X-Profile-Id" not in response.headers
+
+    names = []
+    try:
+        # calls in the inference pool and sync routes in the thread pool are profiled
+        for method, path, body, function in (("POST", "/label_fetch", lead, "prepare_lead"), ("GET", "/data_fetch", None, "iter_records")):
+            response = client.request(method, f'http://127.0.0.1:8000{path}', headers={**headers, 'X-Profile' : '1'}, json=body)
+            assert response.status_code == 200
+            names.append(response.headers["X-Profile-Id"])
+            report = client.get(f'http://127.0.0.1:8000/profiles/{names[-1]}', headers=headers)
+            assert function in report.text
+        assert set(names) <= set(json.loads(client.get('http://127.0.0.1:8000/profiles', headers=headers).text)["profiles"])
+        assert client.get('http://127.0.0.1:8000/profiles/..%2Ftest_app.py', headers=headers).status_code == 404
+    finally:
+        for name in names:
+            os.remove(os.path.join("profiles", name))
+
+
+def test_record_migration_backfills_typed_columns(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    # a warehouse created before the typed columns and indexes
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE record (id INTEGER PRIMARY KEY, posted_on VARCHAR, category VARCHAR, skills VARCHAR, "
+                                "country VARCHAR, message VARCHAR, hourly_from VARCHAR, hourly_to VARCHAR, budget VARCHAR, label VARCHAR)"))
+        for i in range(5):
+            connection.execute(text("INSERT INTO record (posted_on, hourly_from, hourly_to, budget, label) VALUES (:p, :f, :t, :b, 'Applied')"),
+                               {"p" : f"August 0{i + 1}, 2023 09:40 UTC", "f" : "7.0", "t" : "20.0", "b" : ""})
+        connection.execute(text("INSERT INTO record (posted_on, hourly_from, hourly_to, budget) VALUES ('unknown', '', '', '')"))
+    SQLModel.metadata.create_all(engine)
+
+    # startup only checks the schema, the migration adds the columns and indexes
+    with pytest.raises(RuntimeError):
+        check_schema(engine)
+    assert set(add_missing_columns(engine)) == {"record.posted_at", "record.hourly_from_value", "record.hourly_to_value", "record.budget_value"}
+    assert add_missing_columns(engine) == []
+    create_indexes(engine)
+    indexed = {index["column_names"][0] for index in inspect(engine).get_indexes("record")}
+    assert {"label", "category", "country", "posted_at"} <= indexed
+    check_schema(engine)
+
+    # an index created meanwhile by another process is skipped, other failures are raised
+    def create(index, bind, checkfirst):
+        raise OperationalError("CREATE INDEX", {}, Exception(f"index {index.name} already exists"))
+    monkeypatch.setattr(Index, "create", create)
+    create_indexes(engine)
+    def create(index, bind, checkfirst):
+        raise OperationalError("CREATE INDEX", {}, Exception("disk I/O error"))
+    monkeypatch.setattr(Index, "create", create)
+    with pytest.raises(OperationalError):
+        create_indexes(engine)
+    monkeypatch.undo()
+
+    assert backfill_records(engine, chunk_size=2) == 5
+    assert backfill_records(engine, chunk_size=2) == 0 # already backfilled
+    with Session(engine) as session:
+        records = session.exec(select(Record).order_by(Record.id)).all()
+    assert records[0].posted_at == datetime(2023, 8, 1, 9, 40)
+    assert (records[0].hourly_from_value, records[0].hourly_to_value, records[0].budget_value) == (7.0, 20.0, None)
+    assert records[-1].posted_at is None
+
+    # posted_on ranges are matched in SQL on posted_at
+    with Session(engine) as session:
+        filters = RecordFilter(posted_from=datetime(2023, 8, 2), posted_to=datetime(2023, 8, 4))
+        assert [record.id for record in iter_records(session, filters)] == [2, 3]